@@ -0,0 +1,48 @@
+"""
+Overhead of a Chain evaluation, interpreted vs. compiled.
+
+    python benchmarks/bench_chain.py [n_calls]
+"""
+from __future__ import print_function
+import sys
+import time
+
+from dalek.tools.base import Chain, Link
+
+
+class Increment(Link):
+
+    def __init__(self, name_in, name_out):
+        self.inputs = (name_in,)
+        self.outputs = (name_out,)
+
+    def calculate(self, value):
+        return value + 1
+
+
+def make_chain(n_links=10):
+    links = [Increment('x{}'.format(i), 'x{}'.format(i + 1))
+             for i in range(n_links)]
+    half = n_links // 2
+    return Chain(
+            Chain(*links[:half]),
+            Chain(*links[half:], breakable=True))
+
+
+def timed(chain, n_calls):
+    start = time.time()
+    for _ in range(n_calls):
+        chain({'x0': 0})
+    return (time.time() - start) / n_calls
+
+
+def main(n_calls=20000):
+    interpreted = timed(make_chain(), n_calls)
+    compiled = timed(make_chain().compile(), n_calls)
+    print('{:12s} {:8.2f} us/call'.format('interpreted', interpreted * 1e6))
+    print('{:12s} {:8.2f} us/call'.format('compiled', compiled * 1e6))
+    print('{:12s} {:8.2f}x'.format('speedup', interpreted / compiled))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
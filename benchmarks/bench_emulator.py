@@ -0,0 +1,50 @@
+"""
+Compare prediction throughput of the emulators.
+
+    python benchmarks/bench_emulator.py [n_points]
+"""
+from __future__ import print_function
+import sys
+import time
+import warnings
+
+import numpy as np
+
+from dalek.emulator import Emulator, DecoupledEmulator
+
+
+def timed(f, *args, **kwargs):
+    start = time.time()
+    f(*args, **kwargs)
+    return time.time() - start
+
+
+def main(n_points=20000, n_samples=400, n_parameters=6, n_wavelength=1000,
+         n_components=8):
+    state = np.random.RandomState(0)
+    X = state.random_sample((n_samples, n_parameters))
+    wl = np.linspace(0, 1, n_wavelength)
+    Y = 2 + np.dot(np.sin(3 * X), np.cos(np.outer(
+        np.arange(1, n_parameters + 1), wl)))
+    points = state.random_sample((n_points, n_parameters))
+
+    emulators = [
+            ('Emulator', Emulator(X, Y, n_components)),
+            ('DecoupledEmulator', DecoupledEmulator(X, Y, n_components)),
+            ('DecoupledEmulator n_jobs=-1', DecoupledEmulator(
+                X, Y, n_components, n_jobs=-1)),
+            ]
+    # plain BLAS reference: a matmul the size of the correlation solve
+    a = state.random_sample((n_points, n_samples))
+    b = state.random_sample((n_samples, n_samples))
+    print('{:30s} {:10.3f} s'.format('matmul reference', timed(np.dot, a, b)))
+    for name, emulator in emulators:
+        emulator.predict(points[:10])
+        print('{:30s} {:10.3f} s'.format(
+            name, timed(emulator.predict, points)))
+
+
+if __name__ == '__main__':
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,86 @@
+"""
+Lock contention of SafeHDFStore: many local processes append single rows
+to the same file. Shows throughput and the time spent waiting for the lock
+for the flock based lock, the O_EXCL lock file with backoff and the old
+O_EXCL lock file polled every 0.1 s.
+
+    python benchmarks/bench_lock.py [n_processes] [n_writes]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+import warnings
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from dalek.wrapper import hdfstore
+from dalek.wrapper.hdfstore import SafeHDFStore, FileLock, ExclusiveFileLock
+
+
+class FixedIntervalLock(ExclusiveFileLock):
+    '''
+    The lock SafeHDFStore used before: a lock file polled every 0.1 s.
+    '''
+
+    def acquire(self):
+        while True:
+            try:
+                self._fd = os.open(
+                        self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                return
+            except OSError:
+                time.sleep(0.1)
+
+
+def writer(job):
+    lock_class, path, rank, n_writes = job
+    SafeHDFStore.lock_class = lock_class
+    waits = []
+    for i in range(n_writes):
+        start = time.time()
+        store = SafeHDFStore(path)
+        waits.append(time.time() - start)
+        store.append('runs', pd.DataFrame(
+            {'rank': [rank], 'i': [i], 'value': [np.random.random()]}))
+        store.close()
+    return waits
+
+
+def main(n_processes=64, n_writes=10):
+    directory = tempfile.mkdtemp()
+    print('{:20s} {:>10s} {:>10s} {:>10s} {:>10s}'.format(
+        'lock', 'writes/s', 'wait p50', 'wait p99', 'wait max'))
+    try:
+        for lock_class in [FileLock, ExclusiveFileLock, FixedIntervalLock]:
+            if lock_class is FileLock and hdfstore.fcntl is None:
+                continue
+            path = os.path.join(
+                    directory, '{}.h5'.format(lock_class.__name__))
+            pool = Pool(n_processes)
+            start = time.time()
+            waits = pool.map(writer, [
+                (lock_class, path, rank, n_writes)
+                for rank in range(n_processes)], chunksize=1)
+            elapsed = time.time() - start
+            pool.close()
+            pool.join()
+            waits = 1e3 * np.concatenate(waits)
+            with pd.HDFStore(path, 'r') as store:
+                assert len(store['runs']) == n_processes * n_writes
+            print('{:20s} {:10.1f} {:8.1f}ms {:8.1f}ms {:8.1f}ms'.format(
+                lock_class.__name__, len(waits) / elapsed,
+                np.percentile(waits, 50), np.percentile(waits, 99),
+                waits.max()))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        main(*[int(arg) for arg in sys.argv[1:]])
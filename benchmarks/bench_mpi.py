@@ -0,0 +1,71 @@
+"""
+Records per second the MPIContainer master saves while all workers send
+runs as fast as they can.
+
+    mpirun -n 256 python benchmarks/bench_mpi.py \
+        [n_records] [buffer_size] [n_flux] [transport]
+
+n_records is the number of records per worker, each with a flux of n_flux
+bins. transport is pickle or buffer.
+
+The target of 1000 records/s with 256 ranks has not been measured yet,
+only runs with a few ranks on one node were done so far.
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+import warnings
+from uuid import uuid4
+
+import numpy as np
+import pandas as pd
+from mpi4py import MPI
+
+from dalek.base.meta import MPIContainer, MetaInformation
+
+
+def main(n_records=20, buffer_size=10, n_flux=0, transport='pickle'):
+    comm = MPI.COMM_WORLD
+    directory = tempfile.mkdtemp() if comm.rank == 0 else None
+    directory = comm.bcast(directory)
+    container = MPIContainer(
+            os.path.join(directory, 'runs.h5'), comm=comm.Dup(),
+            buffer_size=buffer_size, transport=transport)
+    items = [MetaInformation(
+            uid=comm.rank, iteration=i, probability=np.random.random(),
+            name=uuid4(), info_dict={'val1': 0.5, 'val2': np.random.random()})
+            for i in range(n_records)]
+    if n_flux:
+        for item in items:
+            item.add_data(pd.Series(np.random.random(n_flux)), 'flux')
+    if container.is_master():
+        container.receive()
+    comm.Barrier()
+    start = time.time()
+    if container.is_master():
+        expected = (comm.size - 1) * n_records
+        while container.n_received < expected:
+            time.sleep(1e-3)
+        elapsed = time.time() - start
+        container.stop()
+        with pd.HDFStore(os.path.join(directory, 'runs.h5'), 'r') as store:
+            assert len(store['run_table']) == expected
+        print('{} ranks, buffer_size {}, {} bins, {}: {:.0f} records/s'
+              .format(comm.size, buffer_size, n_flux, transport,
+                      expected / elapsed))
+        shutil.rmtree(directory)
+    else:
+        for item in items:
+            container.save(item, 'run_table')
+        container.close()
+    comm.Barrier()
+
+
+if __name__ == '__main__':
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        args = sys.argv[1:]
+        main(*([int(arg) for arg in args[:3]] + args[3:]))
@@ -0,0 +1,74 @@
+"""
+Time MetaInformation.to_hdf on a run_table with many rows, for new runs
+and for updates of existing runs. Reading the full table, which every save
+did before, is shown for comparison.
+
+    python benchmarks/bench_run_table.py [n_rows] [n_saves]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+import warnings
+from uuid import uuid4
+
+import numpy as np
+import pandas as pd
+
+from dalek.base.meta import MetaInformation
+
+
+def run(iteration, uid):
+    return MetaInformation(
+            uid=uid, iteration=iteration, probability=np.random.random(),
+            name=uuid4(), info_dict={'val1': 0.5, 'val2': np.random.random()})
+
+
+def main(n_rows=10 ** 6, n_saves=100, n_uids=100):
+    path = tempfile.mkdtemp()
+    try:
+        store = pd.HDFStore(os.path.join(path, 'runs.h5'))
+        iterations = np.arange(n_rows) // n_uids
+        df = pd.DataFrame({
+            'uid': np.arange(n_rows) % n_uids,
+            'iteration': iterations,
+            'name': [str(uuid4()) for _ in range(n_rows)],
+            'probability': np.random.random(n_rows),
+            'val1': 0.5,
+            'val2': np.random.random(n_rows),
+            }).set_index(['iteration', 'uid'])
+        start = time.time()
+        store.append('run_table', df, index=['iteration', 'uid'])
+        print('{:30s} {:10.3f} s'.format(
+            'write {} rows'.format(n_rows), time.time() - start))
+
+        start = time.time()
+        store['run_table']
+        print('{:30s} {:10.3f} ms'.format(
+            'read full table', 1e3 * (time.time() - start)))
+
+        last = iterations[-1]
+        for label, runs in [
+                ('save new run', [
+                    run(last + 1 + i // n_uids, i % n_uids)
+                    for i in range(n_saves)]),
+                ('update existing run', [
+                    run(np.random.randint(last), np.random.randint(n_uids))
+                    for _ in range(n_saves)])]:
+            start = time.time()
+            for item in runs:
+                item.to_hdf(store, 'run_table')
+            print('{:30s} {:10.3f} ms'.format(
+                label, 1e3 * (time.time() - start) / n_saves))
+        assert len(store.get_storer('run_table').table) == n_rows + n_saves
+        store.close()
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        main(*[int(arg) for arg in sys.argv[1:]])
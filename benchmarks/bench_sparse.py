@@ -0,0 +1,49 @@
+"""
+Compare training time, prediction time and accuracy of Emulator with the
+exact and the sparse GaussianProcess (gp='exact' and gp='sparse').
+
+    python benchmarks/bench_sparse.py [n_samples] [n_inducing]
+"""
+from __future__ import print_function
+import sys
+import time
+import warnings
+
+import numpy as np
+
+from dalek.emulator import Emulator
+
+
+def spectra(X, wl):
+    return 2 + np.dot(np.sin(3 * X), np.cos(np.outer(
+        np.arange(1, X.shape[1] + 1), wl)))
+
+
+def main(n_samples=2000, n_inducing=300, n_parameters=6, n_wavelength=1000,
+         n_components=8, n_points=5000):
+    state = np.random.RandomState(0)
+    wl = np.linspace(0, 1, n_wavelength)
+    X = state.random_sample((n_samples, n_parameters))
+    Y = spectra(X, wl)
+    points = state.random_sample((n_points, n_parameters))
+    truth = spectra(points, wl)
+
+    print('{:10s} {:>10s} {:>10s} {:>12s}'.format(
+        'gp', 'train', 'predict', 'rms error'))
+    for gp in ['exact', 'sparse']:
+        start = time.time()
+        emulator = Emulator(
+                X, Y, n_components, gp=gp, n_inducing=n_inducing)
+        train = time.time() - start
+        start = time.time()
+        predicted, _ = emulator.predict(points)
+        predict = time.time() - start
+        error = np.sqrt(np.mean((predicted - truth) ** 2))
+        print('{:10s} {:10.3f} {:10.3f} {:12.3e}'.format(
+            gp, train, predict, error))
+
+
+if __name__ == '__main__':
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        main(*[int(arg) for arg in sys.argv[1:]])
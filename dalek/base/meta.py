@@ -1,13 +1,19 @@
 # coding: utf-8
 import os
 import time
+import atexit
 import tables
+import weakref
 import warnings
+import numpy as np
 import pandas as pd
+from copy import copy
 # from multiprocessing import Process
-from threading import Thread
+from threading import Thread, RLock
+from collections import OrderedDict
+from Queue import Queue, Empty
 
-from dalek.wrapper import SafeHDFStore
+from dalek.wrapper import SafeHDFStore, HDFSession
 
 
 try:
@@ -16,6 +22,16 @@ except ImportError:
     MPI = None
 
 
+# containers closed at exit, weak so they can still be collected
+_open_containers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_containers():
+    for container in list(_open_containers):
+        container.close()
+
+
 class _end_receive_message(object):
 
     def __repr__(self):
@@ -32,6 +48,90 @@ class _item_wrapper(object):
         return ', '.join([str(self.item), self.path])
 
 
+class _packed(object):
+    '''
+    Placeholder for a float64 Series stored at buffer[start:stop].
+    '''
+
+    def __init__(self, series, start):
+        self.start = start
+        self.stop = start + len(series)
+        self.name = series.name
+        if series.index.equals(pd.RangeIndex(len(series))):
+            self.index = None
+        else:
+            self.index = series.index
+
+    def unpack(self, buffer):
+        # a view of the buffer, no copy
+        return pd.Series(
+                buffer[self.start:self.stop], index=self.index,
+                name=self.name, copy=False)
+
+
+class _buffer_header(object):
+
+    def __init__(self, wrappers, size):
+        self.wrappers = wrappers
+        self.size = size
+
+
+def _is_packable(value):
+    return isinstance(value, pd.Series) and value.dtype == np.float64
+
+
+def _pack(wrappers):
+    '''
+    Move the float64 Series of `wrappers` (items or data of
+    MetaInformation) into one contiguous float64 buffer.
+
+    Returns:
+    (Tuple) (header, buffer) where header is a _buffer_header with copies
+    of the wrappers which refer to the buffer instead
+    '''
+    arrays = []
+    size = [0]
+
+    def pack(series):
+        arrays.append(series.values)
+        packed = _packed(series, size[0])
+        size[0] = packed.stop
+        return packed
+
+    header = []
+    for wrapper in wrappers:
+        item = wrapper.item
+        if _is_packable(item):
+            item = pack(item)
+        elif isinstance(item, MetaInformation):
+            item = copy(item)
+            for name in item._data:
+                value = getattr(item, '_' + name)
+                if _is_packable(value):
+                    setattr(item, '_' + name, pack(value))
+        header.append(_item_wrapper(item, wrapper.path))
+    if arrays:
+        buffer = np.concatenate(arrays)
+    else:
+        buffer = np.empty(0)
+    return _buffer_header(header, size[0]), buffer
+
+
+def _unpack(header, buffer):
+    '''
+    Inverse of _pack, the Series are views of `buffer`.
+    '''
+    for wrapper in header.wrappers:
+        if isinstance(wrapper.item, _packed):
+            wrapper.item = wrapper.item.unpack(buffer)
+        elif isinstance(wrapper.item, MetaInformation):
+            for name in wrapper.item._data:
+                value = getattr(wrapper.item, '_' + name)
+                if isinstance(value, _packed):
+                    setattr(wrapper.item, '_' + name, value.unpack(buffer))
+    return header.wrappers
+
+
 class MetaContainer(object):
     """
     Class to control storing of metainformation
@@ -44,49 +144,275 @@ class MetaContainer(object):
             Additional information that should be saved.
             For example dalek_version, tardis_version, time,
             number of ranks, iterations
+        window: float
+            Session mode: saves are collected and written together at most
+            `window` seconds later, the file is only locked while writing
+            (see dalek.wrapper.HDFSession). Default: None, the file is
+            locked until close. Errors of the delayed writes are raised
+            by the next save or close, the items are kept and written
+            again then.
 
     """
-    def __init__(self, path, summary_data=None):
+    store_class = SafeHDFStore
+
+    def __init__(self, path, summary_data=None, window=None):
         self._path, self._file = os.path.split(path)
         self._store = None
+        self._session = None
+        self._pending = []
+        self._error = None
+        if window is not None:
+            self._session = HDFSession(
+                    path, window, on_release=self._write_pending)
+            self._lock = self._session.lock
+        else:
+            self._lock = RLock()
         if summary_data is not None:
             self._write_summary(summary_data)
 
     @property
     def store(self):
+        if self._session is not None:
+            return self._session.store
         if self._store is None:
-            self._store = SafeHDFStore(os.path.join(self._path, self._file))
+            self._store = self.store_class(
+                    os.path.join(self._path, self._file))
         return self._store
 
     def close(self):
-        self._store.close()
-        self._store = None
+        with self._lock:
+            if self._session is not None:
+                self._session.release()
+            if self._store is not None:
+                self._store.close()
+            self._store = None
+            self._raise()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
 
     def _write_summary(self, data):
         '''
         Write summary_data to .h5 file.
         '''
-        if 'overview' not in self.store.keys():
-            pd.Series(
-                    data.values(), index=data.keys()
-                    ).to_hdf(self.store, 'overview')
+        with self._lock:
+            if 'overview' not in self.store.keys():
+                pd.Series(
+                        data.values(), index=data.keys()
+                        ).to_hdf(self.store, 'overview')
 
     def save(self, item, path):
-        item.to_hdf(self.store, path)
+        with self._lock:
+            self._raise()
+            if self._session is None:
+                item.to_hdf(self.store, path)
+            else:
+                self._pending.append(_item_wrapper(item, path))
+                self._session.schedule()
+
+    def _write_pending(self, session):
+        # called by the session right before it closes the store, possibly
+        # on its timer thread
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        try:
+            self._save_all(
+                    ((data.item, data.path) for data in pending),
+                    session.open())
+        except Exception as e:
+            self._pending = pending + self._pending
+            self._error = e
+
+    def save_all(self, items):
+        '''
+        Save a list of (item, path). The MetaInformation of every path are
+        saved with save_many.
+        '''
+        with self._lock:
+            self._save_all(items, self.store)
+
+    def _save_all(self, items, store):
+        batches = OrderedDict()
+        for item, path in items:
+            batches.setdefault(path, []).append(item)
+        for path, items in batches.items():
+            if all(isinstance(item, MetaInformation) for item in items):
+                self._save_many(items, path, store)
+            else:
+                for item in items:
+                    item.to_hdf(store, path)
+
+    def save_many(self, items, path):
+        '''
+        Save a list of MetaInformation. The rows of all items not yet in
+        the table are written with a single store.append.
+        '''
+        with self._lock:
+            self._save_many(items, path, self.store)
+
+    def _save_many(self, items, path, store):
+        new = []
+        for item in items:
+            if item.exists(store, path):
+                item.to_hdf(store, path)
+            else:
+                new.append(item)
+        if not new:
+            return
+        # the last item wins if the batch has the same row twice
+        new = list(OrderedDict((item.at, item) for item in new).values())
+        _append_rows(store, path, pd.concat([item.df for item in new]))
+        for item in new:
+            item._save_data(store)
+
+
+class _flush_message(object):
+    pass
+
+
+class AsyncContainer(object):
+    '''
+    Saves items of `container` in a background thread, so save returns
+    immediately. Items are collected until `batch_size` items are pending
+    or `flush_interval` seconds passed, then they are written with
+    container.save_many if available. save blocks while `maxsize` items
+    are waiting.
+
+    Errors of the writer are raised by the next save, flush or close. The
+    items that failed are written again with the next batch, after close
+    they are left in `failed` as (item, path). Pending items are written by
+    close, which is also called at exit.
+    '''
+
+    def __init__(
+            self, container, maxsize=10000, batch_size=100,
+            flush_interval=5.):
+        self.container = container
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = Queue(maxsize)
+        self._error = None
+        self.failed = []
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        _open_containers.add(self)
+
+    def save(self, item, path):
+        self._raise()
+        self._queue.put(_item_wrapper(item, path))
+
+    def flush(self):
+        '''
+        Block until all items saved so far are written.
+        '''
+        if self._thread is not None:
+            self._queue.put(_flush_message())
+            self._queue.join()
+        self._raise()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(_end_receive_message())
+            self._thread.join()
+            self._thread = None
+            if hasattr(self.container, 'close'):
+                self.container.close()
+        self._raise()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        pending = []
+        deadline = time.time() + self.flush_interval
+        while True:
+            try:
+                data = self._queue.get(
+                        timeout=max(deadline - time.time(), 0))
+            except Empty:
+                data = None
+            if isinstance(data, _item_wrapper):
+                pending.append(data)
+            if (data is None or len(pending) >= self.batch_size or
+                    not isinstance(data, _item_wrapper)):
+                pending = self._write(pending)
+                deadline = time.time() + self.flush_interval
+            if data is not None:
+                self._queue.task_done()
+            if isinstance(data, _end_receive_message):
+                self.failed = [(d.item, d.path) for d in pending]
+                return
+
+    def _write(self, pending):
+        '''
+        Returns the items which couldn't be written.
+        '''
+        batches = OrderedDict()
+        for data in pending:
+            batches.setdefault(data.path, []).append(data)
+        failed = []
+        for path, batch in batches.items():
+            items = [data.item for data in batch]
+            try:
+                if (hasattr(self.container, 'save_many') and all(
+                        isinstance(i, MetaInformation) for i in items)):
+                    self.container.save_many(items, path)
+                else:
+                    for item in items:
+                        self.container.save(item, path)
+            except Exception as e:
+                self._error = e
+                failed.extend(batch)
+        return failed
 
 
 class MPIContainer(object):
+    '''
+    Workers send their items to the master (rank 0), which saves them in
+    the thread started by receive. Every worker has to close its
+    MPIContainer, stop (and close) on the master saves everything
+    received until all workers have closed.
+
+    Keyword arguments:
+    buffer_size -- number of items a worker collects before sending them
+                in one message. Items still buffered are sent by flush or
+                close, which is also called at exit. (default: 1)
+    max_batch -- maximum number of messages the master saves at once
+                (default: 1000)
+    transport -- 'pickle': workers send the pickled items; 'buffer': the
+                float64 Series (e.g. fluxes) are sent as one contiguous
+                buffer with Send, only the rest is pickled. The master
+                accepts both. (default: 'pickle')
+    Other arguments are passed on to the MetaContainer of the master.
+    '''
 
     def __init__(self, *args, **kwargs):
         comm = kwargs.pop('comm', None)
         self.comm = MPI.COMM_WORLD.Dup() if comm is None else comm
         self.debug = kwargs.pop('debug', False)
+        self.buffer_size = kwargs.pop('buffer_size', 1)
+        self.max_batch = kwargs.pop('max_batch', 1000)
+        self.transport = kwargs.pop('transport', 'pickle')
+        if self.transport not in ('pickle', 'buffer'):
+            raise ValueError(
+                    'transport has to be pickle or buffer, got {}'.format(
+                        self.transport))
         self.status = MPI.Status()
         if self.is_master():
             self.container = MetaContainer(*args, **kwargs)
         else:
             self.container = None
+        self._buffer = []
         self._p = None
+        self._closed = False
+        self.n_received = 0
+        _open_containers.add(self)
 
     def is_master(self):
         return self.comm.rank == 0
@@ -98,52 +424,99 @@ class MPIContainer(object):
         if self.is_master():
             self.container.save(item, path)
         else:
-            if self.debug:
-                print('save: {} sending data to master'.format(
-                    self.comm.rank))
+            self._buffer.append(_item_wrapper(item, path))
+            if len(self._buffer) >= self.buffer_size:
+                self.flush()
+
+    def flush(self):
+        '''
+        Send the items buffered by a worker to the master.
+        '''
+        if self.is_master() or not self._buffer:
+            return
+        if self.debug:
+            print('save: {} sending {} items to master'.format(
+                self.comm.rank, len(self._buffer)))
+        buffer, self._buffer = self._buffer, []
+        if self.transport == 'pickle':
             self.comm.send(
-                    _item_wrapper(item, path),
+                    buffer,
                     dest=0,
-                    # tag=4,
                     tag=self.comm.rank
                     )
+            return
+        header, values = _pack(buffer)
+        self.comm.send(header, dest=0, tag=self.comm.rank)
+        if header.size:
+            self.comm.Send([values, MPI.DOUBLE], dest=0, tag=self.comm.rank)
 
     def receive(self):
         assert self.is_master()
 
         # Define function that will run in a seperate thread
         def f():
+            stop = False
+            closed = set()
             while True:
                 # Waiting for a message
                 if self.debug:
                     print('receive: waiting...')
+                self.comm.Probe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG)
 
-                # Receive a message
-                data = self.comm.recv(
+                # Receive all messages that arrived
+                batch = []
+                n_messages = 0
+                while n_messages < self.max_batch and self.comm.Iprobe(
                         source=MPI.ANY_SOURCE,
                         tag=MPI.ANY_TAG,
-                        status=self.status)
+                        status=self.status):
+                    data = self.comm.recv(
+                            source=self.status.source,
+                            tag=self.status.tag,
+                            status=self.status)
+                    n_messages += 1
 
-                if self.debug:
-                    print('receive: from {} with tag {}'.format(
-                        self.status.source, self.status.tag))
-                    print('receive: data is {}'.format(data))
+                    if self.debug:
+                        print('receive: from {} with tag {}'.format(
+                            self.status.source, self.status.tag))
+                        print('receive: data is {}'.format(data))
+
+                    # rank 0 asks to stop, workers send it on close. Messages
+                    # of one rank arrive in order, so a closed worker has
+                    # nothing left in flight.
+                    if isinstance(data, _end_receive_message):
+                        if self.status.source == 0:
+                            stop = True
+                        else:
+                            closed.add(self.status.source)
+                        continue
+                    if isinstance(data, _buffer_header):
+                        # the values follow from the same rank
+                        values = np.empty(data.size)
+                        if data.size:
+                            self.comm.Recv(
+                                    [values, MPI.DOUBLE],
+                                    source=self.status.source,
+                                    tag=self.status.tag)
+                        data = _unpack(data, values)
+                    if isinstance(data, _item_wrapper):
+                        data = [data]
+                    batch.extend(data)
+
+                # Save the data
+                if batch:
+                    self.container.save_all(
+                            (data.item, data.path) for data in batch)
+                    self.n_received += len(batch)
+                    if self.debug:
+                        print('receive: finished saving {} items'.format(
+                            len(batch)))
 
-                # Stop the loop on special object
-                if (isinstance(data, _end_receive_message) and
-                        self.status.source == 0):
+                if stop and len(closed) == self.comm.size - 1:
                     if self.debug:
                         print("receive: end signal. stopping")
                     self.container.close()
                     break
-
-                # Save the data
-                self.container.save(data.item, data.path)
-                if self.debug:
-                    print('receive: finished saving {}'.format(data.item))
-
-                # Wait a small amount, might be unnecessary
-                time.sleep(0.1)
             return
 
         # Create and start the thread
@@ -157,6 +530,9 @@ class MPIContainer(object):
             pass
 
     def stop(self):
+        '''
+        Stop receiving once all workers closed, waits for that.
+        '''
         assert self.is_master()
         if self._p and self._p.is_alive():
             self.comm.send(
@@ -168,6 +544,34 @@ class MPIContainer(object):
         self.join()
         self._p = None
 
+    def close(self):
+        '''
+        Workers send their buffered items and tell the master they are
+        done. The master stops receiving once all workers closed and
+        closes its container.
+        '''
+        if self.is_master():
+            if self._p is not None:
+                self.stop()
+            self.container.close()
+        elif not self._closed:
+            self.flush()
+            self.comm.send(
+                    _end_receive_message(), dest=0, tag=self.comm.rank)
+            self._closed = True
+
+
+def _append_rows(store, path, df):
+    '''
+    Append rows of MetaInformation.df to the table `path`, indexed on
+    iteration and uid.
+    '''
+    min_itemsize = None
+    if path not in store:
+        min_itemsize = {'values': MetaInformation.min_itemsize}
+    store.append(
+            path, df, index=['iteration', 'uid'], min_itemsize=min_itemsize)
+
 
 class MetaInformation(object):
     '''
@@ -180,7 +584,11 @@ class MetaInformation(object):
         str name: currently uuid4() is used to name individual runs
         dict info_dict: dictionary of arbitary key/value paires to be
                             appended to the table
+
+    The string columns of a new table have room for `min_itemsize`
+    characters, longer strings can't be saved to it later.
     '''
+    min_itemsize = 64
 
     def __init__(self, uid, iteration, probability, name,
                  info_dict={}):
@@ -222,23 +630,70 @@ Please choose another name.\n'''.format(name))
     def _save_data(self, store):
         warnings.simplefilter('ignore', tables.NaturalNameWarning)
         for d in self._data:
-            try:
-                store[self.data_path(d)]
-            except KeyError:
+            if self.data_path(d) not in store:
                 getattr(self, '_' + d).to_hdf(store, self.data_path(d))
 
+    @property
+    def _where(self):
+        return 'iteration == {} & uid == {}'.format(
+                self._iteration, self._uid)
+
+    def _coordinates(self, store, path):
+        if path not in store:
+            return []
+        return store.select_as_coordinates(path, self._where)
+
+    def exists(self, store, path):
+        '''
+        True if the table `path` has a row for this run. The query uses the
+        PyTables index on iteration and uid instead of reading the table.
+        '''
+        return len(self._coordinates(store, path)) > 0
+
+    def _modify(self, store, path, coordinates):
+        '''
+        Overwrite the rows at `coordinates` with self.df in place. Returns
+        False if the row doesn't fit the table (other columns, longer
+        strings).
+        '''
+        storer = store.get_storer(path)
+        storer.infer_axes()
+        df = self.df
+        columns = set(df.columns)
+        blocks = []
+        for axis in storer.values_axes:
+            if axis.cname in df.index.names:
+                continue
+            if not columns.issuperset(axis.values):
+                return False
+            columns.difference_update(axis.values)
+            values = df[axis.values].values
+            dtype = storer.table.coldtypes[axis.cname]
+            if values.dtype.kind == 'M':
+                values = values.view('i8')
+            elif dtype.base.kind == 'S':
+                values = values.astype(str)
+                if values.dtype.itemsize > dtype.base.itemsize:
+                    return False
+            blocks.append((axis.cname, values.reshape((1,) + dtype.shape)))
+        if columns:
+            return False
+        for cname, values in blocks:
+            for coordinate in coordinates:
+                storer.table.modify_column(
+                        coordinate, coordinate + 1, column=values,
+                        colname=cname)
+        return True
+
     def to_hdf(self, store, path):
-        # print('to_hdf: uid = {}'.format(self._uid))
-        try:
-            if self.at in store[path].index:
-                df = store[path]
-                del store[path]
-                df.loc[self.at] = self.df.loc[self.at]
-            else:
-                df = self.df
-        except KeyError:
-            df = self.df
-        store.append(path, df)
+        coordinates = self._coordinates(store, path)
+        if not len(coordinates):
+            _append_rows(store, path, self.df)
+        elif not self._modify(store, path, coordinates):
+            # append the new version first, so the old row is kept if it
+            # doesn't fit either
+            _append_rows(store, path, self.df)
+            store.remove(path, where=coordinates)
         self._save_data(store)
 
     @property
@@ -0,0 +1,187 @@
+# coding: utf-8
+'''
+Sharded output: every rank writes its own file without locking, the
+shards are combined after the run with merge_shards (or the command
+dalek-merge-shards) or read as one with ShardedView.
+'''
+import os
+import glob
+import argparse
+import warnings
+
+import tables
+import pandas as pd
+from pandas import HDFStore
+
+from dalek.base.meta import MetaContainer, MPI
+from dalek.wrapper import SafeHDFStore
+
+
+def shard_path(path, rank):
+    root, ext = os.path.splitext(path)
+    return '{}.rank{:04d}{}'.format(root, rank, ext)
+
+
+def shard_paths(path):
+    root, ext = os.path.splitext(path)
+    return sorted(glob.glob(
+        '{}.rank[0-9][0-9][0-9][0-9]{}'.format(root, ext)))
+
+
+class ShardedMetaContainer(MetaContainer):
+    '''
+    MetaContainer writing to the file shard_path(path, rank). No other
+    process writes to it, so it isn't locked. The keyword argument `rank`
+    defaults to the rank in MPI.COMM_WORLD, the other arguments are those
+    of MetaContainer.
+    '''
+    store_class = HDFStore
+
+    def __init__(self, path, *args, **kwargs):
+        rank = kwargs.pop('rank', None)
+        if rank is None:
+            rank = MPI.COMM_WORLD.rank if MPI is not None else 0
+        self.rank = rank
+        super(ShardedMetaContainer, self).__init__(
+                shard_path(path, rank), *args, **kwargs)
+
+
+def _string_itemsize(storer):
+    storer.infer_axes()
+    return max([0] + [
+        storer.table.coldtypes[axis.cname].base.itemsize
+        for axis in storer.values_axes
+        if storer.table.coldtypes[axis.cname].base.kind == 'S'])
+
+
+def merge_shards(path, output=None, remove=False, chunksize=100000):
+    '''
+    Combine the shards of `path` into `output` (default: path). Tables
+    like the run_table are concatenated and indexed on iteration and uid,
+    other nodes (data/<uuid>/..., overview) are taken from the first shard
+    having them. `output` must not contain the tables yet.
+
+    Keyword arguments:
+    remove -- delete the shards afterwards (default: False)
+    chunksize -- number of rows copied at once (default: 100000)
+
+    Returns:
+    (list) the merged shards
+    '''
+    output = path if output is None else output
+    shards = shard_paths(path)
+    warnings.simplefilter('ignore', tables.NaturalNameWarning)
+    # strings have a fixed size in a table, use the largest of all shards
+    itemsize = {}
+    for shard in shards:
+        with HDFStore(shard, 'r') as store:
+            for key in store.keys():
+                storer = store.get_storer(key)
+                if storer.is_table:
+                    itemsize[key] = max(
+                            itemsize.get(key, 0), _string_itemsize(storer))
+
+    with SafeHDFStore(output) as out:
+        for key in itemsize:
+            if key in out:
+                raise ValueError('{} already has {}'.format(output, key))
+        for shard in shards:
+            with HDFStore(shard, 'r') as store:
+                for key in store.keys():
+                    if key in itemsize:
+                        min_itemsize = (
+                                {'values': itemsize[key]}
+                                if itemsize[key] else None)
+                        for chunk in store.select(key, chunksize=chunksize):
+                            out.append(
+                                    key, chunk, index=False,
+                                    min_itemsize=min_itemsize)
+                    elif key not in out:
+                        out.put(key, store[key])
+        for key in itemsize:
+            if key not in out:
+                continue
+            columns = [
+                    c for c in ('iteration', 'uid')
+                    if c in out.get_storer(key).table.colnames]
+            if columns:
+                out.create_table_index(
+                        key, columns=columns, optlevel=9, kind='full')
+    if remove:
+        for shard in shards:
+            os.remove(shard)
+    return shards
+
+
+class ShardedView(object):
+    '''
+    Read-only view of all shards of `path` as if they were one HDFStore.
+    Tables are concatenated, other nodes are taken from the first shard
+    having them. Can be used in place of an HDFStore context manager,
+    e.g. for RunInfoFromFile.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._stores = None
+
+    def open(self):
+        if self._stores is None:
+            self._stores = [
+                    HDFStore(shard, 'r') for shard in shard_paths(self.path)]
+
+    def close(self):
+        for store in self._stores or []:
+            store.close()
+        self._stores = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def stores(self):
+        self.open()
+        return self._stores
+
+    def keys(self):
+        keys = set()
+        for store in self.stores:
+            keys.update(store.keys())
+        return sorted(keys)
+
+    def __contains__(self, key):
+        return any(key in store for store in self.stores)
+
+    def __getitem__(self, key):
+        return self.select(key)
+
+    def select(self, key, *args, **kwargs):
+        '''
+        HDFStore.select on every shard having `key`.
+        '''
+        stores = [store for store in self.stores if key in store]
+        if not stores:
+            raise KeyError('No object named {} in {}'.format(key, self.path))
+        if not stores[0].get_storer(key).is_table:
+            return stores[0][key]
+        return pd.concat([store.select(key, *args, **kwargs)
+                          for store in stores])
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+            description='Merge the per-rank shards of a dalek output file.')
+    parser.add_argument('path', help='path given to ShardedMetaContainer')
+    parser.add_argument(
+            '-o', '--output', help='merged file (default: path)')
+    parser.add_argument(
+            '--remove', action='store_true',
+            help='delete the shards afterwards')
+    args = parser.parse_args(args)
+    shards = merge_shards(args.path, args.output, remove=args.remove)
+    print('merged {} shards into {}'.format(
+        len(shards), args.output or args.path))
@@ -1,5 +1,6 @@
-# import os
+import os
 import time
+import shutil
 import pytest
 import tempfile
 from uuid import uuid4
@@ -8,7 +9,9 @@ import pandas as pd
 
 from copy import copy
 
-from dalek.base.meta import MetaContainer, MetaInformation, MPIContainer
+from dalek.base.meta import (
+        MetaContainer, MetaInformation, MPIContainer, AsyncContainer,
+        _item_wrapper, _pack, _unpack)
 
 
 try:
@@ -168,49 +171,234 @@ class TestMetaInformation(object):
                     store['run_table'].loc[instance2.at] ==
                     instance2.df.loc[instance2.at])
 
+    def test_update_fallback(self, instance):
+        instance._info_dict = {'host': 'a', 'val1': 1.}
+        self.container.save(instance, 'run_table')
+        other = copy(instance)
+        other._iteration += 1
+        self.container.save(other, 'run_table')
+        # longer strings fit in place
+        instance._info_dict = {'host': 'a' * 10, 'val1': 2.}
+        self.container.save(instance, 'run_table')
+        # too long for the table, the old row is kept
+        instance._info_dict = {'host': 'a' * 100, 'val1': 4.}
+        with pytest.raises(ValueError):
+            self.container.save(instance, 'run_table')
+        self.container.close()
+        with pd.HDFStore(self._file.name, 'r') as store:
+            assert len(store['run_table']) == 2
+            assert store['run_table'].loc[instance.at, 'val1'] == 2.
+            assert store['run_table'].loc[instance.at, 'host'] == 'a' * 10
+            assert store.get_storer('run_table').table.colindexes.keys()
+
+    def test_save_many(self, parameter_dict, instance):
+        instance._info_dict = parameter_dict
+        self.container.save(instance, 'run_table')
+        updated = copy(instance)
+        updated._probability = 2.
+        others = []
+        for i in range(5):
+            other = copy(instance)
+            other._iteration += i + 1
+            other._name = uuid4()
+            other._data = set(['foo'])
+            other._foo = pd.Series(np.arange(i + 1))
+            others.append(other)
+        self.container.save_many([updated] + others, 'run_table')
+        self.container.close()
+        with pd.HDFStore(self._file.name, 'r') as store:
+            assert len(store['run_table']) == 6
+            assert store['run_table'].loc[instance.at, 'probability'] == 2.
+            for other in others:
+                assert np.all(
+                        store['run_table'].loc[other.at] ==
+                        other.df.loc[other.at])
+                assert np.all(store[other.data_path('foo')] == other._foo)
+
+    def test_save_all(self, instance):
+        others = []
+        for i in range(3):
+            other = copy(instance)
+            other._iteration += i + 1
+            others.append(other)
+        series = pd.Series(np.arange(3))
+        self.container.save_all(
+                [(instance, 'run_table'), (series, 'series')] +
+                [(item, 'other_table') for item in others])
+        self.container.close()
+        with pd.HDFStore(self._file.name, 'r') as store:
+            assert len(store['run_table']) == 1
+            assert len(store['other_table']) == 3
+            assert np.all(store['series'] == series)
+
+
+def test_pack():
+    item = MetaInformation(1, 2, 0.5, uuid4(), {'val1': 0.5})
+    item.add_data(pd.Series(np.random.random(10)), 'flux')
+    item.add_data(pd.Series(np.arange(3)), 'ints')
+    series = pd.Series(np.random.random(5), index=np.arange(5) * 2.)
+    header, buffer = _pack([
+        _item_wrapper(item, 'run_table'), _item_wrapper(series, 'series')])
+    assert header.size == len(buffer) == 15
+    # the original item is unchanged
+    assert isinstance(item._flux, pd.Series)
+
+    wrappers = _unpack(header, buffer.copy())
+    assert [w.path for w in wrappers] == ['run_table', 'series']
+    unpacked = wrappers[0].item
+    assert unpacked.at == item.at
+    assert np.all(unpacked._flux == item._flux)
+    assert unpacked._ints is item._ints
+    assert np.all(wrappers[1].item == series)
+    assert np.all(wrappers[1].item.index == series.index)
+
+
+def test_meta_container_window():
+    f = tempfile.NamedTemporaryFile()
+    container = MetaContainer(f.name, summary_data={'a': 1}, window=0.05)
+    items = [MetaInformation(
+            uid=0, iteration=i, probability=np.random.random(),
+            name=uuid4(), info_dict={'val1': 0.5}) for i in range(5)]
+    for item in items:
+        container.save(item, 'run_table')
+    assert len(container._pending) == 5
+    time.sleep(0.3)
+    assert not container._session.is_open
+    with pd.HDFStore(f.name, 'r') as store:
+        assert len(store['run_table']) == 5
+        assert store['overview']['a'] == 1
+
+    items[0]._probability = 2.
+    container.save(items[0], 'run_table')
+    container.close()
+    with pd.HDFStore(f.name, 'r') as store:
+        assert store['run_table'].loc[items[0].at, 'probability'] == 2.
+
+
+class Failing(object):
+    fail = True
+
+    def to_hdf(self, store, path):
+        if self.fail:
+            raise IOError('disk full')
+        pd.Series([1.]).to_hdf(store, path)
+
+
+def test_meta_container_window_error():
+    f = tempfile.NamedTemporaryFile()
+    container = MetaContainer(f.name, window=0.05)
+    item = Failing()
+    container.save(item, 'series')
+    time.sleep(0.3)
+    # kept for the next attempt, the error is raised by the next call
+    assert len(container._pending) == 1
+    with pytest.raises(IOError):
+        container.save(item, 'series')
+    with pytest.raises(IOError):
+        container.close()
+    item.fail = False
+    container.close()
+    assert not container._pending
+    with pd.HDFStore(f.name, 'r') as store:
+        assert np.all(store['series'] == [1.])
+
+
+def test_async_container():
+    f = tempfile.NamedTemporaryFile()
+    container = AsyncContainer(
+            MetaContainer(f.name), batch_size=7, flush_interval=0.05)
+    items = [MetaInformation(
+            uid=0, iteration=i, probability=np.random.random(),
+            name=uuid4(), info_dict={'val1': 0.5}) for i in range(20)]
+    for item in items[:10]:
+        container.save(item, 'run_table')
+    container.flush()
+    container.container.close()
+    with pd.HDFStore(f.name, 'r') as store:
+        assert len(store['run_table']) == 10
+
+    for item in items[10:]:
+        container.save(item, 'run_table')
+    container.save(pd.Series(np.arange(3)), 'series')
+    container.close()
+    with pd.HDFStore(f.name, 'r') as store:
+        assert len(store['run_table']) == 20
+        for item in items:
+            assert np.all(
+                    store['run_table'].loc[item.at] == item.df.loc[item.at])
+        assert np.all(store['series'] == np.arange(3))
+
+
+def mpi_items(rank, n):
+    items = []
+    for i in range(n):
+        state = np.random.RandomState(100 * rank + i)
+        item = MetaInformation(
+                uid=rank, iteration=i, probability=state.random_sample(),
+                name='run{}_{}'.format(rank, i),
+                info_dict={'val1': 0.5, 'val2': state.random_sample()})
+        item.add_data(pd.Series(state.random_sample(10)), 'foo')
+        items.append(item)
+    return items
+
 
 @pytest.mark.skipif(
         MPI == None or MPI.COMM_WORLD.size < 2,
         reason="No MPI support found")
-def test_mpi_container():
+@pytest.mark.parametrize('transport', ['pickle', 'buffer'])
+@pytest.mark.parametrize('buffer_size', [1, 3])
+def test_mpi_container(transport, buffer_size):
     """
-    Run MPI test.
+    Every item of every worker arrives with the exact values.
     """
     comm = MPI.COMM_WORLD.Dup()
     rank = comm.rank
-    f = tempfile.NamedTemporaryFile()
-    mpi_container = MPIContainer(f.name, comm=comm)
-
-    np.random.seed(12345)
-    meta_info = [MetaInformation(
-            uid=np.random.randint(10),
-            iteration=np.random.randint(100),
-            probability=np.random.random(),
-            name='abc{}abc'.format(np.random.randint(10)),
-            info_dict={
-                'val1': 0.5,
-                'val2': np.random.random(),
-                }) for _ in range(comm.size)]
-    for m in meta_info:
-        m.add_data(pd.Series(np.arange(10)), 'foo')
+    directory = comm.bcast(tempfile.mkdtemp() if rank == 0 else None)
+    path = os.path.join(directory, 'test.h5')
+    mpi_container = MPIContainer(
+            path, comm=comm, transport=transport, buffer_size=buffer_size)
+    n_items = 7
 
     if rank == 0:
         mpi_container.receive()
-        time.sleep(2)
-        mpi_container.stop()
-        mpi_container.join()
-        with pd.HDFStore(f.name, 'r') as store:
-            for m in meta_info[1:]:
-                assert np.all(
-                        store['test'].loc[m.at] ==
-                        m.df.loc[m.at])
-                assert np.all(
-                        store[m.data_path('foo')] ==
-                        m._foo)
-
+    comm.Barrier()
     if rank > 0:
-        print('sending data...')
-        mpi_container.save(meta_info[rank], 'test')
-        with pytest.raises(IOError):
-            with pd.HDFStore(f.name, 'r') as store:
-                    store['test']
+        for item in mpi_items(rank, n_items):
+            mpi_container.save(item, 'test')
+    mpi_container.close()
+
+    if rank == 0:
+        with pd.HDFStore(path, 'r') as store:
+            assert len(store['test']) == (comm.size - 1) * n_items
+            for worker in range(1, comm.size):
+                for item in mpi_items(worker, n_items):
+                    assert np.all(
+                            store['test'].loc[item.at] ==
+                            item.df.loc[item.at])
+                    assert np.all(
+                            store[item.data_path('foo')].values ==
+                            item._foo.values)
+        shutil.rmtree(directory)
+    comm.Barrier()
+
+
+def test_async_container_error():
+    f = tempfile.NamedTemporaryFile()
+    container = AsyncContainer(
+            MetaContainer(f.name), batch_size=1, flush_interval=0.05)
+    item = Failing()
+    container.save(item, 'series')
+    with pytest.raises(IOError):
+        container.flush()
+    # kept and written with the next batch
+    item.fail = False
+    container.save(pd.Series([2.]), 'other')
+    container.flush()
+    item.fail = True
+    container.save(item, 'failed')
+    with pytest.raises(IOError):
+        container.close()
+    assert container.failed == [(item, 'failed')]
+    with pd.HDFStore(f.name, 'r') as store:
+        assert np.all(store['series'] == [1.])
+        assert np.all(store['other'] == [2.])
@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+from uuid import uuid4
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from dalek.base.meta import MetaInformation
+from dalek.base.shards import (
+        ShardedMetaContainer, ShardedView, merge_shards, shard_paths, main)
+
+
+@pytest.fixture
+def shards():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'runs.h5')
+    items = []
+    for rank in range(3):
+        container = ShardedMetaContainer(
+                path, rank=rank, summary_data={'ranks': 3})
+        for i in range(4):
+            item = MetaInformation(
+                    uid=rank, iteration=i, probability=np.random.random(),
+                    name=uuid4(), info_dict={'host': 'h' * (rank + 1)})
+            item.add_data(pd.Series(np.random.random(5)), 'flux')
+            container.save(item, 'run_table')
+            items.append(item)
+        container.close()
+    yield path, items
+    shutil.rmtree(directory)
+
+
+def check(store, items):
+    run_table = store['run_table']
+    assert len(run_table) == len(items)
+    for item in items:
+        assert np.all(run_table.loc[item.at] == item.df.loc[item.at])
+        assert np.all(store[item.data_path('flux')] == item._flux)
+    assert store['overview']['ranks'] == 3
+
+
+def test_sharded_view(shards):
+    path, items = shards
+    assert len(shard_paths(path)) == 3
+    assert not os.path.exists(path)
+    with ShardedView(path) as view:
+        check(view, items)
+        assert '/run_table' in view.keys()
+        selected = view.select('run_table', where='uid == 1')
+        assert len(selected) == 4
+
+
+def test_positional_arguments(shards):
+    path, _ = shards
+    # same positional arguments as MetaContainer
+    container = ShardedMetaContainer(path, {'ranks': 4}, None, rank=3)
+    container.close()
+    assert container.rank == 3
+    with pd.HDFStore(shard_paths(path)[-1], 'r') as store:
+        assert store['overview']['ranks'] == 4
+
+
+def test_merge_shards(shards):
+    path, items = shards
+    merged = merge_shards(path, chunksize=5)
+    assert merged == shard_paths(path)
+    with pd.HDFStore(path, 'r') as store:
+        check(store, items)
+        assert set(store.get_storer('run_table').table.colindexes) == set(
+                ['iteration', 'uid'])
+    with pytest.raises(ValueError):
+        merge_shards(path)
+
+    output = os.path.join(os.path.dirname(path), 'merged.h5')
+    main([path, '-o', output, '--remove'])
+    assert shard_paths(path) == []
+    with pd.HDFStore(output, 'r') as store:
+        check(store, items)
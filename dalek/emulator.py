@@ -1,49 +1,673 @@
+import os
+import json
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 import sklearn.decomposition
 import sklearn.gaussian_process
+from scipy import linalg
+from sklearn.gaussian_process import correlation_models
+from sklearn.metrics.pairwise import manhattan_distances
+
+
+def _squared_exponential(Xs, Ys):
+    '''
+    exp(-sum_j (x_j - y_j)**2) between the rows of Xs and the columns of Ys,
+    both already scaled with sqrt(theta). Ys is feature major.
+
+    The squared distances are accumulated one feature at a time. This keeps
+    only one (n_x, n_y) temporary and avoids the cancellation of the
+    |x|^2 + |y|^2 - 2xy expansion, which badly conditioned correlation
+    matrices amplify.
+    '''
+    d2 = np.empty((Xs.shape[0], Ys.shape[1]))
+    tmp = np.empty_like(d2)
+    np.subtract(Xs[:, [0]], Ys[0], out=d2)
+    d2 **= 2
+    for j in range(1, Xs.shape[1]):
+        np.subtract(Xs[:, [j]], Ys[j], out=tmp)
+        tmp **= 2
+        d2 += tmp
+    return np.exp(-d2, out=d2)
+
+
+def _scale(theta, n_features):
+    theta = np.asarray(theta, dtype=np.float64).ravel()
+    if theta.size == 1:
+        theta = np.repeat(theta, n_features)
+    return np.sqrt(theta)
+
+
+class ChunkedPredictor(object):
+    '''
+    Chunk wise prediction. Subclasses implement chunk_size and
+    _predict_chunk and set _n_targets and _y_ndim.
+    '''
+
+    def iter_chunks(self, X, eval_MSE=False, batch_size=None):
+        '''
+        Yields (slice, prediction) for consecutive chunks of X.
+        '''
+        X = np.atleast_2d(X)
+        if batch_size is None:
+            batch_size = self.chunk_size()
+        for start in range(0, X.shape[0], batch_size):
+            chunk = slice(start, min(start + batch_size, X.shape[0]))
+            yield chunk, self._predict_chunk(X[chunk], eval_MSE)
+
+    def predict(self, X, eval_MSE=False, batch_size=None):
+        '''
+        Same as GaussianProcess.predict but chunked and vectorized.
+        '''
+        X = np.atleast_2d(X)
+        n_eval = X.shape[0]
+        y = np.empty((n_eval, self._n_targets))
+        MSE = np.empty(n_eval)
+        for chunk, result in self.iter_chunks(X, eval_MSE, batch_size):
+            if eval_MSE:
+                y[chunk], MSE[chunk] = result
+            else:
+                y[chunk] = result
+        if self._y_ndim == 1:
+            y = y.ravel()
+        if eval_MSE:
+            return y, MSE
+        return y
+
+
+class BatchPredictor(ChunkedPredictor):
+    '''
+    Evaluates a fitted sklearn.gaussian_process.GaussianProcess for many
+    points at once.
+
+    Everything that only depends on the training set (Cholesky factor,
+    regression weights, scaled training inputs) is computed once.
+    Predictions are then done chunk wise with a few matrix products. The
+    chunk size is chosen so the temporaries of a chunk stay below
+    `memory_limit` bytes.
+
+    Parameters
+    ----------
+        gp: sklearn.gaussian_process.GaussianProcess
+            fitted Gaussian process
+        memory_limit: int
+            memory budget in bytes for the temporaries of one chunk
+    '''
+
+    def __init__(self, gp, memory_limit=2**28):
+        self.memory_limit = memory_limit
+        C, Ft, G = gp.C, gp.Ft, gp.G
+        if C is None:
+            # storage_mode='light' doesn't keep the factorization
+            _, par = gp.reduced_likelihood_function()
+            C, Ft, G = par['C'], par['Ft'], par['G']
+        n_samples, n_features = gp.X.shape
+        self._X = gp.X
+        self._X_mean = gp.X_mean
+        self._X_std = gp.X_std
+        self._y_mean = gp.y_mean
+        self._y_std = gp.y_std
+        self._y_ndim = gp.y_ndim_
+        self._n_targets = gp.y.shape[1]
+        self._regr = gp.regr
+        self._corr = gp.corr
+        self._theta = gp.theta_
+        self._beta = gp.beta
+        self._gamma = gp.gamma
+        # Solving against the triangular factor is as fast as multiplying
+        # with its inverse (both level 3 BLAS) but much better conditioned.
+        self._C = C
+        self._Ft = Ft
+        if gp.beta0 is None:
+            self._G_inv = linalg.inv(G)
+        else:
+            self._G_inv = None
+        self._sigma = np.sqrt(np.sum(gp.sigma2 ** 2) / self._n_targets)
+
+        if self._corr is correlation_models.squared_exponential:
+            self._scale = _scale(self._theta, n_features)
+            # feature major so every feature is a contiguous row
+            self._Xs = np.ascontiguousarray((self._X * self._scale).T)
+        else:
+            self._Xs = None
+
+    def chunk_size(self, n_columns=0):
+        '''
+        Number of points per chunk. `n_columns` are additional float64
+        values per point the caller allocates per chunk (e.g. a spectrum).
+        '''
+        n_samples, n_features = self._X.shape
+        if self._Xs is None:
+            # manhattan_distances keeps all componentwise distances
+            per_point = (n_features + 2) * n_samples
+        else:
+            per_point = 3 * n_samples
+        per_point += 2 * self._n_targets + n_columns
+        return max(1, int(self.memory_limit // (8 * per_point)))
+
+    def correlation(self, X):
+        '''
+        Correlation between the normalized points X and the training set.
+        '''
+        if self._Xs is None:
+            dx = manhattan_distances(X, Y=self._X, sum_over_features=False)
+            return self._corr(self._theta, dx).reshape(
+                    X.shape[0], self._X.shape[0])
+        return _squared_exponential(X * self._scale, self._Xs)
+
+    def _predict_chunk(self, X, eval_MSE):
+        X = (X - self._X_mean) / self._X_std
+        f = self._regr(X)
+        r = self.correlation(X)
+        y = self._y_mean + self._y_std * (
+                np.dot(f, self._beta) + np.dot(r, self._gamma))
+        if not eval_MSE:
+            return y
+        rt = linalg.solve_triangular(
+                self._C, r.T, lower=True, overwrite_b=True, check_finite=False)
+        mse = 1. - np.sum(rt ** 2, axis=0)
+        if self._G_inv is not None:
+            u = np.dot(np.dot(rt.T, self._Ft) - f, self._G_inv)
+            mse += np.sum(u ** 2, axis=1)
+        return y, self._sigma * np.abs(mse)
+
+
+_GP_ARRAYS = (
+        'X', 'y', 'X_mean', 'X_std', 'y_mean', 'y_std', 'theta_',
+        'beta', 'gamma', 'sigma2', 'C', 'Ft', 'G')
+_GP_PARAMS = (
+        'beta0', 'storage_mode', 'verbose', 'theta0', 'thetaL', 'thetaU',
+        'optimizer', 'random_start', 'normalize', 'nugget')
+_PCA_ARRAYS = (
+        'components_', 'mean_', 'explained_variance_', 'singular_values_')
+
+
+def _to_json(value):
+    try:
+        return value.tolist()
+    except AttributeError:
+        return value
+
+
+def _save_arrays(path, arrays):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name, value in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), np.asarray(value))
+
+
+def _load_arrays(path, names, mmap_mode):
+    return {
+            name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+            for name in names}
+
+
+def save_gp(gp, path):
+    '''
+    Store a fitted sklearn.gaussian_process.GaussianProcess in the directory
+    `path`. The Cholesky factorization is always stored, also for
+    storage_mode='light'.
+    '''
+    arrays = {name: getattr(gp, name) for name in _GP_ARRAYS}
+    if arrays['C'] is None:
+        _, par = gp.reduced_likelihood_function()
+        arrays.update(C=par['C'], Ft=par['Ft'], G=par['G'])
+    _save_arrays(path, arrays)
+    GP = sklearn.gaussian_process.GaussianProcess
+    meta = {name: _to_json(getattr(gp, name)) for name in _GP_PARAMS}
+    meta['regr'] = [
+            k for k, v in GP._regression_types.items() if v is gp.regr][0]
+    meta['corr'] = [
+            k for k, v in GP._correlation_types.items() if v is gp.corr][0]
+    meta['y_ndim_'] = gp.y_ndim_
+    with open(os.path.join(path, 'gaussian_process.json'), 'w') as fh:
+        json.dump(meta, fh)
+
+
+def load_gp(path, mmap_mode='r'):
+    '''
+    Load a GaussianProcess stored by save_gp. With mmap_mode='r' the arrays
+    are memory mapped read only, processes loading the same snapshot share
+    the pages.
+    '''
+    with open(os.path.join(path, 'gaussian_process.json')) as fh:
+        meta = json.load(fh)
+    y_ndim = meta.pop('y_ndim_')
+    gp = sklearn.gaussian_process.GaussianProcess(**meta)
+    gp._check_params()
+    for name, value in _load_arrays(path, _GP_ARRAYS, mmap_mode).items():
+        setattr(gp, name, value)
+    gp.y_ndim_ = y_ndim
+    return gp
+
+
+def extend_gp(gp, X, y):
+    '''
+    Add the samples X to a fitted GaussianProcess without refactorizing.
+
+    theta and the normalization of X are kept. The Cholesky factor of the
+    correlation matrix is extended by the rows of the new samples (rank-k
+    update, O(n^2 k)). `y` are the targets of all samples, old and new, and
+    everything depending on them is recomputed by triangular solves against
+    the extended factor. The factor is kept even for storage_mode='light'.
+    '''
+    if np.ndim(gp.nugget) > 0:
+        raise ValueError('extend_gp only supports a scalar nugget')
+    C = gp.C
+    if C is None:
+        _, par = gp.reduced_likelihood_function()
+        C = par['C']
+    X = (np.atleast_2d(X) - gp.X_mean) / gp.X_std
+    n_old, n_new = gp.X.shape[0], X.shape[0]
+
+    R12 = gp.corr(gp.theta_, manhattan_distances(
+        gp.X, X, sum_over_features=False)).reshape(n_old, n_new)
+    R22 = gp.corr(gp.theta_, manhattan_distances(
+        X, X, sum_over_features=False)).reshape(n_new, n_new)
+    R22[np.diag_indices(n_new)] = 1. + gp.nugget
+    L21 = linalg.solve_triangular(C, R12, lower=True).T
+    L22 = linalg.cholesky(R22 - np.dot(L21, L21.T), lower=True)
+    C = np.vstack((
+        np.hstack((C, np.zeros((n_old, n_new)))),
+        np.hstack((L21, L22))))
+
+    y = np.asarray(y, dtype=np.float64)
+    gp.y_ndim_ = y.ndim
+    if y.ndim == 1:
+        y = y[:, np.newaxis]
+    if gp.normalize:
+        gp.y_mean = np.mean(y, axis=0)
+        gp.y_std = np.std(y, axis=0)
+        gp.y_std[gp.y_std == 0.] = 1.
+    gp.X = np.vstack((gp.X, X))
+    gp.y = (y - gp.y_mean) / gp.y_std
+    n_samples = gp.X.shape[0]
+
+    # Same as GaussianProcess.reduced_likelihood_function for fixed C
+    F = gp.regr(gp.X)
+    Ft = linalg.solve_triangular(C, F, lower=True)
+    Q, G = linalg.qr(Ft, mode='economic')
+    Yt = linalg.solve_triangular(C, gp.y, lower=True)
+    if gp.beta0 is None:
+        beta = linalg.solve_triangular(G, np.dot(Q.T, Yt))
+    else:
+        beta = np.array(gp.beta0)
+    rho = Yt - np.dot(Ft, beta)
+    gp.sigma2 = (rho ** 2.).sum(axis=0) / n_samples * gp.y_std ** 2.
+    gp.beta = beta
+    gp.gamma = linalg.solve_triangular(C.T, rho)
+    gp.C, gp.Ft, gp.G = C, Ft, G
+    # the pairwise distances are only used by fit, drop the stale ones
+    gp.D, gp.ij, gp.F = None, None, F
+    return gp
+
+
+class SparseGaussianProcess(ChunkedPredictor):
+    '''
+    Gaussian process in the deterministic training conditional (DTC)
+    approximation with m inducing points.
+
+    The inducing points are a random subset of the training set. theta and
+    the process variance are estimated by an exact GaussianProcess on the
+    inducing points alone; all samples then enter through the (m, n) cross
+    correlation. Training costs O(n m^2 + m^3), the prediction O(m) per
+    point for the mean and O(m^2) for the MSE. Only the squared exponential
+    correlation is supported.
+
+    Keyword arguments:
+    n_inducing -- number of inducing points m (default: 500)
+    nugget -- noise variance relative to the process variance (default: 1e-6)
+    random_state -- seed for the choice of inducing points (default: None)
+    memory_limit -- memory budget in bytes per chunk (default: 2**28)
+
+    All other arguments are passed on to the GaussianProcess on the
+    inducing points.
+    '''
+
+    def __init__(
+            self, n_inducing=500, nugget=1e-6, random_state=None,
+            memory_limit=2**28, **kwargs):
+        if kwargs.get('corr', 'squared_exponential') != 'squared_exponential':
+            raise ValueError(
+                    'SparseGaussianProcess only supports squared_exponential')
+        self.n_inducing = n_inducing
+        self.nugget = nugget
+        self.random_state = random_state
+        self.memory_limit = memory_limit
+        self._exact = sklearn.gaussian_process.GaussianProcess(**kwargs)
+
+    def fit(self, X, y):
+        X = np.atleast_2d(X)
+        y = np.asarray(y, dtype=np.float64)
+        n_samples = X.shape[0]
+        if n_samples > self.n_inducing:
+            state = np.random.RandomState(self.random_state)
+            index = np.sort(state.choice(
+                n_samples, self.n_inducing, replace=False))
+        else:
+            index = np.arange(n_samples)
+        self._exact.fit(X[index], y[index])
+        self.X_inducing = X[index]
+        self._fit(X, y)
+        return self
+
+    def extend(self, X, y):
+        '''
+        Add samples with fixed theta and inducing points. `y` are the
+        targets of all samples, old and new.
+        '''
+        self._fit(np.vstack((self.X, np.atleast_2d(X))), y)
+
+    def _fit(self, X, y):
+        self.X = X
+        self._y_ndim = y.ndim
+        if y.ndim == 1:
+            y = y[:, np.newaxis]
+        self._n_targets = y.shape[1]
+        # theta refers to the normalization of the exact GP
+        self.X_mean = self._exact.X_mean
+        self.X_std = self._exact.X_std
+        self.y_mean = np.mean(y, axis=0)
+        self.y_std = np.std(y, axis=0)
+        self.y_std[self.y_std == 0.] = 1.
+        self.theta_ = self._exact.theta_
+        self.sigma2 = self._exact.sigma2
+        self._scale = _scale(self.theta_, X.shape[1])
+        self.Xs_inducing = np.ascontiguousarray(
+                ((self.X_inducing - self.X_mean) / self.X_std *
+                    self._scale).T)
+
+        m = self.X_inducing.shape[0]
+        jitter = 1e-10 * np.eye(m)
+        K_mm = _squared_exponential(self.Xs_inducing.T, self.Xs_inducing)
+        # A = nugget K_mm + K_mn K_nm and b = K_mn y, accumulated chunk wise
+        A = self.nugget * K_mm
+        b = np.zeros((m, self._n_targets))
+        batch_size = max(1, int(self.memory_limit // (8 * 2 * m)))
+        for start in range(0, X.shape[0], batch_size):
+            chunk = slice(start, start + batch_size)
+            K_nm = self._correlation(X[chunk])
+            A += np.dot(K_nm.T, K_nm)
+            b += np.dot(K_nm.T, (y[chunk] - self.y_mean) / self.y_std)
+        self.L_mm = linalg.cholesky(K_mm + jitter, lower=True)
+        self.L_A = linalg.cholesky(A + jitter, lower=True)
+        self.weights = linalg.cho_solve((self.L_A, True), b)
+
+    def _correlation(self, X):
+        return _squared_exponential(
+                (X - self.X_mean) / self.X_std * self._scale,
+                self.Xs_inducing)
+
+    def chunk_size(self, n_columns=0):
+        per_point = 3 * self.X_inducing.shape[0] + 2 * self._n_targets
+        return max(1, int(self.memory_limit // (8 * (per_point + n_columns))))
+
+    def _predict_chunk(self, X, eval_MSE):
+        K = self._correlation(X)
+        y = self.y_mean + self.y_std * np.dot(K, self.weights)
+        if not eval_MSE:
+            return y
+        q = linalg.solve_triangular(
+                self.L_mm, K.T, lower=True, check_finite=False)
+        a = linalg.solve_triangular(
+                self.L_A, K.T, lower=True, check_finite=False)
+        mse = (
+                1. - np.sum(q ** 2, axis=0) +
+                self.nugget * np.sum(a ** 2, axis=0))
+        sigma = np.sqrt(np.sum(self.sigma2 ** 2) / self._n_targets)
+        return y, sigma * np.abs(mse)
+
+    def save(self, path):
+        save_gp(self._exact, os.path.join(path, 'inducing'))
+        _save_arrays(path, {
+            'X': self.X,
+            'X_inducing': self.X_inducing,
+            'y_mean': self.y_mean,
+            'y_std': self.y_std,
+            'L_mm': self.L_mm,
+            'L_A': self.L_A,
+            'weights': self.weights,
+            })
+        meta = {
+                'n_inducing': self.n_inducing,
+                'nugget': self.nugget,
+                'random_state': self.random_state,
+                'memory_limit': self.memory_limit,
+                'y_ndim': self._y_ndim,
+                }
+        with open(os.path.join(path, 'sparse.json'), 'w') as fh:
+            json.dump(meta, fh)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        with open(os.path.join(path, 'sparse.json')) as fh:
+            meta = json.load(fh)
+        self = cls.__new__(cls)
+        self.n_inducing = meta['n_inducing']
+        self.nugget = meta['nugget']
+        self.random_state = meta['random_state']
+        self.memory_limit = meta['memory_limit']
+        self._y_ndim = meta['y_ndim']
+        self._exact = load_gp(os.path.join(path, 'inducing'), mmap_mode)
+        for name, value in _load_arrays(path, [
+                'X', 'X_inducing', 'y_mean', 'y_std', 'L_mm', 'L_A',
+                'weights'], mmap_mode).items():
+            setattr(self, name, value)
+        self._n_targets = self.weights.shape[1]
+        self.X_mean = self._exact.X_mean
+        self.X_std = self._exact.X_std
+        self.theta_ = self._exact.theta_
+        self.sigma2 = self._exact.sigma2
+        self._scale = _scale(self.theta_, self.X.shape[1])
+        self.Xs_inducing = np.ascontiguousarray(
+                ((self.X_inducing - self.X_mean) / self.X_std *
+                    self._scale).T)
+        return self
 
 
 class Emulator(object):
+    memory_limit = 2**28
+    gp = 'exact'
 
-    def __init__(self, X, Y, n_components):
+    def __init__(
+            self, X, Y, n_components, memory_limit=None, gp='exact',
+            n_inducing=500):
+        '''
+        gp -- 'exact' or 'sparse' (default: 'exact'). 'sparse' uses a
+                    SparseGaussianProcess with `n_inducing` inducing points,
+                    for training sets too large for the exact GP.
+        '''
         # Use GaussianProcessRegressor later
+        if memory_limit is not None:
+            self.memory_limit = memory_limit
+        if gp not in ('exact', 'sparse'):
+            raise ValueError(
+                    "gp has to be 'exact' or 'sparse', got: {}".format(gp))
+        self.gp = gp
         self._ncomp = n_components
         self._PCA = sklearn.decomposition.PCA(n_components=n_components)
-        self._GP = sklearn.gaussian_process.GaussianProcess(
-                theta0=1e-2,
-                thetaL=1e-4,
-                thetaU=1e-1,
-                )
+        gp_kwargs = dict(theta0=1e-2, thetaL=1e-4, thetaU=1e-1)
+        if gp == 'sparse':
+            self._GP = SparseGaussianProcess(
+                    n_inducing=n_inducing,
+                    memory_limit=self.memory_limit,
+                    **gp_kwargs)
+        else:
+            self._GP = sklearn.gaussian_process.GaussianProcess(**gp_kwargs)
         self.train(X, Y)
 
     def train(self, X, Y):
         self._X = X
         self._Y = Y
-        comp = self._PCA.fit_transform(Y)
-        self._GP.fit(X, comp)
+        self._fit()
+
+    def _fit(self):
+        self._predictor = None
+        self._n_added = 0
+        self._pca_var = np.var(self._Y, axis=0)
+        comp = self._PCA.fit_transform(self._Y)
+        self._GP.fit(self._X, comp)
 
-    def predict(self, X):
+    def update(self, X, Y, reoptimize_every=None):
+        '''
+        Add new training samples without training from scratch.
+
+        The PCA basis is updated incrementally (as IncrementalPCA does) and
+        the Cholesky factor of the GP is extended by the new samples, theta
+        stays fixed. If `reoptimize_every` is given, the emulator is fully
+        retrained (including the search for theta) once that many samples
+        were added since the last full training.
+        '''
+        X = np.atleast_2d(X)
+        Y = np.atleast_2d(Y)
+        self._X = np.vstack((self._X, X))
+        self._Y = np.vstack((self._Y, Y))
+        self._n_added += X.shape[0]
+        self._predictor = None
+        if reoptimize_every is not None and self._n_added >= reoptimize_every:
+            self._fit()
+            return
+        self._partial_fit_pca(Y)
+        self._extend_gp(X, self._PCA.transform(self._Y))
+
+    def _partial_fit_pca(self, Y):
+        n_old = self._Y.shape[0] - Y.shape[0]
+        if self._pca_var is None:
+            self._pca_var = np.var(self._Y[:n_old], axis=0)
+        ipca = sklearn.decomposition.IncrementalPCA(
+                n_components=self._ncomp, whiten=self._PCA.whiten)
+        ipca.components_ = self._PCA.components_
+        ipca.singular_values_ = self._PCA.singular_values_
+        ipca.mean_ = self._PCA.mean_
+        ipca.var_ = self._pca_var
+        ipca.n_samples_seen_ = n_old
+        ipca.partial_fit(Y)
+        for name in _PCA_ARRAYS + ('explained_variance_ratio_',):
+            setattr(self._PCA, name, getattr(ipca, name))
+        self._pca_var = ipca.var_
+
+    def _extend_gp(self, X, comp):
+        if self.gp == 'sparse':
+            self._GP.extend(X, comp)
+        else:
+            extend_gp(self._GP, X, comp)
+
+    @property
+    def predictor(self):
+        '''
+        BatchPredictor for the current training set, built on first use.
+        '''
+        if self.gp == 'sparse':
+            return self._GP
+        if self._predictor is None:
+            self._predictor = BatchPredictor(self._GP, self.memory_limit)
+        return self._predictor
+
+    def predict(self, X, batch_size=None):
         X = np.atleast_2d(X)
         n_eval = X.shape[0]
-        y = np.zeros((n_eval, self._GP.y.shape[1]))
-        MSE = np.zeros(n_eval)
-        for k in range(n_eval / 1000 + 1):
-            batch_from = k * 1000
-            batch_to = min([(k + 1) * 1000 + 1, n_eval + 1])
-            y_, MSE_ = self._GP.predict(
-                    X[batch_from:batch_to],
-                    eval_MSE=True)
-            #print(batch_from, batch_to, y_.shape)
-
-            y[batch_from:batch_to] = y_
-            MSE[batch_from:batch_to] = MSE_
-        std = np.sqrt(MSE)
-        return self.comp_to_spectrum(y), std
+        n_wavelength = self._PCA.components_.shape[1]
+        spectra = np.empty((n_eval, n_wavelength))
+        std = np.empty(n_eval)
+        if batch_size is None:
+            batch_size = self.predictor.chunk_size(n_wavelength)
+        for chunk, (y, MSE) in self.predictor.iter_chunks(
+                X, eval_MSE=True, batch_size=batch_size):
+            spectra[chunk] = self.comp_to_spectrum(y)
+            std[chunk] = np.sqrt(MSE)
+        return spectra, std
 
     def quick_predict(self, X):
-        X = np.atleast_2d(X)
-        assert X.shape[0] == 1
-        return self.comp_to_spectrum(self._GP.predict(X))[0]
+        spectra = self.comp_to_spectrum(self.predictor.predict(X))
+        if len(spectra) == 1:
+            return spectra[0]
+        return spectra
+
+    def save(self, path):
+        '''
+        Write a snapshot of the trained emulator to the directory `path`.
+        Everything is stored as raw .npy arrays so it can be memory mapped
+        by `load`.
+        '''
+        arrays = {
+                'pca_' + name.rstrip('_'): getattr(self._PCA, name)
+                for name in _PCA_ARRAYS}
+        arrays.update(X=self._X, Y=self._Y)
+        _save_arrays(path, arrays)
+        self._save_gp(path)
+        meta = {
+                'class': self.__class__.__name__,
+                'n_components': self._ncomp,
+                'memory_limit': self.memory_limit,
+                'whiten': self._PCA.whiten,
+                }
+        if self.gp is not None:
+            meta['gp'] = self.gp
+        with open(os.path.join(path, 'emulator.json'), 'w') as fh:
+            json.dump(meta, fh)
+
+    def _save_gp(self, path):
+        if self.gp == 'sparse':
+            self._GP.save(os.path.join(path, 'gp'))
+        else:
+            save_gp(self._GP, os.path.join(path, 'gp'))
+
+    def _load_gp(self, path, mmap_mode):
+        if self.gp == 'sparse':
+            return SparseGaussianProcess.load(
+                    os.path.join(path, 'gp'), mmap_mode)
+        return load_gp(os.path.join(path, 'gp'), mmap_mode)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        '''
+        Load a snapshot written by `save` without retraining. Returns an
+        instance of the class that was saved.
+
+        With the default mmap_mode='r' all arrays are memory mapped read
+        only, so loading is almost free and all processes on a node using
+        the same snapshot share the pages. Use mmap_mode=None to read the
+        arrays into memory.
+        '''
+        with open(os.path.join(path, 'emulator.json')) as fh:
+            meta = json.load(fh)
+        emulator_cls = EMULATORS[meta['class']]
+        if not issubclass(emulator_cls, cls):
+            raise TypeError('{} is a snapshot of {}, not {}'.format(
+                path, meta['class'], cls.__name__))
+        self = emulator_cls.__new__(emulator_cls)
+        self.memory_limit = meta['memory_limit']
+        self._ncomp = meta['n_components']
+        self._PCA = sklearn.decomposition.PCA(
+                n_components=self._ncomp, whiten=meta['whiten'])
+        arrays = _load_arrays(
+                path,
+                ['pca_' + name.rstrip('_') for name in _PCA_ARRAYS] +
+                ['X', 'Y'],
+                mmap_mode)
+        for name in _PCA_ARRAYS:
+            setattr(self._PCA, name, arrays['pca_' + name.rstrip('_')])
+        self._PCA.n_components_ = self._ncomp
+        self._X = arrays['X']
+        self._Y = arrays['Y']
+        if emulator_cls.gp is not None:
+            self.gp = meta.get('gp', 'exact')
+        self._GP = self._load_gp(path, mmap_mode)
+        self._predictor = None
+        self._n_added = 0
+        self._pca_var = None
+        return self
+
+    def pca_basis(self):
+        '''
+        Matrix mapping PCA components onto the spectrum (without the mean).
+        '''
+        if self._PCA.whiten:
+            return (
+                    np.sqrt(self._PCA.explained_variance_)[:, np.newaxis] *
+                    self._PCA.components_)
+        return self._PCA.components_
 
     def pca_transform(self, Y):
         return self._PCA.inverse_transform(self._PCA.transform(Y))
@@ -57,39 +681,184 @@ class LogEmulator(Emulator):
     def train(self, X, Y):
         super(LogEmulator, self).train(X, np.log10(Y))
 
+    def update(self, X, Y, reoptimize_every=None):
+        super(LogEmulator, self).update(X, np.log10(Y), reoptimize_every)
+
     def comp_to_spectrum(self, Y):
         return 10 ** super(LogEmulator, self).comp_to_spectrum(Y)
 
 
+def _fit_gp(job):
+    gp, X, y = job
+    gp.fit(X, y)
+    return gp
+
+
 class DecoupledGaussianProcess(object):
+    '''
+    One independent GaussianProcess per target column.
+
+    Keyword arguments:
+    n_jobs -- number of workers used by fit and predict, -1 uses all CPUs
+                (default: 1)
+    backend -- 'process' or 'thread' (default: 'process'). The hyperparameter
+                search uses scipy's fmin_cobyla which is not thread safe, so
+                'thread' only works with a fixed theta0. predict always uses
+                threads.
+    memory_limit -- memory budget in bytes per chunk of predict
+                (default: 2**28)
+
+    All other arguments are passed on to every GaussianProcess.
+    '''
 
     def __init__(self, N, *args, **kwargs):
+        self.n_jobs = kwargs.pop('n_jobs', 1)
+        self.backend = kwargs.pop('backend', 'process')
+        self.memory_limit = kwargs.pop('memory_limit', 2**28)
+        if self.backend not in ('process', 'thread'):
+            raise ValueError(
+                    "backend has to be 'process' or 'thread', got: {}".format(
+                        self.backend))
+        if (self.backend == 'thread' and self.n_jobs != 1 and
+                kwargs.get('thetaL') is not None):
+            raise ValueError(
+                    "backend 'thread' can't optimize theta, "
+                    "use backend='process'")
         self.N = N
         self._GP = [
                 sklearn.gaussian_process.GaussianProcess(*args, **kwargs)
                 for _ in xrange(N)
                 ]
         self.y = None
+        self._predictors = None
+
+    @property
+    def n_workers(self):
+        n_jobs = self.n_jobs if self.n_jobs > 0 else cpu_count()
+        return min(n_jobs, self.N)
+
+    def _pool(self, backend=None):
+        backend = backend or self.backend
+        if backend == 'thread':
+            return ThreadPool(self.n_workers)
+        return Pool(self.n_workers)
 
     def fit(self, X, y):
         assert y.shape[1] == self.N
         self.y = y
+        self._predictors = None
+        jobs = [(self._GP[i], X, y[:, i]) for i in xrange(self.N)]
+        if self.n_jobs == 1:
+            self._GP = [_fit_gp(job) for job in jobs]
+            return
+        pool = self._pool()
+        try:
+            # chunksize=1: every component is scheduled on its own so the
+            # total time is bound by the slowest fit
+            self._GP = pool.map(_fit_gp, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    @property
+    def predictors(self):
+        '''
+        One BatchPredictor per component, built on first use.
+        '''
+        if self._predictors is None:
+            self._predictors = [
+                    BatchPredictor(gp, self.memory_limit) for gp in self._GP]
+        return self._predictors
+
+    def chunk_size(self, n_columns=0):
+        # all workers hold the temporaries of one component at the same time
+        return max(1, min(
+            p.chunk_size(n_columns) for p in self.predictors) //
+            self.n_workers)
+
+    def iter_chunks(self, X, eval_MSE=False, batch_size=None):
+        '''
+        Yields (slice, prediction) for consecutive chunks of X. The
+        components of one chunk are evaluated concurrently on n_jobs threads.
+        '''
+        X = np.atleast_2d(X)
+        predictors = self.predictors
+        if batch_size is None:
+            batch_size = self.chunk_size()
+        pool = self._pool('thread') if self.n_workers > 1 else None
+        try:
+            for start in range(0, X.shape[0], batch_size):
+                chunk = slice(start, min(start + batch_size, X.shape[0]))
+
+                def component(p):
+                    return p._predict_chunk(X[chunk], eval_MSE)
+
+                if pool is None:
+                    results = [component(p) for p in predictors]
+                else:
+                    results = pool.map(component, predictors)
+                if eval_MSE:
+                    yield chunk, (
+                            np.hstack([y for y, _ in results]),
+                            np.column_stack([MSE for _, MSE in results]))
+                else:
+                    yield chunk, np.hstack(results)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def extend(self, X, y):
+        '''
+        Add samples to every component, see extend_gp.
+        '''
+        assert y.shape[1] == self.N
+        self.y = y
+        self._predictors = None
         for i in xrange(self.N):
-            self._GP[i].fit(X, y[:, i])
+            extend_gp(self._GP[i], X, y[:, i])
+
+    def save(self, path):
+        _save_arrays(path, {'y': self.y})
+        for i, gp in enumerate(self._GP):
+            save_gp(gp, os.path.join(path, 'gp_{}'.format(i)))
+        meta = {
+                'N': self.N,
+                'n_jobs': self.n_jobs,
+                'backend': self.backend,
+                'memory_limit': self.memory_limit,
+                }
+        with open(os.path.join(path, 'decoupled.json'), 'w') as fh:
+            json.dump(meta, fh)
 
-    def predict(self, X, eval_MSE=False):
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        with open(os.path.join(path, 'decoupled.json')) as fh:
+            meta = json.load(fh)
+        self = cls.__new__(cls)
+        self.N = meta['N']
+        self.n_jobs = meta['n_jobs']
+        self.backend = meta['backend']
+        self.memory_limit = meta['memory_limit']
+        self._GP = [
+                load_gp(os.path.join(path, 'gp_{}'.format(i)), mmap_mode)
+                for i in xrange(self.N)]
+        self.y = _load_arrays(path, ['y'], mmap_mode)['y']
+        self._predictors = None
+        return self
+
+    def predict(self, X, eval_MSE=False, batch_size=None):
         X = np.atleast_2d(X)
-        y = np.zeros((X.shape[0], self.N))
+        y = np.empty((X.shape[0], self.N))
+        MSE = np.empty((X.shape[0], self.N))
+        for chunk, result in self.iter_chunks(X, eval_MSE, batch_size):
+            if eval_MSE:
+                y[chunk], MSE[chunk] = result
+            else:
+                y[chunk] = result
         if eval_MSE:
-            MSE = np.zeros((X.shape[0], self.N))
-            for i in xrange(self.N):
-                y[:, i], MSE[:, i] = self._GP[i].predict(X, eval_MSE=eval_MSE)
             return y, MSE
-        else:
-            for i in xrange(self.N):
-                y[:, i] = self._GP[i].predict(X)
-            return y
-
+        return y
 
     # def __getattr__(self, name):
     #     try:
@@ -104,9 +873,25 @@ class DecoupledGaussianProcess(object):
 
 
 class DecoupledEmulator(Emulator):
+    '''
+    Emulator with an independent GaussianProcess (and theta) per PCA
+    component, see DecoupledGaussianProcess. Unlike Emulator, predict
+    returns the uncertainty per wavelength, propagated from the MSE of
+    every component.
+
+    Every component has its own correlation, so a prediction costs about
+    n_components times that of Emulator on one core; n_jobs evaluates the
+    components in parallel.
+    '''
+    # the GaussianProcess of every component is exact
+    gp = None
 
-    def __init__(self, X, Y, n_components):
+    def __init__(
+            self, X, Y, n_components, memory_limit=None, n_jobs=1,
+            backend='process'):
         # Use GaussianProcessRegressor later
+        if memory_limit is not None:
+            self.memory_limit = memory_limit
         self._ncomp = n_components
         self._PCA = sklearn.decomposition.PCA(n_components=n_components)
         self._GP = DecoupledGaussianProcess(
@@ -115,8 +900,46 @@ class DecoupledEmulator(Emulator):
                 thetaL=1e-4,
                 thetaU=1e-1,
                 storage_mode='light',
+                n_jobs=n_jobs,
+                backend=backend,
+                memory_limit=self.memory_limit,
                 )
         self.train(X, Y)
 
-    def predict(self, *args, **kwargs):
-        raise NotImplementedError
+    @property
+    def predictor(self):
+        return self._GP
+
+    def _extend_gp(self, X, comp):
+        self._GP.extend(X, comp)
+
+    def _save_gp(self, path):
+        self._GP.save(os.path.join(path, 'gp'))
+
+    def _load_gp(self, path, mmap_mode):
+        return DecoupledGaussianProcess.load(os.path.join(path, 'gp'), mmap_mode)
+
+    def predict(self, X, batch_size=None):
+        '''
+        Returns the spectra and their standard deviation per wavelength.
+        Both have the shape (n_points, n_wavelength).
+
+        The MSE of every component is propagated through the PCA inverse
+        transform, assuming independent components.
+        '''
+        X = np.atleast_2d(X)
+        n_eval = X.shape[0]
+        basis_sq = self.pca_basis() ** 2
+        n_wavelength = basis_sq.shape[1]
+        spectra = np.empty((n_eval, n_wavelength))
+        std = np.empty((n_eval, n_wavelength))
+        if batch_size is None:
+            batch_size = self._GP.chunk_size(2 * n_wavelength)
+        for chunk, (y, MSE) in self._GP.iter_chunks(
+                X, eval_MSE=True, batch_size=batch_size):
+            spectra[chunk] = self.comp_to_spectrum(y)
+            std[chunk] = np.sqrt(np.dot(MSE, basis_sq))
+        return spectra, std
+
+EMULATORS = {
+        cls.__name__: cls for cls in (Emulator, LogEmulator, DecoupledEmulator)}
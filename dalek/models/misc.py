@@ -5,6 +5,8 @@ from astropy.modeling import Model
 
 from astropy import units as u, constants as const
 
+from dalek.util import bin_center_to_edge
+
 def intensity_black_body_wavelength(wavelength, T):
     wavelength = u.Quantity(wavelength, u.angstrom)
     T = u.Quantity(T, u.K)
@@ -23,16 +25,14 @@ class SimpleTARDISUncertaintyModel(Model):
                  virtual_uncertainty_scaling=5.):
         self.observed_wavelength = observed_wavelength
         self.wavelength_bins = self._generate_bins(observed_wavelength)
+        self.wavelength_bin_widths = np.diff(self.wavelength_bins)
         self.mode = mode
         self.virtual_uncertainty_scaling = virtual_uncertainty_scaling
         super(SimpleTARDISUncertaintyModel, self).__init__()
 
     @staticmethod
     def _generate_bins(observed_wavelength):
-        hdiff = 0.5 * np.diff(observed_wavelength)
-        hdiff = np.hstack((-hdiff[0], hdiff, hdiff[-1]))
-        bins = np.hstack((observed_wavelength[0], observed_wavelength)) + hdiff
-        return bins
+        return bin_center_to_edge(observed_wavelength)
 
     def evaluate(self, packet_nu, packet_energy, virtual_nu, virtual_energy,
                  param_names, param_values):
@@ -40,7 +40,7 @@ class SimpleTARDISUncertaintyModel(Model):
         bin_counts = np.histogram(packet_lambda, bins=self.wavelength_bins)[0]
 
         uncertainty = (np.sqrt(bin_counts) * np.mean(packet_energy)
-                       / np.diff(self.wavelength_bins))
+                       / self.wavelength_bin_widths)
 
         if self.mode == 'normal':
             luminosity = np.histogram(packet_lambda,
@@ -53,7 +53,7 @@ class SimpleTARDISUncertaintyModel(Model):
                           bins=self.wavelength_bins)[0]
             uncertainty /= self.virtual_uncertainty_scaling
 
-        luminosity_density = luminosity / np.diff(self.wavelength_bins)
+        luminosity_density = luminosity / self.wavelength_bin_widths
 
         self.luminosity_density = luminosity_density
         self.uncertainty = uncertainty.value
@@ -0,0 +1,244 @@
+import os
+import json
+
+import pytest
+import numpy as np
+from sklearn.gaussian_process import GaussianProcess
+
+from dalek.emulator import (
+        Emulator, LogEmulator, BatchPredictor,
+        DecoupledGaussianProcess, DecoupledEmulator, SparseGaussianProcess,
+        extend_gp,
+        )
+
+
+@pytest.fixture(scope='module')
+def training_set():
+    state = np.random.RandomState(1234)
+    X = state.random_sample((60, 3))
+    wl = np.linspace(0, 1, 200)
+    Y = (
+            2 + X[:, [0]] * np.sin(4 * wl) +
+            X[:, [1]] * np.cos(3 * wl) +
+            X[:, [2]] * wl ** 2)
+    return X, Y
+
+
+@pytest.fixture(scope='module')
+def emulator(training_set):
+    return Emulator(training_set[0], training_set[1], 4)
+
+
+@pytest.fixture
+def points():
+    return np.random.RandomState(42).random_sample((2500, 3))
+
+
+def test_batch_predictor(emulator, points):
+    predictor = BatchPredictor(emulator._GP)
+    y, MSE = predictor.predict(points, eval_MSE=True, batch_size=333)
+    y_sk, MSE_sk = emulator._GP.predict(points, eval_MSE=True)
+    np.testing.assert_allclose(y, y_sk, rtol=1e-8, atol=1e-10)
+    np.testing.assert_allclose(MSE, MSE_sk, rtol=1e-6, atol=1e-12)
+    np.testing.assert_allclose(predictor.predict(points), y_sk, atol=1e-10)
+
+
+def test_chunk_size(emulator):
+    predictor = BatchPredictor(emulator._GP, memory_limit=8 * 1000)
+    assert predictor.chunk_size() >= 1
+    assert predictor.chunk_size(200) < predictor.chunk_size()
+
+
+@pytest.mark.parametrize('batch_size', [None, 1, 7, 10000])
+def test_predict(emulator, points, batch_size):
+    spectra, std = emulator.predict(points, batch_size=batch_size)
+    y, MSE = emulator._GP.predict(points, eval_MSE=True)
+    assert spectra.shape == (len(points), emulator._Y.shape[1])
+    assert std.shape == (len(points),)
+    np.testing.assert_allclose(
+            spectra, emulator.comp_to_spectrum(y), rtol=1e-8, atol=1e-10)
+    np.testing.assert_allclose(std, np.sqrt(MSE), rtol=1e-6, atol=1e-8)
+
+
+def test_quick_predict(emulator, points):
+    spectra, _ = emulator.predict(points[:5])
+    np.testing.assert_allclose(emulator.quick_predict(points[0]), spectra[0])
+    np.testing.assert_allclose(emulator.quick_predict(points[:5]), spectra)
+
+
+def test_log_emulator(training_set, points):
+    emulator = LogEmulator(training_set[0], training_set[1], 4)
+    spectra, _ = emulator.predict(points[:10])
+    assert np.all(spectra > 0)
+
+
+@pytest.mark.parametrize(['backend', 'theta'], [
+    ('process', dict(theta0=1e-2, thetaL=1e-4, thetaU=1e-1)),
+    ('thread', dict(theta0=1e-2)),
+    ])
+def test_decoupled_parallel_fit(training_set, backend, theta):
+    X, Y = training_set
+    comp = Y[:, :4]
+    serial = DecoupledGaussianProcess(4, **theta)
+    serial.fit(X, comp)
+    parallel = DecoupledGaussianProcess(
+            4, n_jobs=2, backend=backend, **theta)
+    parallel.fit(X, comp)
+    assert len(parallel._GP) == 4
+    np.testing.assert_allclose(parallel.predict(X[:5]), serial.predict(X[:5]))
+
+
+def test_decoupled_backend():
+    with pytest.raises(ValueError):
+        DecoupledGaussianProcess(4, backend='mpi')
+    with pytest.raises(ValueError):
+        DecoupledGaussianProcess(
+                4, theta0=1e-2, thetaL=1e-4, thetaU=1e-1,
+                n_jobs=2, backend='thread')
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_decoupled_predict(training_set, points, n_jobs):
+    X, Y = training_set
+    # theta ends up at thetaL, the correlation matrix is badly conditioned
+    # and the MSE only agrees to a few digits
+    points = 4 * points - 1.5
+    emulator = DecoupledEmulator(X, Y, 3, n_jobs=n_jobs)
+    spectra, std = emulator.predict(points, batch_size=1000)
+    assert spectra.shape == (len(points), Y.shape[1])
+    assert std.shape == spectra.shape
+
+    y = np.column_stack([gp.predict(points) for gp in emulator._GP._GP])
+    MSE = np.column_stack([
+        gp.predict(points, eval_MSE=True)[1] for gp in emulator._GP._GP])
+    np.testing.assert_allclose(
+            spectra, emulator.comp_to_spectrum(y), rtol=1e-6, atol=1e-8)
+    np.testing.assert_allclose(
+            std, np.sqrt(np.dot(MSE, emulator._PCA.components_ ** 2)),
+            rtol=1e-3, atol=1e-3 * std.max())
+    np.testing.assert_allclose(
+            emulator.quick_predict(points[0]), spectra[0])
+
+
+@pytest.mark.parametrize('emulator_cls', [
+    Emulator, LogEmulator, DecoupledEmulator])
+def test_snapshot(training_set, points, tmpdir, emulator_cls):
+    X, Y = training_set
+    emulator = emulator_cls(X, Y, 3)
+    path = str(tmpdir.join('snapshot'))
+    emulator.save(path)
+
+    loaded = Emulator.load(path)
+    assert type(loaded) is emulator_cls
+    assert isinstance(loaded._Y, np.memmap)
+    for expected, obtained in zip(
+            emulator.predict(points[:50]), loaded.predict(points[:50])):
+        np.testing.assert_allclose(obtained, expected)
+    np.testing.assert_allclose(
+            loaded.pca_transform(Y[:5]), emulator.pca_transform(Y[:5]))
+
+    in_memory = emulator_cls.load(path, mmap_mode=None)
+    assert not isinstance(in_memory._Y, np.memmap)
+    with open(os.path.join(path, 'emulator.json')) as fh:
+        meta = json.load(fh)
+    assert ('gp' in meta) == (emulator_cls is not DecoupledEmulator)
+    if emulator_cls is not DecoupledEmulator:
+        with pytest.raises(TypeError):
+            DecoupledEmulator.load(path)
+
+
+@pytest.mark.parametrize('emulator_cls', [
+    Emulator, LogEmulator, DecoupledEmulator])
+def test_update(training_set, points, emulator_cls):
+    X, Y = training_set
+    incremental = emulator_cls(X[:40], Y[:40], 3)
+    theta = np.copy(incremental._GP.theta_) if emulator_cls is Emulator else None
+    incremental.update(X[40:50], Y[40:50])
+    incremental.update(X[50:], Y[50:])
+    assert incremental._X.shape[0] == incremental._Y.shape[0] == len(X)
+    if theta is not None:
+        np.testing.assert_array_equal(incremental._GP.theta_, theta)
+
+    # the extended factorization has to reproduce the training data up to
+    # the truncation of the PCA (log(Y) isn't exactly of rank 3)
+    spectra, _ = incremental.predict(X)
+    np.testing.assert_allclose(spectra, Y, rtol=5e-2)
+
+    full = emulator_cls(X, Y, 3)
+    np.testing.assert_allclose(
+            incremental.predict(points[:20])[0],
+            full.predict(points[:20])[0], rtol=5e-2)
+
+
+def test_extend_gp(training_set):
+    X, Y = training_set
+    comp = Y[:, [0, 50, 100]]
+    # X normalization is kept by extend_gp, so compare without it
+    reference = GaussianProcess(theta0=0.5, normalize=False)
+    reference.fit(X, comp)
+    partial = GaussianProcess(theta0=0.5, normalize=False)
+    partial.fit(X[:45], comp[:45])
+    extend_gp(partial, X[45:], comp)
+    np.testing.assert_allclose(partial.C, reference.C, atol=1e-10)
+    for name in ['beta', 'gamma', 'sigma2', 'Ft', 'G']:
+        np.testing.assert_allclose(
+                getattr(partial, name), getattr(reference, name),
+                rtol=1e-4, atol=1e-8)
+    np.testing.assert_allclose(
+            partial.predict(X[:5]), reference.predict(X[:5]))
+
+
+def test_reoptimize(training_set):
+    X, Y = training_set
+    emulator = Emulator(X[:40], Y[:40], 3)
+    emulator.update(X[40:45], Y[40:45], reoptimize_every=10)
+    assert emulator._n_added == 5
+    emulator.update(X[45:50], Y[45:50], reoptimize_every=10)
+    assert emulator._n_added == 0
+    assert emulator._GP.X.shape[0] == 50
+
+
+def test_sparse_gp(training_set, points):
+    X, Y = training_set
+    comp = Y[:, [0, 50, 100]]
+    exact = GaussianProcess(theta0=0.5)
+    exact.fit(X, comp)
+    # with every sample an inducing point DTC interpolates like the exact
+    # GP, away from the samples they differ by the estimated constant mean
+    sparse = SparseGaussianProcess(n_inducing=60, theta0=0.5, nugget=1e-10)
+    sparse.fit(X, comp)
+    np.testing.assert_allclose(sparse.predict(X), comp, atol=1e-4)
+    np.testing.assert_allclose(
+            sparse.predict(points[:50]), exact.predict(points[:50]),
+            atol=2e-2)
+
+    exact = GaussianProcess(theta0=0.05)
+    exact.fit(X, comp)
+    sparse = SparseGaussianProcess(
+            n_inducing=30, theta0=0.05, random_state=0, memory_limit=8 * 1000)
+    sparse.fit(X, comp)
+    y, MSE = sparse.predict(points, eval_MSE=True, batch_size=333)
+    assert y.shape == (len(points), 3)
+    assert MSE.shape == (len(points),)
+    np.testing.assert_allclose(y, exact.predict(points), atol=5e-2)
+
+    with pytest.raises(ValueError):
+        SparseGaussianProcess(corr='absolute_exponential')
+
+
+def test_sparse_emulator(training_set, points, tmpdir):
+    X, Y = training_set
+    emulator = Emulator(X[:50], Y[:50], 3, gp='sparse', n_inducing=20)
+    assert emulator.predictor is emulator._GP
+    emulator.update(X[50:], Y[50:])
+    assert emulator._GP.X.shape[0] == 60
+    spectra, std = emulator.predict(points[:100])
+    assert std.shape == (100,)
+
+    emulator.save(str(tmpdir))
+    loaded = Emulator.load(str(tmpdir))
+    assert loaded.gp == 'sparse'
+    np.testing.assert_array_equal(loaded.predict(points[:100])[0], spectra)
+
+    with pytest.raises(ValueError):
+        Emulator(X, Y, 3, gp='dense')
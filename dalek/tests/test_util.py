@@ -0,0 +1,102 @@
+import pytest
+import numpy as np
+from scipy import sparse
+from astropy import units as u
+
+from dalek.util import ReSamplingMatrixNonUniform, Rebinner, resample
+
+
+def edges(l):
+    low = np.zeros(len(l))
+    low[1:] = (l[1:] + l[:-1]) / 2
+    low[0] = l[0] - (l[1] - l[0]) / 2
+    upp = np.zeros(len(l))
+    upp[:-1] = low[1:]
+    upp[-1] = l[-1] + (l[-1] - l[-2]) / 2
+    return low, upp
+
+
+def reference(lorig, lresam, extrap=False):
+    '''
+    The original O(N*M) loop of ReSamplingMatrixNonUniform.
+    '''
+    matrix = np.zeros((len(lresam), len(lorig)))
+    lo_low, lo_upp = edges(lorig)
+    lr_low, lr_upp = edges(lresam)
+    for i_r in range(len(lresam)):
+        bins = np.where((lr_low[i_r] < lo_upp) & (lr_upp[i_r] > lo_low))[0]
+        for i_o in bins:
+            d_lr = lr_upp[i_r] - lr_low[i_r]
+            if (lr_low[i_r] > lo_low[i_o]) & (lr_upp[i_r] < lo_upp[i_o]):
+                matrix[i_r, i_o] += 1.
+            if (lr_low[i_r] < lo_low[i_o]) & (lr_upp[i_r] > lo_upp[i_o]):
+                matrix[i_r, i_o] += (lo_upp[i_o] - lo_low[i_o]) / d_lr
+            if (lr_low[i_r] > lo_low[i_o]) & (lr_upp[i_r] > lo_upp[i_o]):
+                matrix[i_r, i_o] += (lo_upp[i_o] - lr_low[i_r]) / d_lr
+            if (lr_low[i_r] < lo_low[i_o]) & (lr_upp[i_r] < lo_upp[i_o]):
+                matrix[i_r, i_o] += (lr_upp[i_r] - lo_low[i_o]) / d_lr
+    if extrap:
+        bins_l = np.where(lr_low < lo_low[0])[0]
+        bins_r = np.where(lr_upp > lo_upp[-1])[0]
+        if len(bins_l) > 0 and len(bins_r) > 0:
+            matrix[bins_l, np.where(lo_low >= lr_low[bins_l[0]])[0][0]] = 1.
+            matrix[bins_r, np.where(lo_upp <= lr_upp[bins_r[0]])[0][-1]] = 1.
+    return matrix
+
+
+state = np.random.RandomState(0)
+GRIDS = [
+        (np.linspace(3400, 8900, 900) * 1.001, np.linspace(3400, 8900, 500)),
+        (np.linspace(3400, 8900, 500), np.linspace(3400, 8900, 900) * 1.001),
+        # coinciding bin edges
+        (np.linspace(3000, 9000, 601), np.linspace(3000, 9000, 301)),
+        (np.sort(state.uniform(3000, 9000, 300)),
+            np.sort(state.uniform(2500, 9500, 700))),
+        ]
+
+
+@pytest.mark.parametrize('extrap', [False, True])
+@pytest.mark.parametrize('lorig,lresam', GRIDS)
+def test_resampling_matrix(lorig, lresam, extrap):
+    expected = reference(lorig, lresam, extrap)
+    matrix = ReSamplingMatrixNonUniform(lorig, lresam, extrap)
+    assert sparse.isspmatrix_csr(matrix)
+    np.testing.assert_array_equal(matrix.toarray(), expected)
+    np.testing.assert_array_equal(
+            ReSamplingMatrixNonUniform(lorig, lresam, extrap, dense=True),
+            expected)
+
+
+def test_resample():
+    lorig, lresam = GRIDS[0]
+    flux = state.random_sample((5, len(lorig)))
+    expected = np.dot(reference(lorig, lresam), flux.T).T
+    np.testing.assert_allclose(resample(lorig, lresam, flux), expected)
+    np.testing.assert_allclose(resample(lorig, lresam, flux[0]), expected[0])
+
+
+def test_rebinner_cache():
+    Rebinner.clear_cache()
+    lorig, lresam = GRIDS[0]
+    rebinner = Rebinner.get(lorig, lresam)
+    assert Rebinner.get(lorig.copy(), lresam) is rebinner
+    assert Rebinner.get(lorig, lresam, extrap=True) is not rebinner
+    assert Rebinner.get(lorig * u.angstrom, lresam) is not rebinner
+
+    for shift in range(Rebinner.cache_size):
+        Rebinner.get(lorig, lresam + shift + 1)
+    assert len(Rebinner._cache) == Rebinner.cache_size
+    assert Rebinner.get(*GRIDS[0]) is not rebinner
+
+
+def test_rebinner():
+    lorig, lresam = GRIDS[1]
+    rebinner = Rebinner.get(lorig * u.angstrom, lresam * u.angstrom)
+    np.testing.assert_array_equal(rebinner.source, lorig)
+    np.testing.assert_allclose(rebinner.target_widths.sum(), lresam.ptp() +
+            (lresam[1] - lresam[0] + lresam[-1] - lresam[-2]) / 2)
+    flux = state.random_sample((3, len(lorig))) * u.erg
+    rebinned = rebinner(flux)
+    assert rebinned.unit == u.erg
+    np.testing.assert_allclose(
+            rebinned.value, np.dot(reference(lorig, lresam), flux.value.T).T)
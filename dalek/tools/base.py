@@ -1,11 +1,25 @@
 from __future__ import print_function
 import sys
+import atexit
+import weakref
+
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
 
 def warning(*objs):
     print("WARNING: ", *objs, file=sys.stderr)
 
 class BreakChainException(Exception):
-    pass
+    '''
+    In batch mode `items` can be a boolean mask of the items that break,
+    None means all of them.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.items = kwargs.pop('items', None)
+        super(BreakChainException, self).__init__(*args, **kwargs)
 
 class Chainable(object):
     '''
@@ -63,12 +77,123 @@ class Chainable(object):
     def _apply(self, args, kwargs):
         raise NotImplementedError('This has to be implemented by the subclass.')
 
+    def batch(self, *args, **kwargs):
+        '''
+        Evaluate a batch of items at once. Every input is a sequence with one
+        value per item, every output is a list with one value per item.
+        `batch_size` has to be given if there are no inputs.
+
+        Items breaking a Chain that isn't breakable raise a
+        BreakChainException with `items` set, after all other items were
+        evaluated.
+        '''
+        return self.full_batch(*args, **kwargs)[1]
+
+    def full_batch(self, *args, **kwargs):
+        n = kwargs.pop('batch_size', None)
+        args, kwargs = self._prepare_args(args, kwargs)
+        if n is None:
+            n = _batch_size(kwargs)
+        result, kwargs, broken = self._apply_batch(args, kwargs, n)
+        if broken is not None and broken.any():
+            raise BreakChainException(
+                    '{} of {} items broke the chain'.format(broken.sum(), n),
+                    items=broken)
+        return result, kwargs
+
+    def _apply_batch(self, args, kwargs, n):
+        '''
+        Fallback: evaluate item by item.
+
+        Returns:
+        (Tuple) (result, kwargs, broken) where broken is a boolean mask of
+        the items which raised a BreakChainException or None
+        '''
+        results = [None] * n
+        broken = np.zeros(n, dtype=bool)
+        output = dict((k, list(v)) for k, v in kwargs.items())
+        for i in range(n):
+            item = dict((k, v[i]) for k, v in kwargs.items())
+            try:
+                results[i], item = self.full([], **item)
+            except BreakChainException:
+                broken[i] = True
+                continue
+            for k, v in item.items():
+                output.setdefault(k, [None] * n)[i] = v
+        return results, output, broken
+
 
 class Link(Chainable):
+    '''
+    Subclasses implement calculate. For batch evaluation they can also
+    implement calculate_batch, which gets a sequence of values per input
+    and returns the outputs as for calculate, but with one value per item
+    along the first axis. Without calculate_batch, calculate is called for
+    every item. calculate_batch can raise a BreakChainException with
+    `items` set, it is then called again for the other items. Links
+    overriding _apply are evaluated item by item with full.
+    '''
+    calculate_batch = None
 
     def _apply(self, args, kwargs):
         return self._prepare_output(self.calculate(*args), **kwargs)
 
+    def _apply_batch(self, args, kwargs, n):
+        if self.calculate_batch is None and not _is_plain(self):
+            return super(Link, self)._apply_batch(args, kwargs, n)
+        if self.calculate_batch is None:
+            outputs, broken = self._calculate_items(args, n)
+        else:
+            outputs, broken = self._calculate_batch(args, n)
+        if len(self.outputs) == len(outputs):
+            kwargs.update(zip(self.outputs, outputs))
+        return outputs, kwargs, broken
+
+    def _calculate_items(self, args, n):
+        broken = np.zeros(n, dtype=bool)
+        results = []
+        for i, item in enumerate(zip(*args) if args else [()] * n):
+            try:
+                results.append(self.calculate(*item))
+            except BreakChainException:
+                broken[i] = True
+                results.append(None)
+        if len(self.outputs) == 1:
+            return [results], broken
+        if len(self.outputs) > 1:
+            return [
+                    [None if r is None else r[j] for r in results]
+                    for j in range(len(self.outputs))], broken
+        return [], broken
+
+    def _calculate_batch(self, args, n):
+        try:
+            return self._split(self.calculate_batch(*args), n), None
+        except BreakChainException as e:
+            if e.items is None:
+                raise
+            broken = np.asarray(e.items, dtype=bool)
+        keep = np.flatnonzero(~broken)
+        outputs = [[None] * n for _ in self.outputs]
+        if len(keep):
+            kept = self._split(self.calculate_batch(
+                *[[arg[i] for i in keep] for arg in args]), len(keep))
+            for output, values in zip(outputs, kept):
+                for i, value in zip(keep, values):
+                    output[i] = value
+        return outputs, broken
+
+    def _split(self, result, n):
+        '''
+        One list of n values per output.
+        '''
+        if len(self.outputs) == 1:
+            return [list(result)]
+        if len(self.outputs) > 1 and len(result) == len(self.outputs):
+            return [list(values) for values in result]
+        return []
+
     def _prepare_output(self, args, **kwargs):
         '''
         Possible inputs:
@@ -95,6 +220,7 @@ class Chain(Link):
     def __init__(self, *args, **kwargs):
         self.breakable = kwargs.pop('breakable', False)
         self._links = args
+        self._plan = None
         self.inputs = set()
         self.outputs = set()
         for arg in args:
@@ -103,6 +229,31 @@ class Chain(Link):
         self.outputs.update(self.inputs)
         super(Chain, self).__init__()
 
+    def compile(self):
+        '''
+        Resolve the wiring of all links (including nested Chains) once into
+        a fixed array of slots. Afterwards every call passes the values
+        positionally from slot to slot instead of building a new dict per
+        link. Returns the Chain itself.
+
+        Links overriding _apply (e.g. DynamicOutput) are still called with
+        a dict of the current values.
+        '''
+        self._names = sorted(self.outputs)
+        self._plan = _Plan(self, dict((n, i) for i, n in enumerate(self._names)))
+        return self
+
+    def full(self, *args, **kwargs):
+        if self._plan is None:
+            return super(Chain, self).full(*args, **kwargs)
+        _, kwargs = self._prepare_args(args, kwargs)
+        slots = [kwargs.pop(name, _UNSET) for name in self._names]
+        result = self._plan.run(slots, kwargs)
+        kwargs.update(
+                (name, value) for name, value in zip(self._names, slots)
+                if value is not _UNSET)
+        return result, kwargs
+
     def _apply(self, args, kwargs):
         for link in self._links:
             try:
@@ -115,12 +266,329 @@ class Chain(Link):
                     raise e
         return args, kwargs
 
+    def _apply_batch(self, args, kwargs, n):
+        active = np.ones(n, dtype=bool)
+        broken = np.zeros(n, dtype=bool)
+        result = None
+        for link in self._links:
+            index = np.flatnonzero(active)
+            if len(index) == 0:
+                break
+            if len(index) == n:
+                link_kwargs = dict(kwargs)
+            else:
+                link_kwargs = dict(
+                        (k, [v[i] for i in index]) for k, v in kwargs.items())
+            try:
+                link_args, link_kwargs = link._prepare_args([], link_kwargs)
+                result, link_kwargs, link_broken = link._apply_batch(
+                        link_args, link_kwargs, len(index))
+            except BreakChainException as e:
+                if e.items is not None:
+                    raise
+                # every item broke
+                link_kwargs = {}
+                link_broken = np.ones(len(index), dtype=bool)
+            for k, v in link_kwargs.items():
+                if len(index) == n:
+                    kwargs[k] = list(v)
+                else:
+                    values = kwargs.setdefault(k, [None] * n)
+                    for j, i in enumerate(index):
+                        values[i] = v[j]
+            if link_broken is not None and link_broken.any():
+                active[index[link_broken]] = False
+                broken[index[link_broken]] = True
+        if self.breakable:
+            # cleanup: the outputs missing for broken items are None
+            for name in self.outputs:
+                kwargs.setdefault(name, [None] * n)
+            return result, kwargs, None
+        return result, kwargs, broken
+
     def cleanup(self, **kwargs):
         output_dict = dict.fromkeys(self.outputs)
         output_dict.update(kwargs)
         return output_dict
 
 
+def _writes(link):
+    '''
+    Names a link sets. A Chain passes its inputs through, only the outputs
+    of its links count.
+    '''
+    if isinstance(link, Chain):
+        names = set()
+        for sub in link._links:
+            names.update(_writes(sub))
+        return names
+    return set(link.outputs)
+
+
+def _run_link(job):
+    link, kwargs = job
+    try:
+        return link.full([], **kwargs), False
+    except BreakChainException:
+        return None, True
+
+
+# worker pools of ParallelChains by a weak reference to their chain, a pool
+# is terminated when its chain is collected or at exit
+_pools = {}
+
+
+def _terminate_pool(ref):
+    pool = _pools.pop(ref, None)
+    if pool is not None:
+        pool.terminate()
+
+
+@atexit.register
+def _terminate_pools():
+    for ref in list(_pools):
+        _terminate_pool(ref)
+
+
+class ParallelChain(Chain):
+    '''
+    Chain which evaluates independent links concurrently.
+
+    A link depends on an earlier link if it reads a name the earlier one
+    sets, or if both set the same name, or if it sets a name the earlier
+    one reads. A link without outputs, e.g. CheckPrior, is only there to
+    break the chain, so all later links depend on it. Links are run in waves of links whose dependencies are
+    done, each wave on a pool of `n_jobs` workers. The outputs are merged
+    in the order of the links, so the result is the same as for Chain.
+
+    If a link breaks the chain, only the links before it are still run.
+    Outputs of links after it are discarded, even if they already ran, so
+    the result is again the same as for Chain (cleaned up if breakable,
+    otherwise the BreakChainException is raised).
+
+    Keyword arguments:
+    n_jobs -- number of workers, -1 uses all CPUs (default: -1)
+    backend -- 'thread' or 'process' (default: 'thread'). With 'process'
+                the links and values have to be picklable and changes to
+                the state of a link are lost.
+    breakable -- see Chain (default: False)
+
+    The pool is started on first use and shut down by close(), at the end
+    of a with block, when the chain is garbage collected or at exit.
+
+    compile() and batch() evaluate the links sequentially.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.n_jobs = kwargs.pop('n_jobs', -1)
+        self.backend = kwargs.pop('backend', 'thread')
+        if self.backend not in ('thread', 'process'):
+            raise ValueError(
+                    "backend has to be 'thread' or 'process', got: {}".format(
+                        self.backend))
+        super(ParallelChain, self).__init__(*args, **kwargs)
+        self._pool = None
+        self._ref = None
+        reads = [set(link.inputs) for link in self._links]
+        writes = [_writes(link) for link in self._links]
+        self._writes = writes
+        self._depends = [
+                set(i for i in range(j) if
+                    reads[j] & writes[i] or writes[j] & writes[i] or
+                    writes[j] & reads[i] or not writes[i])
+                for j in range(len(self._links))]
+        self._waves = []
+        done = set()
+        while len(done) < len(self._links):
+            wave = [j for j in range(len(self._links))
+                    if j not in done and self._depends[j] <= done]
+            self._waves.append(wave)
+            done.update(wave)
+
+    @property
+    def n_workers(self):
+        if self.n_jobs < 0:
+            return cpu_count()
+        return self.n_jobs
+
+    def _map(self, jobs):
+        if len(jobs) == 1 or self.n_workers == 1:
+            return [_run_link(job) for job in jobs]
+        if self._pool is None:
+            if self.backend == 'thread':
+                self._pool = ThreadPool(self.n_workers)
+            else:
+                self._pool = Pool(self.n_workers)
+            self._ref = weakref.ref(self, _terminate_pool)
+            _pools[self._ref] = self._pool
+        return self._pool.map(_run_link, jobs, chunksize=1)
+
+    def close(self):
+        '''
+        Shut down the worker pool.
+        '''
+        if self._pool is not None:
+            _pools.pop(self._ref, None)
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._ref = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_ref'] = None
+        return state
+
+    def _merge(self, kwargs, outputs, stop):
+        '''
+        kwargs updated with the outputs of the links before `stop` in the
+        order of the links.
+        '''
+        kwargs = dict(kwargs)
+        for j in sorted(outputs):
+            if j >= stop:
+                break
+            kwargs.update(
+                    (k, v) for k, v in outputs[j].items()
+                    if k in self._writes[j] or k not in kwargs)
+        return kwargs
+
+    def _apply(self, args, kwargs):
+        n_links = len(self._links)
+        outputs = {}
+        results = {}
+        broken = n_links
+        for wave in self._waves:
+            wave = [j for j in wave if j < broken]
+            if not wave:
+                continue
+            # a link never reads what a later link writes, so every link of
+            # the wave sees the same values as in a sequential Chain
+            current = self._merge(kwargs, outputs, n_links)
+            outcomes = self._map([(self._links[j], current) for j in wave])
+            for j, (result, link_broken) in zip(wave, outcomes):
+                if link_broken:
+                    broken = min(broken, j)
+                else:
+                    results[j], outputs[j] = result
+        # links after a breaking one don't count, even if they already ran
+        kwargs = self._merge(kwargs, outputs, broken)
+        if broken < n_links:
+            if not self.breakable:
+                raise BreakChainException(
+                        '{} broke the chain'.format(
+                            self._links[broken].__class__.__name__))
+            kwargs = self.cleanup(**kwargs)
+        done = [j for j in results if j < broken]
+        return (results[max(done)] if done else None), kwargs
+
+
+_UNSET = object()
+_LINK, _CHAIN, _GENERIC = range(3)
+
+
+def _batch_size(kwargs):
+    for value in kwargs.values():
+        return len(value)
+    raise ValueError('batch_size is required for Chainables without inputs')
+
+
+def _overrides(link, base, name):
+    method = getattr(type(link), name)
+    return (
+            getattr(method, '__func__', method) is not
+            getattr(getattr(base, name), '__func__', getattr(base, name)))
+
+
+def _is_plain(link):
+    '''
+    True if `link` is evaluated by Link._apply and Link._prepare_output.
+    '''
+    return (
+            isinstance(link, Link) and not isinstance(link, Chain) and
+            not _overrides(link, Link, '_apply') and
+            not _overrides(link, Link, '_prepare_output'))
+
+
+class _Plan(object):
+    '''
+    Execution plan of a compiled Chain, see Chain.compile.
+    '''
+
+    def __init__(self, chain, index):
+        self._index = index
+        self._names = sorted(index, key=index.get)
+        self.breakable = chain.breakable
+        self.outputs = [index[name] for name in chain.outputs]
+        self.steps = []
+        for link in chain._links:
+            if _is_plain(link):
+                self.steps.append((
+                    _LINK, link,
+                    tuple(index[name] for name in link.inputs),
+                    tuple(index[name] for name in link.outputs)))
+            elif (isinstance(link, Chain) and
+                    not _overrides(link, Chain, '_apply') and
+                    not _overrides(link, Chain, 'cleanup')):
+                self.steps.append((_CHAIN, _Plan(link, index), None, None))
+            else:
+                self.steps.append((_GENERIC, link, None, None))
+
+    def run(self, slots, extras):
+        result = None
+        for kind, target, inputs, outputs in self.steps:
+            try:
+                if kind is _LINK:
+                    args = []
+                    for i in inputs:
+                        value = slots[i]
+                        if value is _UNSET:
+                            raise KeyError(
+                                    "{} expected {} as input".format(
+                                        target.__class__.__name__,
+                                        target.inputs))
+                        args.append(value)
+                    result = target.calculate(*args)
+                    if len(outputs) == 1:
+                        slots[outputs[0]] = result
+                    elif len(outputs) > 1 and len(result) == len(outputs):
+                        for i, value in zip(outputs, result):
+                            slots[i] = value
+                elif kind is _CHAIN:
+                    result = target.run(slots, extras)
+                else:
+                    result = self._run_generic(target, slots, extras)
+            except BreakChainException:
+                if not self.breakable:
+                    raise
+                for i in self.outputs:
+                    if slots[i] is _UNSET:
+                        slots[i] = None
+                break
+        return result
+
+    def _run_generic(self, link, slots, extras):
+        kwargs = dict(extras)
+        kwargs.update(
+                (name, value) for name, value in zip(self._names, slots)
+                if value is not _UNSET)
+        result, kwargs = link.full([], **kwargs)
+        for name, value in kwargs.items():
+            i = self._index.get(name)
+            if i is None:
+                extras[name] = value
+            else:
+                slots[i] = value
+        return result
+
+
 class DynamicOutput(Chainable):
     '''
     This will return the value of `name`.
@@ -11,6 +11,7 @@ from dalek.tools.providers import (
         RunInfo
         )
 from dalek.tools.likelihood import SSum
+from dalek.tools.emulated import EmulatedFlux
 
 
 class SimpleTardis(Chain):
@@ -32,3 +33,37 @@ class SimpleTardis(Chain):
                     ),
                 Posterior(),
                 )
+
+
+class EmulatedTardis(Chain):
+    '''
+    SimpleTardis with the flux predicted by `emulator`. TARDIS only runs if
+    the emulator is too uncertain, see EmulatedFlux.
+    '''
+
+    def __init__(
+            self, wrapper, emulator, names, threshold, observed_wl,
+            observed_flux, distance=(1 * u.Mpc)):
+        # Make sure we are dealing with bin edges, not centers
+        assert len(observed_wl) == len(observed_flux) + 1
+        super(EmulatedTardis, self).__init__(
+                RunInfo(),
+                Prior(),
+                Chain(
+                    CheckPrior(),
+                    EmulatedFlux(
+                        emulator,
+                        Chain(
+                            Tardis(wrapper),
+                            VirtualPacketProvider(),
+                            VirtualLuminosity(observed_wl),
+                            Flux(distance),
+                            ),
+                        names,
+                        threshold,
+                        ),
+                    SSum(observed_wl, observed_flux),
+                    breakable=True
+                    ),
+                Posterior(),
+                )
@@ -0,0 +1,68 @@
+import numpy as np
+from astropy import units as u
+
+from dalek.tools.base import Link
+
+
+class EmulatedFlux(Link):
+    '''
+    Predicts the flux with a trained dalek.emulator.Emulator.
+
+    Only if the standard deviation predicted by the emulator exceeds
+    `threshold` the `fallback` is evaluated. `fallback` is a Chainable
+    computing 'flux' from 'parameters', usually
+    Chain(Tardis(wrapper), VirtualPacketProvider(), VirtualLuminosity(wl),
+    Flux()). Its flux is added to the training set of the emulator, so the
+    fallback is needed less and less often.
+
+    The other outputs of `fallback` (e.g. 'runtime') are outputs of
+    EmulatedFlux as well, they are None if the flux was emulated.
+
+    Keyword arguments:
+    names -- parameter names in the order of the emulator's input columns
+    threshold -- maximum of the std returned by emulator.predict up to which
+                the emulated flux is used
+    unit -- unit of the fluxes the emulator is trained on
+                (default: erg / (Angstrom cm2 s))
+    reoptimize_every -- passed on to Emulator.update (default: None)
+    '''
+    outputs = ('flux', 'emulated',)
+
+    def __init__(
+            self, emulator, fallback, names, threshold,
+            unit='erg / (Angstrom cm2 s)', reoptimize_every=None):
+        self._emulator = emulator
+        self._fallback = fallback
+        self._names = list(names)
+        self._threshold = threshold
+        self._unit = u.Unit(unit)
+        self._reoptimize_every = reoptimize_every
+        self.inputs = ('parameters',) + tuple(
+                i for i in fallback.inputs if i != 'parameters')
+        self._extra = tuple(sorted(
+                set(fallback.outputs) - set(fallback.inputs) -
+                set(self.outputs)))
+        self.outputs = self.outputs + self._extra
+        self.n_emulated = 0
+        self.n_fallback = 0
+
+    def _apply(self, args, kwargs):
+        x = np.array(
+                [[kwargs['parameters'][name] for name in self._names]],
+                dtype=np.float64)
+        spectra, std = self._emulator.predict(x)
+        if np.max(std) <= self._threshold:
+            self.n_emulated += 1
+            flux = spectra[0] * self._unit
+            return self._prepare_output(
+                    (flux, True) + (None,) * len(self._extra), **kwargs)
+
+        self.n_fallback += 1
+        _, kwargs = self._fallback.full([], **kwargs)
+        flux = kwargs['flux']
+        self._emulator.update(
+                x, flux.to(self._unit).value[np.newaxis],
+                reoptimize_every=self._reoptimize_every)
+        return self._prepare_output(
+                (flux, False) + tuple(kwargs.get(k) for k in self._extra),
+                **kwargs)
@@ -1,6 +1,8 @@
 import numpy as np
+from astropy import units as u
 
 from dalek.tools.base import Link
+from dalek.util import Rebinner
 
 
 # class BaseLikelihoodModel(object):
@@ -23,12 +25,21 @@ from dalek.tools.base import Link
 #         properties_dict = dict(transformed_params=transformed_params)
 #         return loglikelihood, properties_dict
 
+def _stack(values):
+    if isinstance(values[0], u.Quantity):
+        return u.Quantity(values)
+    return np.asarray(values)
+
+
 class SSum(Link):
     inputs = ('flux',)
     outputs = ('loglikelihood',)
 
     def __init__(self, wl, flux, start=0, end=np.inf):
-        if len(wl) == len(flux) + 1:
+        if isinstance(wl, Rebinner):
+            # the bin centres of the grid the model flux is rebinned to
+            wl = wl.target
+        elif len(wl) == len(flux) + 1:
             # convert bin edges to bin centers
             wl = (wl[1:] + wl[:-1]) / 2
         self._slice = slice(
@@ -42,3 +53,224 @@ class SSum(Link):
                 (self._observed_flux[self._slice] -
                 flux[self._slice])**2)
 
+    def calculate_batch(self, flux):
+        return -0.5 * np.sum(
+                (self._observed_flux[self._slice] -
+                _stack(flux)[:, self._slice])**2, axis=1)
+
+
+
+class ChiSquare(Link):
+    '''
+    Gaussian log likelihood of the model flux given the observed flux
+
+        -0.5 * sum((observed - flux)**2 / variance + log(variance))
+
+    with variance = uncertainty**2 + observed_uncertainty**2. Without a model
+    uncertainty (model_uncertainty=False) the variance is constant and the
+    log(variance) term is dropped.
+
+    The observed arrays are sliced to [start, end], masked for non finite
+    values and converted to plain arrays once. Each call only works in
+    buffers, which are reused as long as the shape of `flux` doesn't
+    change. `flux` (and `uncertainty`) can be a single spectrum or a stack
+    of spectra with shape (n_spectra, n_wavelength), then an array of
+    n_spectra log likelihoods is returned. Bins with zero total variance
+    (no observed uncertainty and an empty model bin) are skipped.
+
+    Keyword arguments:
+    wl -- bin edges or centres of the observed flux, or a dalek.util.Rebinner
+    flux -- observed flux
+    uncertainty -- uncertainty of the observed flux (default: None)
+    start, end -- wavelength range in angstrom (default: 0, inf)
+    model_uncertainty -- use the 'uncertainty' of the model (default: True)
+    unit -- flux unit (default: erg / (Angstrom cm2 s))
+    '''
+    outputs = ('loglikelihood',)
+
+    def __init__(
+            self, wl, flux, uncertainty=None, start=0, end=np.inf,
+            model_uncertainty=True, unit='erg / (Angstrom cm2 s)'):
+        if isinstance(wl, Rebinner):
+            wl = wl.target
+        elif len(wl) == len(flux) + 1:
+            # convert bin edges to bin centers
+            wl = (wl[1:] + wl[:-1]) / 2
+        wl = u.Quantity(wl, u.angstrom).value
+        self._unit = u.Unit(unit)
+        self._model_uncertainty = model_uncertainty
+        observed = u.Quantity(flux, self._unit).value
+        if uncertainty is None:
+            if not model_uncertainty:
+                raise ValueError(
+                        'Either the observed or the model uncertainty '
+                        'is required.')
+            variance = np.zeros_like(observed)
+        else:
+            variance = u.Quantity(uncertainty, self._unit).value ** 2
+        index = np.arange(len(observed))[slice(
+                wl.searchsorted(u.Quantity(start, u.angstrom).value),
+                wl.searchsorted(u.Quantity(end, u.angstrom).value) + 1
+                )]
+        observed = observed[index]
+        variance = variance[index]
+        valid = self._valid(observed, variance)
+        self._index = index[valid]
+        self._observed, self._observed_variance = self._transform(
+                observed[valid], variance[valid])
+        if model_uncertainty:
+            self.inputs = ('flux', 'uncertainty',)
+        else:
+            self.inputs = ('flux',)
+            self._inverse_variance = 1. / self._observed_variance
+        # bins without observed uncertainty can end up with no variance
+        self._maybe_empty = not np.all(self._observed_variance > 0)
+        self._buffers = None
+
+    def _valid(self, observed, variance):
+        valid = np.isfinite(observed) & np.isfinite(variance)
+        if not self._model_uncertainty:
+            valid &= variance > 0
+        return valid
+
+    def _transform(self, observed, variance):
+        return observed, variance
+
+    def _buffer(self, shape):
+        # only the buffers of the last shape are kept
+        shape = shape + self._index.shape
+        if self._buffers is None or self._buffers[0].shape != shape:
+            self._buffers = (np.empty(shape), np.empty(shape))
+        return self._buffers
+
+    def _empty(self, variance):
+        '''
+        Mask of the bins with zero total variance (e.g. empty bins of the
+        model without observed uncertainty) or None. These bins are
+        skipped.
+        '''
+        if not self._maybe_empty:
+            return None
+        empty = variance <= 0
+        return empty if empty.any() else None
+
+    def _values(self, value):
+        if isinstance(value, u.Quantity):
+            # no copy if the unit matches
+            value = value.to_value(self._unit)
+        return np.asarray(value, dtype=np.float64)
+
+    def _terms(self, flux, uncertainty):
+        '''
+        Fills the buffers with the residuals and the total variance.
+        '''
+        flux = self._values(flux)
+        residual, variance = self._buffer(flux.shape[:-1])
+        np.take(flux, self._index, axis=-1, out=residual)
+        residual -= self._observed
+        if not self._model_uncertainty:
+            return residual, None
+        np.take(self._values(uncertainty), self._index, axis=-1, out=variance)
+        variance *= variance
+        variance += self._observed_variance
+        return residual, variance
+
+    def calculate(self, flux, uncertainty=None):
+        residual, variance = self._terms(flux, uncertainty)
+        residual *= residual
+        if variance is None:
+            residual *= self._inverse_variance
+        else:
+            empty = self._empty(variance)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                residual /= variance
+                residual += np.log(variance, out=variance)
+            if empty is not None:
+                residual[empty] = 0.
+        return -0.5 * residual.sum(axis=-1)
+
+    def calculate_batch(self, flux, uncertainty=None):
+        if uncertainty is not None:
+            uncertainty = _stack(uncertainty)
+        return self.calculate(_stack(flux), uncertainty)
+
+
+class StudentT(ChiSquare):
+    '''
+    Student-t log likelihood with `dof` degrees of freedom, robust against
+    outliers in the observed spectrum:
+
+        -sum((dof + 1) / 2 * log(1 + r**2 / (dof * variance))
+             + log(variance) / 2)
+
+    See ChiSquare for the other arguments.
+    '''
+
+    def __init__(self, wl, flux, uncertainty=None, dof=4., **kwargs):
+        self.dof = dof
+        super(StudentT, self).__init__(wl, flux, uncertainty, **kwargs)
+
+    def calculate(self, flux, uncertainty=None):
+        residual, variance = self._terms(flux, uncertainty)
+        residual *= residual
+        empty = None
+        if variance is None:
+            residual *= self._inverse_variance / self.dof
+        else:
+            empty = self._empty(variance)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                residual /= variance
+            residual /= self.dof
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.log1p(residual, out=residual)
+            residual *= (self.dof + 1) / 2.
+            if variance is not None:
+                np.log(variance, out=variance)
+                variance *= 0.5
+                residual += variance
+        if empty is not None:
+            residual[empty] = 0.
+        return -residual.sum(axis=-1)
+
+
+class LogFluxChiSquare(ChiSquare):
+    '''
+    ChiSquare of the natural logarithm of the fluxes. The uncertainties are
+    propagated to first order, sigma_log = sigma / flux. Observed bins with
+    non positive flux are masked, a model with non positive flux in a used
+    bin has a log likelihood of -inf.
+    '''
+
+    def _valid(self, observed, variance):
+        return (
+                super(LogFluxChiSquare, self)._valid(observed, variance) &
+                (observed > 0))
+
+    def _transform(self, observed, variance):
+        return np.log(observed), variance / observed ** 2
+
+    def _terms(self, flux, uncertainty):
+        flux = self._values(flux)
+        residual, variance = self._buffer(flux.shape[:-1])
+        np.take(flux, self._index, axis=-1, out=residual)
+        if self._model_uncertainty:
+            np.take(
+                    self._values(uncertainty), self._index, axis=-1,
+                    out=variance)
+            variance /= residual
+            variance *= variance
+            variance += self._observed_variance
+        else:
+            variance = None
+        np.log(residual, out=residual)
+        residual -= self._observed
+        return residual, variance
+
+    def calculate(self, flux, uncertainty=None):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            loglikelihood = super(LogFluxChiSquare, self).calculate(
+                    flux, uncertainty)
+        if np.ndim(loglikelihood) == 0:
+            return -np.inf if np.isnan(loglikelihood) else loglikelihood
+        loglikelihood[np.isnan(loglikelihood)] = -np.inf
+        return loglikelihood
@@ -0,0 +1,167 @@
+import os
+import hashlib
+import cPickle as pickle
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from dalek.tools.base import Link
+from dalek.wrapper import SafeHDFStore
+
+
+def canonical_hash(*values):
+    '''
+    sha1 hex digest of `values` which doesn't depend on the order of dict
+    keys or the identity of the objects, only on their content.
+
+    Numbers are hashed exactly and together with their kind: ints (and
+    numpy integers) hash alike, as do floats, but 1 and 1.0 or True and 1
+    hash differently. Arrays also include their dtype.
+    '''
+    h = hashlib.sha1()
+    for value in values:
+        _update_hash(h, value)
+    return h.hexdigest()
+
+
+def _update_hash(h, value):
+    if hasattr(value, 'as_full_dict'):
+        # ParameterContainer: raw values and all derived values
+        value = value.as_full_dict()
+    if isinstance(value, dict):
+        h.update('d{}'.format(len(value)))
+        for k in sorted(value):
+            _update_hash(h, k)
+            _update_hash(h, value[k])
+    elif isinstance(value, pd.Series):
+        h.update('s')
+        _update_hash(h, list(value.index))
+        _update_hash(h, value.values)
+    elif hasattr(value, 'unit') and hasattr(value, 'value'):
+        h.update('q' + str(value.unit))
+        _update_hash(h, value.value)
+    elif isinstance(value, np.ndarray):
+        h.update('a{}{}'.format(value.dtype.str, value.shape))
+        if value.dtype.hasobject:
+            for v in value.ravel():
+                _update_hash(h, v)
+        else:
+            h.update(np.ascontiguousarray(value).data)
+    elif isinstance(value, (list, tuple)):
+        h.update('l{}'.format(len(value)))
+        for v in value:
+            _update_hash(h, v)
+    elif isinstance(value, (float, np.floating)):
+        # repr is exact for floats
+        h.update('f' + repr(float(value)))
+    elif isinstance(value, (bool, np.bool_)):
+        h.update('b' + repr(bool(value)))
+    elif isinstance(value, (int, long, np.integer)):
+        # str, repr of a long ends with L
+        h.update('i' + str(int(value)))
+    else:
+        h.update('o' + repr(value))
+
+
+class Memoize(Link):
+    '''
+    Caches the outputs of `chain` keyed on a hash of the inputs named in
+    `keys` (see canonical_hash). On a hit the chain isn't evaluated, its
+    cached outputs are used instead. The least recently used entries are
+    dropped once there are more than `maxsize`.
+
+    With `path` the outputs are additionally written to an HDF5 file, so
+    hits survive restarts and are shared by all processes using the same
+    file. Every read and write opens a SafeHDFStore and closes it right
+    away, reads share the lock.
+
+    Keyword arguments:
+    keys -- names of the inputs the outputs depend on
+            (default: ('parameters',))
+    maxsize -- maximum number of entries kept in memory (default: 128)
+    path -- HDF5 file used as second level cache (default: None)
+    '''
+
+    def __init__(self, chain, keys=('parameters',), maxsize=128, path=None):
+        self._chain = chain
+        self._keys = tuple(keys)
+        self.maxsize = maxsize
+        self._path = path
+        self.inputs = tuple(self._keys) + tuple(
+                i for i in chain.inputs if i not in self._keys)
+        self.outputs = tuple(chain.outputs)
+        self._cached = tuple(sorted(
+                set(chain.outputs).difference(chain.inputs)))
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+    @property
+    def cache_size(self):
+        return len(self._cache)
+
+    def clear_cache(self):
+        '''
+        Clears the in memory cache and the counters, not the HDF5 file.
+        '''
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+    def _key(self, kwargs):
+        return canonical_hash(*[kwargs[k] for k in self._keys])
+
+    def _apply(self, args, kwargs):
+        key = self._key(kwargs)
+        entry = self._cache.pop(key, None)
+        if entry is None and self._path is not None:
+            entry = self._read(key)
+            if entry is not None:
+                self.disk_hits += 1
+        if entry is not None:
+            self.hits += 1
+            self._insert(key, entry)
+            result, outputs = entry
+            kwargs.update(outputs)
+            return result, kwargs
+
+        self.misses += 1
+        result, kwargs = self._chain.full([], **kwargs)
+        entry = (result, dict((k, kwargs[k]) for k in self._cached))
+        self._insert(key, entry)
+        if self._path is not None:
+            self._write(key, entry)
+        return result, kwargs
+
+    def _insert(self, key, entry):
+        self._cache[key] = entry
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    @staticmethod
+    def _node(key):
+        return 'memoize/h' + key
+
+    def _read(self, key):
+        if not os.path.exists(self._path):
+            return None
+        store = SafeHDFStore(self._path, mode='r')
+        try:
+            if self._node(key) not in store:
+                return None
+            blob = store[self._node(key)].values
+        finally:
+            store.close()
+        return pickle.loads(blob.tostring())
+
+    def _write(self, key, entry):
+        blob = np.frombuffer(
+                pickle.dumps(entry, pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+        store = SafeHDFStore(self._path)
+        try:
+            store.put(self._node(key), pd.Series(blob))
+        finally:
+            store.close()
@@ -3,10 +3,15 @@ import pandas as pd
 
 from dalek.tools.base import Link
 
-from dalek.base.meta import MetaInformation
+from dalek.base.meta import MetaInformation, AsyncContainer
 
 
 class SaveRun(Link):
+    '''
+    Saves every run to `container`. With background=True the container is
+    wrapped in an AsyncContainer, so the chain doesn't wait for the HDF5
+    writes. Use close() (or exit) to write the remaining runs.
+    '''
     inputs = (
             'model', 'uuid', 'rank', 'iteration', 'parameters',
             'posterior', 'flux', 'runtime', 'host', 'time')
@@ -14,9 +19,11 @@ class SaveRun(Link):
 
     def __init__(
             self, container=None, add_data=[],
-            table_name='run_table', flux=False):
+            table_name='run_table', flux=False, background=False):
         if container is None:
             self.calculate = lambda *args, **kwargs: None
+        elif background:
+            container = AsyncContainer(container)
         self._container = container
         self._table_name = table_name
         self._add_data = add_data
@@ -29,7 +36,8 @@ class SaveRun(Link):
         try:
             run_values = parameters.as_full_dict()
         except AttributeError:
-            run_values = parameters
+            # the item may be written later, keep the values of this run
+            run_values = dict(parameters)
 
         run_values['runtime'] = runtime or 0.0
         run_values['start_time'] = time or np.datetime64()
@@ -57,6 +65,10 @@ class SaveRun(Link):
                 metainfo.add_data(pd.Series(obj), name)
         self._container.save(metainfo, self._table_name)
 
+    def close(self):
+        if hasattr(self._container, 'close'):
+            self._container.close()
+
 
 class SavePreRun(SaveRun):
     '''
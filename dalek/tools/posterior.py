@@ -1,3 +1,5 @@
+import numpy as np
+
 from dalek.tools.base import Link
 
 
@@ -7,9 +9,16 @@ class Posterior(Link):
 
     def calculate(self, logprior, loglikelihood):
         try:
-            return logprior + loglikelihood.value
+            # Quantity (SSum) or plain float (ChiSquare)
+            return logprior + getattr(loglikelihood, 'value', loglikelihood)
         except (TypeError, AttributeError) as e:
             if loglikelihood is None:
                 return logprior
             else:
                 raise e
+
+    def calculate_batch(self, logprior, loglikelihood):
+        # loglikelihood is None for items that broke the chain before it
+        return np.asarray(logprior) + np.array([
+            0. if l is None else getattr(l, 'value', l)
+            for l in loglikelihood])
@@ -24,6 +24,10 @@ class Prior(Link):
     def calculate(self, parameters, logprior=DEFAULT):
         return self.logprior(parameters) + logprior
 
+    def calculate_batch(self, parameters, logprior=DEFAULT):
+        return np.array(
+                [self.logprior(p) for p in parameters]) + np.asarray(logprior)
+
     def logprior(self, parameters):
         return DEFAULT
 
@@ -113,3 +117,10 @@ class CheckPrior(Link):
         if logprior == INVALID:
             raise BreakChainException(
                     'Prior is INVALID: {}'.format(logprior))
+
+    def calculate_batch(self, logprior):
+        invalid = np.asarray(logprior) == INVALID
+        if invalid.any():
+            raise BreakChainException(
+                    'Prior is INVALID for {} items'.format(invalid.sum()),
+                    items=invalid)
@@ -0,0 +1,148 @@
+from timeit import default_timer
+
+import numpy as np
+import pandas as pd
+
+from dalek.tools.base import Chain, BreakChainException, _is_plain
+
+
+def _nbytes(value):
+    '''
+    Size of the arrays in `value`, python 2 can't trace allocations.
+    '''
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    try:
+        return int(value.nbytes)
+    except (AttributeError, TypeError):
+        return 0
+
+
+_missing = object()
+
+
+class _Record(object):
+
+    def __init__(self):
+        self.times = []
+        self.nbytes = 0
+        self.breaks = 0
+        self.active = False
+
+
+class Profiler(object):
+    '''
+    Records the runtime of every link of `chain`, including the links of
+    nested Chains. Links are labeled with their position and class name,
+    e.g. '1:Chain/0:Prior'.
+
+    The links are instrumented by wrapping calculate (or _apply for links
+    overriding it) on the instances, so a chain without Profiler runs
+    exactly the code it ran before. This also works for compiled Chains and
+    batch evaluation, but not for ParallelChain with backend='process'
+    where the links run in copies.
+
+    Calls of a link from within itself, e.g. calculate_batch calling
+    calculate, are part of the outer call and not recorded separately.
+
+    'bytes' is the size of the arrays returned by the link.
+
+    Profiler(chain) starts recording right away, detach() restores the
+    links. It can also be used as context manager.
+    '''
+
+    def __init__(self, chain):
+        self._chain = chain
+        self._records = {}
+        self._labels = []
+        self._patched = []
+        self._instrument(chain, '')
+
+    def _instrument(self, chain, prefix):
+        for i, link in enumerate(chain._links):
+            label = '{}{}:{}'.format(prefix, i, link.__class__.__name__)
+            if isinstance(link, Chain):
+                self._instrument(link, label + '/')
+                continue
+            self._labels.append(label)
+            record = self._records[label] = _Record()
+            if _is_plain(link):
+                names = ['calculate', 'calculate_batch']
+            else:
+                names = ['_apply', '_apply_batch']
+            for name in names:
+                if getattr(link, name, None) is not None:
+                    self._patch(link, name, record)
+
+    def _patch(self, link, name, record):
+        method = getattr(link, name)
+        # e.g. SaveRun(container=None) replaces calculate on the instance
+        previous = link.__dict__.get(name, _missing)
+
+        def timed(*args, **kwargs):
+            if record.active:
+                # e.g. calculate called by calculate_batch, already timed
+                return method(*args, **kwargs)
+            record.active = True
+            start = default_timer()
+            try:
+                result = method(*args, **kwargs)
+            except BreakChainException:
+                record.breaks += 1
+                raise
+            finally:
+                record.times.append(default_timer() - start)
+                record.active = False
+            record.nbytes += _nbytes(result)
+            return result
+
+        setattr(link, name, timed)
+        self._patched.append((link, name, previous))
+
+    def detach(self):
+        for link, name, previous in reversed(self._patched):
+            if previous is _missing:
+                del link.__dict__[name]
+            else:
+                link.__dict__[name] = previous
+        self._patched = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def reset(self):
+        for record in self._records.values():
+            record.__init__()
+
+    def stats(self, percentiles=(50, 90, 99)):
+        '''
+        Returns:
+        (DataFrame) one row per link with the number of calls, breaks, the
+        total, mean and percentile runtimes in seconds and the bytes
+        returned
+        '''
+        rows = []
+        for label in self._labels:
+            record = self._records[label]
+            times = np.array(record.times)
+            row = [len(times), record.breaks, times.sum()]
+            if len(times):
+                row.append(times.mean())
+                row.extend(np.percentile(times, percentiles))
+            else:
+                row.extend([np.nan] * (len(percentiles) + 1))
+            row.append(record.nbytes)
+            rows.append(row)
+        columns = (
+                ['calls', 'breaks', 'total', 'mean'] +
+                ['p{}'.format(p) for p in percentiles] + ['bytes'])
+        return pd.DataFrame(rows, index=self._labels, columns=columns)
+
+    def save(self, container, path='profile'):
+        '''
+        Save stats() with container.save, e.g. to a MetaContainer.
+        '''
+        container.save(self.stats(), path)
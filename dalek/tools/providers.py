@@ -1,10 +1,11 @@
 import platform
 import numpy as np
 from uuid import uuid4
-from astropy import units as u
+from astropy import units as u, constants as c
 from datetime import datetime as dt
 
 from dalek.tools.base import Link
+from dalek.util import Rebinner
 
 
 class PacketProvider(Link):
@@ -31,18 +32,119 @@ class VirtualPacketProvider(Link):
 
 
 class Luminosity(Link):
+    '''
+    Luminosity density of the packets in the wavelength bins `wl` (edges).
+
+    `wl` can also be a dalek.util.Rebinner. The packets are then binned on
+    its source grid and the luminosity density is rebinned onto its target
+    grid.
+
+    With fast=True the packets are binned on plain float64 arrays: the bin
+    edges are converted to frequency once, packets are assigned to bins
+    with searchsorted (or directly for a uniform wavelength grid) and
+    summed with bincount. Units are only attached to the result. Packets
+    exactly on a bin edge may end up in the neighbouring bin compared to
+    the default mode. Grids uniform in wavelength or in frequency (like the
+    TARDIS spectrum) are binned without searching.
+    '''
     inputs = ('packet_nu', 'packet_energy',)
     outputs = ('luminosity',)
 
-    def __init__(self, wl):
-        self._wl_bins = wl
+    def __init__(self, wl, fast=False):
+        if isinstance(wl, Rebinner):
+            self._rebinner = wl
+            self._wl_bins = u.Quantity(wl.source_edges, wl.unit or u.angstrom)
+        else:
+            self._rebinner = None
+            self._wl_bins = wl
+        self._bin_widths = np.diff(self._wl_bins)
+        self.fast = fast
+        if fast:
+            self._prepare_fast()
+
+    def _prepare_fast(self):
+        edges = u.Quantity(self._wl_bins, u.angstrom).value
+        # the widths are in angstrom, plain edges stay without unit
+        self._wl_unit = (
+                u.angstrom if hasattr(self._wl_bins, 'unit')
+                else u.dimensionless_unscaled)
+        self._widths = np.diff(edges)
+        self._c = c.c.to('angstrom/s').value
+        # ascending frequency edges
+        self._nu_edges = self._c / edges[::-1]
+        nu_widths = np.diff(self._nu_edges)
+        if np.allclose(self._widths, self._widths[0], rtol=1e-9, atol=0):
+            self._uniform = 'wavelength'
+        elif np.allclose(nu_widths, nu_widths[0], rtol=1e-9, atol=0):
+            self._uniform = 'frequency'
+        else:
+            self._uniform = None
+        self._wl_min = edges[0]
+        self._wl_max = edges[-1]
+        # mean widths, a single bin can be narrower by round-off
+        self._width = (self._wl_max - self._wl_min) / len(self._widths)
+        self._nu_width = (
+                (self._nu_edges[-1] - self._nu_edges[0]) / len(nu_widths))
+
+    def _bin_index(self, nu):
+        '''
+        Wavelength bin of every packet, -1 if outside of the grid.
+        '''
+        n_bins = len(self._widths)
+        if self._uniform == 'wavelength':
+            wl = self._c / nu
+            index = np.floor((wl - self._wl_min) / self._width).astype(np.intp)
+            # the last bin is closed, as in np.histogram, round-off must
+            # not move packets inside of the grid out of it
+            np.clip(index, 0, n_bins - 1, out=index)
+            index[(wl < self._wl_min) | (wl > self._wl_max)] = -1
+        elif self._uniform == 'frequency':
+            nu_min = self._nu_edges[0]
+            k = np.ceil((nu - nu_min) / self._nu_width).astype(np.intp)
+            np.clip(k, 1, n_bins, out=k)
+            index = n_bins - k
+            index[(nu < nu_min) | (nu > self._nu_edges[-1])] = -1
+        else:
+            # nu in (nu_edges[k - 1], nu_edges[k]] is wavelength bin n - k
+            k = self._nu_edges.searchsorted(nu, side='left')
+            k[nu == self._nu_edges[0]] = 1
+            index = n_bins - k
+            index[(k < 1) | (k > n_bins)] = -1
+        return index
+
+    def _accumulate(self, nu, energy, out):
+        '''
+        Add the energies of the packets with the frequencies nu (Hz) to the
+        histogram `out`.
+        '''
+        index = self._bin_index(nu)
+        inside = index >= 0
+        out += np.bincount(
+                index[inside], weights=energy[inside],
+                minlength=len(self._widths))
+
+    def _histogram_fast(self, packet_nu, packet_energy):
+        nu = np.asarray(u.Quantity(packet_nu, u.Hz).value, dtype=np.float64)
+        energy = np.asarray(getattr(packet_energy, 'value', packet_energy))
+        luminosity = np.zeros(len(self._widths))
+        self._accumulate(nu, energy, luminosity)
+        luminosity /= self._widths
+        return luminosity * (
+                getattr(packet_energy, 'unit', u.dimensionless_unscaled) /
+                self._wl_unit)
 
     def calculate(self, packet_nu, packet_energy):
-        return (np.histogram(
-            packet_nu.to(u.angstrom, u.spectral()),
-            weights=packet_energy,
-            bins=self._wl_bins)[0] * packet_energy.unit  / np.diff(self._wl_bins)
-            )
+        if self.fast:
+            luminosity = self._histogram_fast(packet_nu, packet_energy)
+        else:
+            luminosity = (np.histogram(
+                packet_nu.to(u.angstrom, u.spectral()),
+                weights=packet_energy,
+                bins=self._wl_bins)[0] * packet_energy.unit  / self._bin_widths
+                )
+        if self._rebinner is not None:
+            return self._rebinner(luminosity)
+        return luminosity
 
 
 class VirtualLuminosity(Luminosity):
@@ -54,6 +156,145 @@ class VirtualLuminosity(Luminosity):
                         virtual_packet_nu, virtual_packet_energy)
 
 
+class LuminosityUncertainty(Luminosity):
+    '''
+    Luminosity density and its uncertainty, binned as with fast=True.
+
+    The packets are assigned to bins once and both the sum of the energies
+    and the sum of the squared energies are taken from that assignment. The
+    number of packets per bin is Poisson distributed, so the variance of the
+    summed energies is the sum of the squared energies.
+    '''
+    outputs = ('luminosity', 'uncertainty',)
+
+    def __init__(self, wl):
+        super(LuminosityUncertainty, self).__init__(wl, fast=True)
+        if self._rebinner is not None:
+            self._matrix_sq = self._rebinner.matrix.multiply(
+                    self._rebinner.matrix).tocsr()
+
+    def calculate(self, packet_nu, packet_energy):
+        nu = np.asarray(u.Quantity(packet_nu, u.Hz).value, dtype=np.float64)
+        energy = np.asarray(getattr(packet_energy, 'value', packet_energy))
+        index = self._bin_index(nu)
+        inside = index >= 0
+        index = index[inside]
+        energy = energy[inside]
+        n_bins = len(self._widths)
+        luminosity = np.bincount(index, weights=energy, minlength=n_bins)
+        variance = np.bincount(
+                index, weights=energy * energy, minlength=n_bins)
+        if self._rebinner is not None:
+            luminosity = self._rebinner(luminosity / self._widths)
+            uncertainty = np.sqrt(self._matrix_sq.dot(
+                variance / self._widths ** 2))
+        else:
+            luminosity /= self._widths
+            uncertainty = np.sqrt(variance) / self._widths
+        unit = (
+                getattr(packet_energy, 'unit', u.dimensionless_unscaled) /
+                self._wl_unit)
+        return luminosity * unit, uncertainty * unit
+
+
+class VirtualLuminosityUncertainty(LuminosityUncertainty):
+    inputs = ('virtual_packet_nu', 'virtual_packet_energy',)
+
+    def calculate(self, virtual_packet_nu, virtual_packet_energy):
+        return super(
+                VirtualLuminosityUncertainty, self).calculate(
+                        virtual_packet_nu, virtual_packet_energy)
+
+
+def packet_chunks(nu, energy, chunk_size=2**20, energy_scale=1.):
+    '''
+    Yields (nu, energy) of consecutive chunks of at most `chunk_size`
+    packets as float64 arrays, the energies multiplied by `energy_scale`.
+
+    `nu` and `energy` can be memory mapped (np.load(..., mmap_mode='r')),
+    then only one chunk at a time is read into memory.
+    '''
+    for start in range(0, len(nu), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        energy_chunk = np.array(energy[chunk], dtype=np.float64)
+        if energy_scale != 1.:
+            energy_chunk *= energy_scale
+        yield np.asarray(nu[chunk], dtype=np.float64), energy_chunk
+
+
+class VirtualPacketChunkProvider(Link):
+    '''
+    Streaming version of VirtualPacketProvider. Provides the virtual packets
+    as an iterator over chunks of plain arrays: frequency in Hz and
+    luminosity in erg/s.
+    '''
+    inputs = ('model',)
+    outputs = ('virtual_packet_chunks',)
+
+    def __init__(self, chunk_size=2**20):
+        self._chunk_size = chunk_size
+
+    def calculate(self, model):
+        time_of_simulation = u.Quantity(
+                model.runner.time_of_simulation, u.s).value
+        return packet_chunks(
+                model.runner.virt_packet_nus,
+                model.runner.virt_packet_energies,
+                self._chunk_size,
+                1. / time_of_simulation)
+
+
+class PacketFileChunkProvider(Link):
+    '''
+    Provides the packets of the .npy file `packet_file` as an iterator over
+    chunks. The file holds an (n_packets, 2) array of frequency in Hz and
+    luminosity in erg/s and is memory mapped.
+    '''
+    inputs = ('packet_file',)
+    outputs = ('virtual_packet_chunks',)
+
+    def __init__(self, chunk_size=2**20):
+        self._chunk_size = chunk_size
+
+    def calculate(self, packet_file):
+        packets = np.load(packet_file, mmap_mode='r')
+        return packet_chunks(
+                packets[:, 0], packets[:, 1], self._chunk_size)
+
+
+class StreamingLuminosity(Luminosity):
+    '''
+    Luminosity density of packets given as an iterable of (nu, energy)
+    chunks of plain arrays, e.g. from VirtualPacketChunkProvider. The chunks
+    are binned as with fast=True and added up in a preallocated buffer, so
+    the memory used is bounded by the chunk size, independent of the number
+    of packets.
+
+    Keyword arguments:
+    nu_unit -- unit of the frequencies in the chunks (default: Hz)
+    energy_unit -- unit of the energies in the chunks (default: erg / s)
+    '''
+    inputs = ('virtual_packet_chunks',)
+
+    def __init__(self, wl, nu_unit=u.Hz, energy_unit=u.erg / u.s):
+        super(StreamingLuminosity, self).__init__(wl, fast=True)
+        self._nu_scale = u.Unit(nu_unit).to(u.Hz)
+        self._energy_unit = u.Unit(energy_unit)
+        self._buffer = np.zeros(len(self._widths))
+
+    def calculate(self, virtual_packet_chunks):
+        self._buffer[:] = 0.
+        for nu, energy in virtual_packet_chunks:
+            if self._nu_scale != 1.:
+                nu = nu * self._nu_scale
+            self._accumulate(nu, energy, self._buffer)
+        luminosity = self._buffer / self._widths * (
+                self._energy_unit / self._wl_unit)
+        if self._rebinner is not None:
+            return self._rebinner(luminosity)
+        return luminosity
+
+
 class Flux(Link):
     inputs = ('luminosity',)
     outputs = ('flux',)
@@ -64,6 +305,27 @@ class Flux(Link):
     def calculate(self, luminosity):
         return luminosity / (4 * np.pi * self._distance**2)
 
+    def calculate_batch(self, luminosity):
+        return self.calculate(u.Quantity(luminosity))
+
+
+class FluxUncertainty(Flux):
+    '''
+    Flux and its uncertainty from the output of LuminosityUncertainty.
+    '''
+    inputs = ('luminosity', 'uncertainty',)
+    outputs = ('flux', 'uncertainty',)
+
+    def calculate(self, luminosity, uncertainty):
+        return (
+                super(FluxUncertainty, self).calculate(luminosity),
+                super(FluxUncertainty, self).calculate(uncertainty),
+                )
+
+    def calculate_batch(self, luminosity, uncertainty):
+        return self.calculate(
+                u.Quantity(luminosity), u.Quantity(uncertainty))
+
 
 class RunInfo(Link):
     inputs = tuple()
@@ -92,6 +354,10 @@ class RunInfo(Link):
 class RunInfoFromFile(RunInfo):
     """
     Not yet modified to reflect new MetaContainer
+
+    `container` is used as context manager returning an HDFStore, e.g.
+    dalek.wrapper.HDFSession(path, mode='r') which keeps the file open
+    between runs instead of reopening it every time.
     """
 
     def __init__(self, container):
@@ -1,7 +1,11 @@
+import gc
+import time
+from multiprocessing.pool import RUN
+
 import numpy as np
 import pytest
 from dalek.tools.base import (
-        Link, Chain, BreakChainException,
+        Link, Chain, ParallelChain, BreakChainException,
         DynamicOutput
         )
 
@@ -256,3 +260,191 @@ def multi_input(apple_t, banana_t, cherry_a):
     assert Chain(multi)(
             np.all(multi(np.ones(10), np.ones(10))['data'])
             )
+
+
+def test_compile(apple, apple_t, banana, banana_t, cherry_a, data):
+    cond = AppleBreak()
+    input_dict = {'apple': False, 'banana': True}
+    cases = [
+            (lambda: Chain(apple_t, cherry_a, banana_t), [input_dict]),
+            (lambda: Chain(Chain(apple_t, cherry_a, banana_t), cherry_a),
+                [input_dict]),
+            (lambda: Chain(apple, banana, apple_t, cond, banana_t,
+                breakable=True), []),
+            (lambda: Chain(apple, cond, banana, apple, breakable=True), []),
+            (lambda: Chain(apple, Chain(cond, banana, breakable=True),
+                cherry_a), []),
+            (lambda: Chain(apple, DynamicOutput('apple'), apple_t), []),
+            (lambda: Chain(ApplePie(), NumpyReturn(data)), []),
+            ]
+    for make_chain, args in cases:
+        expected_args, expected = make_chain().full(*args)
+        obtained_args, obtained = make_chain().compile().full(*args)
+        assert obtained.keys() == expected.keys()
+        for key in expected:
+            assert np.all(obtained[key] == expected[key])
+        assert np.all(obtained_args == expected_args)
+
+    chain = Chain(apple_t, cherry_a, banana_t).compile()
+    assert chain(dict(input_dict, extra=1))['extra'] == 1
+    with pytest.raises(KeyError):
+        chain({'banana': False})
+    with pytest.raises(BreakChainException):
+        Chain(apple, banana, cond, banana_t).compile()()
+
+
+class Square(Link):
+    inputs = ('x',)
+    outputs = ('y',)
+
+    def calculate(self, x):
+        if x < 0:
+            raise BreakChainException
+        return x ** 2
+
+
+class SquareBatch(Square):
+    calls = 0
+
+    def calculate_batch(self, x):
+        SquareBatch.calls += 1
+        x = np.asarray(x)
+        if np.any(x < 0):
+            raise BreakChainException(items=x < 0)
+        return x ** 2
+
+
+class Sum(Link):
+    inputs = ('x', 'y',)
+    outputs = ('z', 'double',)
+
+    def calculate(self, x, y):
+        return x + y, 2 * (x + y)
+
+
+@pytest.mark.parametrize('square', [Square, SquareBatch])
+def test_batch(square):
+    x = [3., -1., 2., -5.]
+    chain = Chain(Chain(square(), Sum(), breakable=True), DynamicOutput('x'))
+    result = chain.batch({'x': x})
+    for i, value in enumerate(x):
+        expected = chain({'x': value})
+        assert dict((k, v[i]) for k, v in result.items()) == expected
+    assert chain.full_batch({'x': x})[0] == x
+
+    with pytest.raises(BreakChainException) as e:
+        Chain(square(), Sum()).batch({'x': x})
+    assert list(e.value.items) == [False, True, False, True]
+
+    assert Chain(square(), Sum()).batch({'x': [1., 2.]}) == {
+            'x': [1., 2.], 'y': [1., 4.], 'z': [2., 6.], 'double': [4., 12.]}
+
+
+def test_batch_calls():
+    SquareBatch.calls = 0
+    Chain(SquareBatch(), breakable=True).batch({'x': [1., -1., 2.]})
+    # once for all items, once for the items which didn't break
+    assert SquareBatch.calls == 2
+
+
+def test_batch_no_inputs(apple, banana, cherry_a):
+    assert Chain(apple, banana, cherry_a).batch(batch_size=2) == {
+            'apple': [True, True],
+            'banana': [True, True],
+            'cherry': [True, True],
+            }
+    with pytest.raises(ValueError):
+        apple.batch()
+
+
+class Sleep(Link):
+
+    def __init__(self, name, delay=0.2):
+        self.inputs = ('x',)
+        self.outputs = (name,)
+        self._delay = delay
+
+    def calculate(self, x):
+        time.sleep(self._delay)
+        return x + 1
+
+
+def test_parallel_chain(apple, apple_t, banana, banana_t, cherry_a):
+    input_dict = {'apple': False, 'banana': True}
+    chain = ParallelChain(apple_t, banana_t, cherry_a, n_jobs=2)
+    assert chain._waves == [[0, 1], [2]]
+    assert chain(input_dict) == Chain(apple_t, banana_t, cherry_a)(input_dict)
+    # cherry_a reads what the toggles write
+    chain = ParallelChain(cherry_a, apple_t, banana_t, n_jobs=2)
+    assert chain._waves == [[0], [1, 2]]
+    assert chain(input_dict) == Chain(cherry_a, apple_t, banana_t)(input_dict)
+    chain.close()
+
+    with ParallelChain(
+            Sleep('a'), Sleep('b'), Sleep('c'), Sleep('d'), n_jobs=4) as chain:
+        start = time.time()
+        assert chain({'x': 1}) == {'x': 1, 'a': 2, 'b': 2, 'c': 2, 'd': 2}
+        assert time.time() - start < 0.6
+        pool = chain._pool
+    assert chain._pool is None
+    assert pool._state != RUN
+
+
+def test_parallel_chain_collected(apple_t, banana_t):
+    chain = ParallelChain(apple_t, banana_t, n_jobs=2)
+    chain({'apple': False, 'banana': True})
+    pool = chain._pool
+    del chain
+    gc.collect()
+    # the pool doesn't outlive its chain
+    assert pool._state != RUN
+
+
+def test_parallel_chain_break(apple, banana):
+    cond = AppleBreak()
+    with pytest.raises(BreakChainException):
+        ParallelChain(apple, cond, banana, n_jobs=2)()
+    assert ParallelChain(apple, cond, banana, n_jobs=2, breakable=True)() == {
+            'apple': True,
+            'banana': None,
+            }
+    with pytest.raises(ValueError):
+        ParallelChain(apple, backend='mpi')
+
+
+class Check(Link):
+    inputs = ['apple']
+
+    def calculate(self, apple):
+        if apple:
+            raise BreakChainException
+
+
+class Count(Link):
+    outputs = ['count']
+
+    def __init__(self):
+        self.calls = 0
+
+    def calculate(self):
+        self.calls += 1
+        return self.calls
+
+
+def test_parallel_chain_barrier():
+    count = Count()
+    chain = ParallelChain(Check(), count, n_jobs=2, breakable=True)
+    # the check has no outputs, the expensive link has to wait for it
+    assert chain._waves == [[0], [1]]
+    assert chain({'apple': True}) == {'apple': True, 'count': None}
+    assert count.calls == 0
+    assert chain({'apple': False}) == {'apple': False, 'count': 1}
+    chain.close()
+
+
+def test_parallel_chain_process(apple_t, banana_t, cherry_a):
+    input_dict = {'apple': False, 'banana': True}
+    chain = ParallelChain(
+            Chain(apple_t, cherry_a), banana_t, n_jobs=2, backend='process')
+    assert chain(input_dict) == Chain(apple_t, cherry_a, banana_t)(input_dict)
+    chain.close()
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from astropy import units as u
+
+from dalek.emulator import Emulator
+from dalek.tools.base import Chain, Link
+from dalek.tools.emulated import EmulatedFlux
+
+FLUX_UNIT = u.erg / (u.angstrom * u.cm**2 * u.s)
+WL = np.linspace(0, 1, 50)
+
+
+def spectrum(x):
+    return 2 + x[0] * np.sin(4 * WL) + x[1] * np.cos(3 * WL)
+
+
+class FakeTardis(Link):
+    inputs = ('parameters', 'uuid',)
+    outputs = ('flux', 'runtime',)
+
+    def calculate(self, parameters, uuid):
+        x = [parameters['a'], parameters['b']]
+        return spectrum(x) * FLUX_UNIT, 1.
+
+
+@pytest.fixture
+def emulator():
+    X = np.random.RandomState(0).random_sample((30, 2))
+    return Emulator(X, np.array([spectrum(x) for x in X]), 2)
+
+
+def test_emulated_flux(emulator):
+    link = EmulatedFlux(emulator, FakeTardis(), ['a', 'b'], threshold=np.inf)
+    assert set(link.inputs) == set(['parameters', 'uuid'])
+    assert link.outputs == ('flux', 'emulated', 'runtime')
+    output = Chain(link)({'parameters': {'a': .3, 'b': .6}, 'uuid': 1})
+    assert output['emulated']
+    assert output['runtime'] is None
+    np.testing.assert_allclose(
+            output['flux'].value, spectrum([.3, .6]), rtol=1e-2)
+    assert link.n_emulated == 1
+
+
+def test_emulated_flux_fallback(emulator):
+    link = EmulatedFlux(emulator, FakeTardis(), ['a', 'b'], threshold=0)
+    output = link({'parameters': {'a': .3, 'b': .6}, 'uuid': 1})
+    assert not output['emulated']
+    assert output['runtime'] == 1.
+    np.testing.assert_allclose(output['flux'].value, spectrum([.3, .6]))
+    assert link.n_fallback == 1
+    assert emulator._X.shape[0] == 31
+    np.testing.assert_array_equal(emulator._X[-1], [.3, .6])
+
+
+def test_emulated_flux_batch(emulator):
+    parameters = [{'a': .3, 'b': .6}, {'a': 3., 'b': -2.}]
+    _, std = emulator.predict([[.3, .6], [3., -2.]])
+    link = EmulatedFlux(emulator, FakeTardis(), ['a', 'b'], threshold=std[0])
+    output = Chain(link).batch({'parameters': parameters, 'uuid': [1, 2]})
+    assert output['emulated'] == [True, False]
+    assert output['runtime'] == [None, 1.]
+    for p, flux in zip(parameters, output['flux']):
+        np.testing.assert_allclose(
+                flux.value, spectrum([p['a'], p['b']]), rtol=1e-2)
+    assert (link.n_emulated, link.n_fallback) == (1, 1)
@@ -0,0 +1,173 @@
+import numpy as np
+import pytest
+from astropy import units as u
+
+from dalek.tools.likelihood import ChiSquare, StudentT, LogFluxChiSquare
+
+FLUX_UNIT = u.erg / (u.angstrom * u.cm**2 * u.s)
+
+
+@pytest.fixture
+def observation():
+    state = np.random.RandomState(0)
+    wl = np.linspace(3000, 9000, 101) * u.angstrom
+    flux = (1 + state.random_sample(100)) * FLUX_UNIT
+    uncertainty = 0.1 * np.ones(100) * FLUX_UNIT
+    flux[3] = np.nan
+    return wl, flux, uncertainty
+
+
+@pytest.fixture
+def models():
+    state = np.random.RandomState(1)
+    return (
+            (1 + state.random_sample((5, 100))) * FLUX_UNIT,
+            0.05 * (1 + state.random_sample((5, 100))) * FLUX_UNIT,
+            )
+
+
+def reference(observation, flux, uncertainty, start=4000, end=8000):
+    wl, observed, observed_uncertainty = observation
+    centers = 0.5 * (wl[1:] + wl[:-1]).value
+    used = ((centers >= centers[centers.searchsorted(start)]) &
+            (centers <= centers[min(centers.searchsorted(end), 99)]) &
+            np.isfinite(observed))
+    residual = (observed - flux).value[..., used]
+    variance = (observed_uncertainty.value ** 2 + uncertainty.value ** 2)
+    return residual, variance[..., used]
+
+
+def test_chi_square(observation, models):
+    flux, uncertainty = models
+    chi_square = ChiSquare(*observation, start=4000, end=8000)
+    assert chi_square.inputs == ('flux', 'uncertainty')
+    residual, variance = reference(observation, flux, uncertainty)
+    expected = -0.5 * np.sum(residual ** 2 / variance + np.log(variance), -1)
+    np.testing.assert_allclose(chi_square.calculate(flux, uncertainty), expected)
+    np.testing.assert_allclose(
+            chi_square({'flux': flux[2], 'uncertainty': uncertainty[2]})[
+                'loglikelihood'], expected[2])
+    np.testing.assert_allclose(
+            chi_square.batch({'flux': list(flux),
+                'uncertainty': list(uncertainty)})['loglikelihood'],
+            expected)
+    # buffers are reused
+    buffers = chi_square._buffer((5,))
+    chi_square.calculate(flux, uncertainty)
+    assert chi_square._buffer((5,)) is buffers
+    # only the last shape is kept
+    chi_square.calculate(flux[0], uncertainty[0])
+    assert chi_square._buffer((5,)) is not buffers
+
+
+def test_chi_square_empty_bins(observation, models):
+    wl, observed, _ = observation
+    flux, uncertainty = models
+    chi_square = ChiSquare(wl, observed)
+    flux[:, 10] = 0 * FLUX_UNIT
+    uncertainty[:, 10] = 0 * FLUX_UNIT
+    for likelihood in [chi_square, StudentT(wl, observed)]:
+        with np.errstate(all='raise'):
+            obtained = likelihood.calculate(flux, uncertainty)
+        assert np.all(np.isfinite(obtained))
+
+
+def test_chain_posterior(observation, models):
+    from dalek.tools.base import Chain, Link
+    from dalek.tools.posterior import Posterior
+
+    flux, uncertainty = models
+
+    class Model(Link):
+        outputs = ('flux', 'uncertainty', 'logprior')
+
+        def calculate(self):
+            return flux[0], uncertainty[0], 1.
+
+    chi_square = ChiSquare(*observation)
+    result = Chain(Model(), chi_square, Posterior())()
+    assert result['posterior'] == 1. + chi_square.calculate(
+            flux[0], uncertainty[0])
+
+
+def test_chi_square_observed_uncertainty(observation, models):
+    flux, uncertainty = models
+    chi_square = ChiSquare(
+            *observation, start=4000, end=8000, model_uncertainty=False)
+    assert chi_square.inputs == ('flux',)
+    residual, variance = reference(observation, flux, 0 * uncertainty)
+    np.testing.assert_allclose(
+            chi_square.calculate(flux.value),
+            -0.5 * np.sum(residual ** 2 / variance, -1))
+
+    with pytest.raises(ValueError):
+        ChiSquare(observation[0], observation[1], model_uncertainty=False)
+
+
+def test_student_t(observation, models):
+    flux, uncertainty = models
+    student_t = StudentT(*observation, start=4000, end=8000, dof=3.)
+    residual, variance = reference(observation, flux, uncertainty)
+    expected = -np.sum(
+            2 * np.log(1 + residual ** 2 / (3 * variance)) +
+            0.5 * np.log(variance), -1)
+    np.testing.assert_allclose(student_t.calculate(flux, uncertainty), expected)
+
+
+def test_log_flux_chi_square(observation, models):
+    flux, uncertainty = models
+    log_chi_square = LogFluxChiSquare(*observation, start=4000, end=8000)
+    wl, observed, observed_uncertainty = observation
+    log_observation = (
+            wl, np.log(observed.value) * FLUX_UNIT,
+            observed_uncertainty / observed.value)
+    residual, variance = reference(
+            log_observation, np.log(flux.value) * FLUX_UNIT,
+            uncertainty / flux.value)
+    expected = -0.5 * np.sum(residual ** 2 / variance + np.log(variance), -1)
+    np.testing.assert_allclose(
+            log_chi_square.calculate(flux, uncertainty), expected)
+
+    flux = flux.copy()
+    flux[1, 50] = -1 * FLUX_UNIT
+    obtained = log_chi_square.calculate(flux, uncertainty)
+    assert obtained[1] == -np.inf
+    np.testing.assert_allclose(obtained[[0, 2, 3, 4]], expected[[0, 2, 3, 4]])
+    assert log_chi_square.calculate(flux[1], uncertainty[1]) == -np.inf
+
+
+def test_batch_pipeline(observation):
+    from dalek.tools.base import Chain, Link
+    from dalek.tools.prior import Prior, CheckPrior, ParameterValuePrior
+    from dalek.tools.providers import Flux
+    from dalek.tools.likelihood import SSum
+    from dalek.tools.posterior import Posterior
+
+    class ScaledLuminosity(Link):
+        inputs = ('parameters',)
+        outputs = ('luminosity',)
+
+        def calculate(self, parameters):
+            return (parameters['scale'] * np.ones(100) *
+                    4 * np.pi * (u.Mpc.to('cm') * u.cm) ** 2 * FLUX_UNIT)
+
+    Prior.reset()
+    wl, observed, _ = observation
+    observed = np.ones(100) * FLUX_UNIT
+    chain = Chain(
+            Prior(),
+            ParameterValuePrior(['scale'], lambda scale: scale > 0),
+            Chain(
+                CheckPrior(),
+                ScaledLuminosity(),
+                Flux(),
+                SSum(wl, observed),
+                breakable=True),
+            Posterior())
+    parameters = [{'scale': scale} for scale in [1., -1., 2., 0.5]]
+    result = chain.batch({'parameters': parameters})
+    for i, p in enumerate(parameters):
+        expected = chain({'parameters': p})
+        assert result['posterior'][i] == expected['posterior']
+    assert result['loglikelihood'][1] is None
+    Prior.reset()
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pytest
+from astropy import units as u
+
+from dalek.tools.base import Link, Chain
+from dalek.tools.memoize import Memoize, canonical_hash
+from dalek.tools.parameters import ParameterContainer, DynamicParameter
+
+
+class Square(Link):
+    inputs = ('parameters',)
+    outputs = ('flux',)
+
+    def __init__(self):
+        self.calls = 0
+
+    def calculate(self, parameters):
+        self.calls += 1
+        return np.array([parameters['a'], parameters['b']]) ** 2 * u.erg
+
+
+@pytest.fixture
+def tmpdir_path():
+    path = tempfile.mkdtemp()
+    yield path
+    shutil.rmtree(path)
+
+
+def test_canonical_hash():
+    assert canonical_hash({'a': 1, 'b': 2.}) == canonical_hash({'b': 2., 'a': 1})
+    assert canonical_hash({'a': 1.}) != canonical_hash({'a': 1 + 1e-15})
+    assert canonical_hash(2 ** 53) != canonical_hash(2 ** 53 + 1)
+    assert canonical_hash(np.int64(3)) == canonical_hash(3)
+    assert canonical_hash(3) != canonical_hash(3.)
+    assert canonical_hash(True) != canonical_hash(1)
+    assert canonical_hash(np.arange(3.)) == canonical_hash(np.arange(3.))
+    assert canonical_hash(np.arange(3.)) != canonical_hash(np.arange(3))
+    assert canonical_hash(1. * u.m) != canonical_hash(1. * u.cm)
+
+    parameters = ParameterContainer(
+            DynamicParameter('a', bounds=(0, 2)),
+            DynamicParameter('b', bounds=(0, 2)))
+    parameters.values = [0.5, 0.25]
+    key = canonical_hash(parameters)
+    parameters.values = [0.5, 0.5]
+    assert canonical_hash(parameters) != key
+    parameters.values = [0.5, 0.25]
+    assert canonical_hash(parameters) == key
+
+
+def test_memoize_hits_and_lru():
+    square = Square()
+    memo = Memoize(Chain(square), maxsize=2)
+    assert memo.inputs == ('parameters',)
+
+    for a in [1., 2., 1., 3., 2., 1.]:
+        flux = memo(parameters={'a': a, 'b': 2.})['flux']
+        assert np.all(flux == [a ** 2, 4.] * u.erg)
+    # 1 -> 2 -> 1 (hit) -> 3 evicts 2 -> 2 evicts 1 -> 1
+    assert (memo.hits, memo.misses) == (1, 5)
+    assert square.calls == 5
+    assert memo.cache_size == 2
+
+
+def test_memoize_batch():
+    square = Square()
+    chain = Chain(Memoize(square))
+    parameters = [{'a': a, 'b': 1.} for a in [1., 2., 1.]]
+    flux = chain.batch({'parameters': parameters})['flux']
+    assert len(flux) == 3
+    for p, f in zip(parameters, flux):
+        assert np.all(f == [p['a'] ** 2, 1.] * u.erg)
+    assert square.calls == 2
+
+
+def test_memoize_hdf(tmpdir_path):
+    path = os.path.join(tmpdir_path, 'memo.h5')
+    memo = Memoize(Square(), path=path)
+    first = memo(parameters={'a': 3., 'b': 1.})['flux']
+
+    square = Square()
+    memo = Memoize(square, path=path)
+    again = memo(parameters={'a': 3., 'b': 1.})['flux']
+    assert square.calls == 0
+    assert (memo.hits, memo.disk_hits, memo.misses) == (1, 1, 0)
+    assert np.all(first == again)
+    assert again.unit == u.erg
+
+    memo(parameters={'a': 3., 'b': 1.})
+    assert (memo.hits, memo.disk_hits) == (2, 1)
@@ -0,0 +1,28 @@
+import numpy as np
+
+from dalek.tools.meta import SaveRun
+
+
+class Container(object):
+
+    def __init__(self):
+        self.saved = []
+
+    def save(self, item, path):
+        self.saved.append((item, path))
+
+
+def test_save_run_copies_parameters():
+    container = Container()
+    link = SaveRun(container)
+    parameters = {'a': 1.}
+    link(
+            model=None, uuid='abc', rank=0, iteration=0,
+            parameters=parameters, posterior=0.5, flux=np.nan, runtime=2.,
+            host='host', time=None)
+    parameters['a'] = 2.
+    assert parameters == {'a': 2.}
+    item, path = container.saved[0]
+    assert path == 'run_table'
+    assert item._info_dict['a'] == 1.
+    assert item._info_dict['runtime'] == 2.
@@ -0,0 +1,77 @@
+import numpy as np
+
+from dalek.tools.base import Link, Chain, DynamicOutput
+from dalek.tools.profiling import Profiler
+from dalek.tools.test_base import AppleTrue, AppleToggle, AppleBreak
+
+
+class Ones(Link):
+    outputs = ('ones',)
+
+    def calculate(self):
+        return np.ones(10)
+
+
+class Twice(Link):
+    inputs = ('x',)
+    outputs = ('y',)
+
+    def calculate(self, x):
+        return 2 * x
+
+    def calculate_batch(self, x):
+        return self.calculate(np.asarray(x))
+
+
+def test_profiler():
+    chain = Chain(
+            Ones(), Chain(AppleTrue(), AppleToggle()), AppleBreak(),
+            DynamicOutput('apple'), breakable=True)
+    with Profiler(chain) as profiler:
+        for _ in range(3):
+            chain()
+        chain.compile()
+        chain()
+    stats = profiler.stats()
+    assert list(stats.index) == [
+            '0:Ones', '1:Chain/0:AppleTrue', '1:Chain/1:AppleToggle',
+            '2:AppleBreak', '3:DynamicOutput']
+    assert list(stats['calls']) == [4, 4, 4, 4, 4]
+    assert list(stats['breaks']) == [0, 0, 0, 0, 0]
+    assert stats.loc['0:Ones', 'bytes'] == 4 * 80
+    assert (stats['total'] >= stats['p99']).all()
+
+    profiler.reset()
+    assert profiler.stats()['calls'].sum() == 0
+    # detached
+    chain()
+    assert profiler.stats()['calls'].sum() == 0
+    assert 'calculate' not in chain._links[0].__dict__
+
+
+def test_profiler_break():
+    chain = Chain(AppleTrue(), AppleBreak(), breakable=True)
+    profiler = Profiler(chain)
+    chain()
+    stats = profiler.stats()
+    assert stats.loc['1:AppleBreak', 'breaks'] == 1
+    assert stats.loc['1:AppleBreak', 'calls'] == 1
+
+
+def test_profiler_detach_restores():
+    link = Ones()
+    link.calculate = lambda: np.zeros(3)
+    chain = Chain(link)
+    with Profiler(chain) as profiler:
+        assert np.all(chain()['ones'] == 0)
+    assert profiler.stats().loc['0:Ones', 'calls'] == 1
+    # the replaced calculate is still there
+    assert np.all(chain()['ones'] == 0)
+
+
+def test_profiler_batch():
+    chain = Chain(Twice())
+    with Profiler(chain) as profiler:
+        assert chain.batch({'x': [1., 2.]})['y'] == [2., 4.]
+    # calculate inside of calculate_batch isn't counted again
+    assert profiler.stats().loc['0:Twice', 'calls'] == 1
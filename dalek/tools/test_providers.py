@@ -1,13 +1,17 @@
 import pytest
 import numpy as np
-from astropy import units as u
+from astropy import units as u, constants as c
 
 from dalek.tools.providers import (
         PacketProvider, VirtualPacketProvider,
         Luminosity, VirtualLuminosity,
         Flux,
+        VirtualPacketChunkProvider, PacketFileChunkProvider,
+        StreamingLuminosity, packet_chunks,
+        LuminosityUncertainty, FluxUncertainty,
         )
-from dalek.tools.base import Chain
+from dalek.tools.base import Chain, Link
+from dalek.util import Rebinner, bin_edge_to_center
 
 
 @pytest.fixture
@@ -71,6 +75,155 @@ def test_luminosity(input_dict, model, bins):
     assert obtained.unit.is_equivalent('erg/ (angstrom s)')
 
 
+@pytest.mark.parametrize('wl', [
+    np.linspace(3000, 9000, 201),
+    (np.linspace(3.3e14, 1e15, 301) * u.Hz).to(
+        u.angstrom, u.spectral()).value[::-1],
+    np.logspace(3.5, 3.95, 150),
+    # widths are not integers
+    np.linspace(3500, 7500, 334),
+    ])
+def test_luminosity_fast(wl):
+    state = np.random.RandomState(0)
+    packet_nu = (state.uniform(2900, 9100, 10000) * u.angstrom).to(
+            u.Hz, u.spectral())
+    packet_energy = state.random_sample(10000) * u.erg / u.s
+    expected = Luminosity(wl * u.angstrom).calculate(packet_nu, packet_energy)
+    obtained = Luminosity(wl * u.angstrom, fast=True).calculate(
+            packet_nu, packet_energy)
+    assert obtained.unit == expected.unit
+    np.testing.assert_allclose(obtained.value, expected.value)
+
+
+@pytest.mark.parametrize('wl', [
+    np.linspace(3500, 7500, 334),
+    (np.linspace(3.3e14, 1e15, 301) * u.Hz).to(
+        u.angstrom, u.spectral()).value[::-1],
+    ])
+def test_luminosity_fast_edges(wl):
+    # packets just inside of the outermost edges
+    packet_wl = np.array([
+        wl[0], wl[0] * (1 + 1e-15), wl[-1] * (1 - 1e-15), wl[-1],
+        np.nextafter(wl[-1], 0)])
+    packet_nu = c.c.to('angstrom/s').value / packet_wl * u.Hz
+    packet_energy = np.ones(len(packet_wl)) * u.erg / u.s
+    obtained = Luminosity(wl * u.angstrom, fast=True).calculate(
+            packet_nu, packet_energy)
+    assert obtained.shape == (len(wl) - 1,)
+    np.testing.assert_allclose(
+            (obtained.value * np.diff(wl)).sum(), len(packet_wl))
+
+
+def test_luminosity_fast_nm():
+    state = np.random.RandomState(0)
+    packet_nu = (state.uniform(290, 910, 10000) * u.nm).to(
+            u.Hz, u.spectral())
+    packet_energy = state.random_sample(10000) * u.erg / u.s
+    wl = np.linspace(300, 900, 151) * u.nm
+    expected = np.histogram(
+            packet_nu.to(u.nm, u.spectral()).value,
+            weights=packet_energy.value,
+            bins=wl.value)[0] / np.diff(wl.value) * u.erg / u.s / u.nm
+    obtained = Luminosity(wl, fast=True).calculate(packet_nu, packet_energy)
+    np.testing.assert_allclose(
+            obtained.to_value(expected.unit), expected.value)
+    streamed = StreamingLuminosity(wl).calculate(iter(
+        packet_chunks(packet_nu.value, packet_energy.value, 999)))
+    np.testing.assert_allclose(
+            streamed.to_value(expected.unit),
+            expected.value)
+
+
+def test_streaming_luminosity(tmpdir):
+    state = np.random.RandomState(0)
+    packet_nu = (state.uniform(2900, 9100, 10000) * u.angstrom).to(
+            u.Hz, u.spectral())
+    packet_energy = state.random_sample(10000)
+    wl = np.linspace(3000, 9000, 201) * u.angstrom
+    expected = Luminosity(wl).calculate(
+            packet_nu, packet_energy * u.erg / u.s)
+
+    chunks = list(packet_chunks(packet_nu.value, packet_energy, 999))
+    assert len(chunks) == 11
+    obtained = StreamingLuminosity(wl).calculate(iter(chunks))
+    assert obtained.unit == expected.unit
+    np.testing.assert_allclose(obtained.value, expected.value)
+
+    fname = str(tmpdir.join('packets.npy'))
+    np.save(fname, np.column_stack((packet_nu.value, packet_energy)))
+    chain = Chain(PacketFileChunkProvider(999), StreamingLuminosity(wl))
+    np.testing.assert_allclose(
+            chain({'packet_file': fname})['luminosity'].value, expected.value)
+
+
+def test_streaming_vluminosity(vmodel, bins):
+    expected = VirtualLuminosity(bins * u.angstrom)(
+            VirtualPacketProvider()({'model': vmodel}))['luminosity']
+    chain = Chain(
+            VirtualPacketChunkProvider(1000),
+            StreamingLuminosity(bins * u.angstrom))
+    obtained = chain({'model': vmodel})['luminosity']
+    np.testing.assert_allclose(obtained.value, expected.value)
+
+
+class RandomPackets(Link):
+    outputs = ('packet_nu', 'packet_energy',)
+
+    def calculate(self):
+        state = np.random.RandomState(0)
+        return (
+                (state.uniform(2900, 9100, 10000) * u.angstrom).to(
+                    u.Hz, u.spectral()),
+                state.random_sample(10000) * u.erg / u.s,
+                )
+
+
+def test_luminosity_uncertainty():
+    wl = np.linspace(3000, 9000, 201) * u.angstrom
+    packets = RandomPackets()()
+    result = Chain(LuminosityUncertainty(wl), FluxUncertainty())(packets)
+    expected = Luminosity(wl)(packets)['luminosity']
+    variance = np.histogram(
+            packets['packet_nu'].to(u.angstrom, u.spectral()).value,
+            weights=packets['packet_energy'].value ** 2, bins=wl.value)[0]
+    np.testing.assert_allclose(result['luminosity'].value, expected.value)
+    np.testing.assert_allclose(
+            result['uncertainty'].value,
+            Flux().calculate(np.sqrt(variance) / np.diff(wl.value)).value)
+    assert result['uncertainty'].unit.is_equivalent(result['flux'].unit)
+
+    rebinner = Rebinner.get(
+            bin_edge_to_center(wl), np.linspace(3500, 8500, 51) * u.angstrom)
+    result = LuminosityUncertainty(rebinner)(packets)
+    np.testing.assert_allclose(
+            result['luminosity'].value, rebinner(expected.value))
+    assert np.all(result['uncertainty'].value > 0)
+
+
+def test_flux_uncertainty_batch():
+    wl = np.linspace(3000, 9000, 201) * u.angstrom
+    chain = Chain(RandomPackets(), LuminosityUncertainty(wl), FluxUncertainty())
+    result = chain.batch(batch_size=3)
+    expected = chain()
+    assert len(result['flux']) == len(result['uncertainty']) == 3
+    for flux, uncertainty in zip(result['flux'], result['uncertainty']):
+        assert flux.unit == expected['flux'].unit
+        np.testing.assert_allclose(flux.value, expected['flux'].value)
+        np.testing.assert_allclose(
+                uncertainty.value, expected['uncertainty'].value)
+
+
+def test_luminosity_rebinner(model, bins):
+    target = np.linspace(bins[0], bins[-1], len(bins) // 4)[1:-1]
+    rebinner = Rebinner.get(bin_edge_to_center(bins), target)
+    obtained = Luminosity(rebinner)(
+            PacketProvider()({'model': model,}))['luminosity']
+    expected = Luminosity(bins * u.angstrom)(
+            PacketProvider()({'model': model,}))['luminosity']
+    np.testing.assert_allclose(obtained.value, rebinner(expected.value))
+    assert obtained.unit.is_equivalent('erg/ (angstrom s)')
+
+
 def test_vluminosity(input_dict, vmodel, bins):
     vluminosity = VirtualLuminosity(bins * u.angstrom)
     lum_density = np.histogram(
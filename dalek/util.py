@@ -1,5 +1,10 @@
 import os
+import hashlib
+import warnings
+from collections import OrderedDict
+
 import numpy as np
+from scipy import sparse
 from astropy import units as u, constants as const
 # Some helper functions
 
@@ -65,7 +70,7 @@ def weighted_avg_and_std(values, weights):
     return (average, np.sqrt(variance))
 
 #stolen from https://bitbucket.org/astro_ufsc/pystarlight/src/20c5b3444bbed9ace92e32162bfd816b2e75da3b/src/pystarlight/util/StarlightUtils.py?at=default#cl-93
-def ReSamplingMatrixNonUniform(lorig, lresam, extrap = False):
+def ReSamplingMatrixNonUniform(lorig, lresam, extrap = False, dense=False):
     '''
     Compute resampling matrix R_o2r, useful to convert a spectrum sampled at
     wavelengths lorig to a new grid lresamp. Here, there is no necessity to have constant gris as on :py:func:`ReSamplingMatrix`.
@@ -75,6 +80,10 @@ def ReSamplingMatrixNonUniform(lorig, lresam, extrap = False):
 
         [[ResampMat]] [F_o] = [F_r]
 
+    Every resampled bin only overlaps a contiguous range of original bins,
+    which is found with searchsorted on the bin edges. Time and memory are
+    O(Nlorig + Nlresamp) instead of O(Nlorig * Nlresamp).
+
     Warning! lorig and lresam MUST be on ascending order!
 
 
@@ -90,10 +99,13 @@ def ReSamplingMatrixNonUniform(lorig, lresam, extrap = False):
            Extrapolate values, i.e., values for lresam < lorig[0]  are set to match lorig[0] and
                                      values for lresam > lorig[-1] are set to match lorig[-1].
 
+    dense : boolean, optional
+           Return a dense ndarray instead of a scipy.sparse.csr_matrix.
+
 
     Returns
     -------
-    ResampMat : array_like
+    ResampMat : scipy.sparse.csr_matrix or array_like
                 Resample matrix.
 
     Examples
@@ -102,12 +114,11 @@ def ReSamplingMatrixNonUniform(lorig, lresam, extrap = False):
     >>> lresam = np.linspace(3400, 8900, 5000)
     >>> forig = np.random.normal(size=len(lorig))**2
     >>> matrix = slut.ReSamplingMatrixNonUniform(lorig, lresam)
-    >>> fresam = np.dot(matrix, forig)
+    >>> fresam = matrix.dot(forig)
     >>> print np.trapz(forig, lorig), np.trapz(fresam, lresam)
     '''
-
-    # Init ResampMatrix
-    matrix = np.zeros((len(lresam), len(lorig)))
+    n_r = len(lresam)
+    n_o = len(lorig)
 
     # Define lambda ranges (low, upp) for original and resampled.
     lo_low = np.zeros(len(lorig))
@@ -126,47 +137,39 @@ def ReSamplingMatrixNonUniform(lorig, lresam, extrap = False):
     lr_upp[:-1] = lr_low[1:]
     lr_upp[-1] = lresam[-1] + (lresam[-1] - lresam[-2])/2
 
+    # Original bins with lr_low < lo_upp and lr_upp > lo_low, for every
+    # resampled bin as the range [first, last).
+    first = lo_upp.searchsorted(lr_low, side='right')
+    last = lo_low.searchsorted(lr_upp, side='left')
+    counts = np.maximum(last - first, 0)
+    i_r = np.repeat(np.arange(n_r), counts)
+    offset = np.repeat(first - np.cumsum(counts) + counts, counts)
+    i_o = np.arange(counts.sum()) + offset
 
-    # Iterate over resampled lresam vector
-    for i_r in range(len(lresam)):
-
-        # Find in which bins lresam bin within lorig bin
-        bins_resam = np.where( (lr_low[i_r] < lo_upp) & (lr_upp[i_r] > lo_low) )[0]
-
-        # On these bins, eval fraction of resamled bin is within original bin.
-        for i_o in bins_resam:
-
-            aux = 0
-
-            d_lr = lr_upp[i_r] - lr_low[i_r]
-            d_lo = lo_upp[i_o] - lo_low[i_o]
-            d_ir = lo_upp[i_o] - lr_low[i_r]  # common section on the right
-            d_il = lr_upp[i_r] - lo_low[i_o]  # common section on the left
-
-            # Case 1: resampling window is smaller than or equal to the original window.
-            # This is where the bug was: if an original bin is all inside the resampled bin, then
-            # all flux should go into it, not then d_lr/d_lo fraction. --Natalia@IoA - 21/12/2012
-            if (lr_low[i_r] > lo_low[i_o]) & (lr_upp[i_r] < lo_upp[i_o]):
-                aux += 1.
-
-            # Case 2: resampling window is larger than the original window.
-            if (lr_low[i_r] < lo_low[i_o]) & (lr_upp[i_r] > lo_upp[i_o]):
-                aux += d_lo / d_lr
-
-            # Case 3: resampling window is on the right of the original window.
-            if (lr_low[i_r] > lo_low[i_o]) & (lr_upp[i_r] > lo_upp[i_o]):
-                aux += d_ir / d_lr
+    a, b = lr_low[i_r], lr_upp[i_r]
+    c, d = lo_low[i_o], lo_upp[i_o]
+    d_lr = b - a
+    values = np.zeros(len(i_r))
 
-            # Case 4: resampling window is on the left of the original window.
-            if (lr_low[i_r] < lo_low[i_o]) & (lr_upp[i_r] < lo_upp[i_o]):
-                aux += d_il / d_lr
+    # Case 1: resampling window is smaller than or equal to the original window.
+    # This is where the bug was: if an original bin is all inside the resampled bin, then
+    # all flux should go into it, not then d_lr/d_lo fraction. --Natalia@IoA - 21/12/2012
+    case = (a > c) & (b < d)
+    values[case] = 1.
 
-            matrix[i_r, i_o] += aux
+    # Case 2: resampling window is larger than the original window.
+    case = (a < c) & (b > d)
+    values[case] = (d - c)[case] / d_lr[case]
 
+    # Case 3: resampling window is on the right of the original window.
+    case = (a > c) & (b > d)
+    values[case] = (d - a)[case] / d_lr[case]
 
-    # Fix matrix to be exactly = 1 ==> TO THINK
-    #print np.sum(matrix), np.sum(lo_upp - lo_low), (lr_upp - lr_low).shape
+    # Case 4: resampling window is on the left of the original window.
+    case = (a < c) & (b < d)
+    values[case] = (b - c)[case] / d_lr[case]
 
+    matrix = sparse.csr_matrix((values, (i_r, i_o)), shape=(n_r, n_o))
 
     # Fix extremes: extrapolate if needed
     if (extrap):
@@ -175,11 +178,97 @@ def ReSamplingMatrixNonUniform(lorig, lresam, extrap = False):
         bins_extrapr = np.where( (lr_upp > lo_upp[-1]) )[0]
 
         if (len(bins_extrapl) > 0) & (len(bins_extrapr) > 0):
-            io_extrapl = np.where( (lo_low >= lr_low[bins_extrapl[0]])  )[0][0]
-            io_extrapr = np.where( (lo_upp <= lr_upp[bins_extrapr[0]])  )[0][-1]
+            io_extrapl = lo_low.searchsorted(lr_low[bins_extrapl[0]], side='left')
+            io_extrapr = lo_upp.searchsorted(lr_upp[bins_extrapr[0]], side='right') - 1
+
+            with warnings.catch_warnings():
+                # changing the sparsity structure of a csr matrix is slow,
+                # but these are only a few entries at the edges
+                warnings.simplefilter('ignore', sparse.SparseEfficiencyWarning)
+                matrix[bins_extrapl, io_extrapl] = 1.
+                matrix[bins_extrapr, io_extrapr] = 1.
+
+    if dense:
+        return matrix.toarray()
+    return matrix
+
 
-            matrix[bins_extrapl, io_extrapl] = 1.
-            matrix[bins_extrapr, io_extrapr] = 1.
+def grid_hash(grid):
+    '''
+    Hash of the values, shape and unit of a wavelength grid.
+    '''
+    unit = getattr(grid, 'unit', None)
+    values = np.ascontiguousarray(getattr(grid, 'value', grid), dtype=np.float64)
+    digest = hashlib.sha1(values.tobytes())
+    digest.update(str((values.shape, unit)).encode())
+    return digest.hexdigest()
 
 
-    return matrix
+class Rebinner(object):
+    '''
+    Flux conserving rebinning from the bin centres `source` to the bin
+    centres `target`, see ReSamplingMatrixNonUniform.
+
+    The resampling matrix and the bin edges and widths of both grids are
+    computed once. Use Rebinner.get to share one instance per pair of grids
+    across the pipeline; the last `cache_size` instances are kept.
+    '''
+    cache_size = 32
+    _cache = OrderedDict()
+
+    def __init__(self, source, target, extrap=False):
+        self.unit = getattr(source, 'unit', None)
+        self.source = self._values(source)
+        self.target = self._values(target)
+        self.source_edges = bin_center_to_edge(self.source)
+        self.target_edges = bin_center_to_edge(self.target)
+        self.source_widths = np.diff(self.source_edges)
+        self.target_widths = np.diff(self.target_edges)
+        self.matrix = ReSamplingMatrixNonUniform(
+                self.source, self.target, extrap=extrap)
+
+    def _values(self, grid):
+        if self.unit is None:
+            return np.asarray(grid, dtype=np.float64)
+        return u.Quantity(grid, self.unit).value
+
+    @classmethod
+    def get(cls, source, target, extrap=False):
+        '''
+        Cached Rebinner for the given grids.
+        '''
+        key = (grid_hash(source), grid_hash(target), extrap)
+        try:
+            rebinner = cls._cache.pop(key)
+        except KeyError:
+            rebinner = cls(source, target, extrap)
+        cls._cache[key] = rebinner
+        while len(cls._cache) > cls.cache_size:
+            cls._cache.popitem(last=False)
+        return rebinner
+
+    @classmethod
+    def clear_cache(cls):
+        cls._cache.clear()
+
+    def __call__(self, flux):
+        '''
+        Rebin a spectrum or a stack of spectra with shape
+        (n_spectra, len(source)). Units of `flux` are kept.
+        '''
+        unit = getattr(flux, 'unit', None)
+        flux = np.asarray(getattr(flux, 'value', flux))
+        rebinned = self.matrix.dot(flux.T).T
+        if unit is None:
+            return rebinned
+        return rebinned * unit
+
+
+def resample(lorig, lresam, flux, extrap=False):
+    '''
+    Resample `flux` from the bin centres lorig to lresam with the cached
+    Rebinner for these grids. `flux` can be a single spectrum or a stack of
+    spectra with shape (n_spectra, len(lorig)), all of which are resampled
+    with one sparse matrix product.
+    '''
+    return Rebinner.get(lorig, lresam, extrap)(flux)
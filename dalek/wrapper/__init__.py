@@ -1 +1 @@
-from hdfstore import SafeHDFStore
+from hdfstore import SafeHDFStore, HDFSession
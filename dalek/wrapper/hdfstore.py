@@ -1,34 +1,298 @@
 import os
 import time
 import errno
+import random
+import atexit
+import socket
 import logging
+import weakref
+import threading
 
 from pandas import HDFStore
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 logger = logging.getLogger(__name__)
 
 
-class SafeHDFStore(HDFStore):
-    def open(self, *args, **kwargs):
-        probe_interval = kwargs.pop("probe_interval", 0.1)
-        self._lock = "%s.lock" % self._path
-        while True:
+def _backoff(max_interval, first=1e-3):
+    '''
+    Yields right away, then after sleeps growing exponentially up to
+    `max_interval`, randomized so waiting processes don't probe in
+    lockstep.
+    '''
+    interval = first
+    while True:
+        yield
+        time.sleep(random.uniform(0.5, 1.) * interval)
+        interval = min(2 * interval, max_interval)
+
+
+def _owner():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class FileLock(object):
+    '''
+    Advisory lock on the file `path` using flock. With shared=True several
+    readers can hold the lock at once. Waiting processes block in flock
+    and are woken by the kernel as soon as the lock is released. The kernel
+    also releases the lock when the holding process dies, so a lock can't
+    go stale. The file itself is kept, it contains the host and pid of the
+    last writer.
+
+    `max_interval` is ignored, it is only there so both lock classes take
+    the same arguments (see ExclusiveFileLock).
+    '''
+
+    def __init__(self, path, shared=False, max_interval=0.1):
+        self.path = path
+        self.shared = shared
+        self.max_interval = max_interval
+        self._fd = None
+
+    @property
+    def locked(self):
+        return self._fd is not None
+
+    def acquire(self):
+        fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+        operation = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, operation)
+                    break
+                except IOError as e:
+                    if e.errno != errno.EINTR:
+                        raise
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        if not self.shared:
+            os.ftruncate(fd, 0)
+            os.write(fd, _owner())
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class ExclusiveFileLock(FileLock):
+    '''
+    Lock held by creating `path` exclusively, for systems without fcntl.
+    Readers are exclusive as well. Waiting processes retry with jittered,
+    exponentially growing intervals up to `max_interval`.
+
+    The file contains host and pid of the holder; a lock of a dead process
+    on the same host is removed. The removal is guarded by "<path>.guard"
+    and the owner is checked again inside of the guard, so a lock created
+    in the meantime is never removed. A guard older than `guard_timeout`
+    seconds is left over by a dead process and removed.
+    '''
+    guard_timeout = 10.
+
+    def acquire(self):
+        for _ in _backoff(self.max_interval):
             try:
-                self._flock = os.open(
-                        self._lock, os.O_CREAT |
-                        os.O_EXCL |
-                        os.O_WRONLY)
-                break
+                fd = os.open(
+                        self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
             except OSError as e:
-                if e.errno == errno.EEXIST:
-                    time.sleep(probe_interval)
-                else:
-                    raise e
+                if e.errno != errno.EEXIST:
+                    raise
+                self._remove_stale()
+            else:
+                os.write(fd, _owner())
+                self._fd = fd
+                return
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        os.close(fd)
+        os.remove(self.path)
+
+    def _dead_owner(self):
+        '''
+        Content of the lock file if its process is gone, otherwise None.
+        '''
+        try:
+            with open(self.path) as f:
+                owner = f.read()
+            host, pid = owner.rsplit(':', 1)
+            pid = int(pid)
+        except (IOError, ValueError):
+            # gone or still being written
+            return None
+        if host != socket.gethostname():
+            return None
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                return owner
+        return None
+
+    def _remove_stale(self):
+        owner = self._dead_owner()
+        if owner is None:
+            return
+        guard = self.path + '.guard'
+        try:
+            fd = os.open(guard, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            self._remove_stale_guard(guard)
+            return
+        try:
+            # the lock may have been replaced since it was read
+            if self._dead_owner() == owner:
+                logger.warning(
+                        'Removing stale lock %s of %s', self.path, owner)
+                os.remove(self.path)
+        finally:
+            os.close(fd)
+            os.remove(guard)
+
+    def _remove_stale_guard(self, guard):
+        try:
+            if time.time() - os.path.getmtime(guard) > self.guard_timeout:
+                logger.warning('Removing stale guard %s', guard)
+                os.remove(guard)
+        except OSError:
+            pass
+
+
+class SafeHDFStore(HDFStore):
+    '''
+    HDFStore holding the lock "<path>.lock" while it is open. Stores opened
+    with mode='r' share the lock, so readers don't wait for each other.
+
+    Keyword arguments (of the constructor and open):
+    probe_interval -- maximum time between two attempts to get the lock,
+                    only used without fcntl (default: 0.1)
+    '''
+    lock_class = FileLock if fcntl is not None else ExclusiveFileLock
 
-        super(SafeHDFStore, self).open(*args, **kwargs)
+    def open(self, mode='a', **kwargs):
+        probe_interval = kwargs.pop("probe_interval", 0.1)
+        # HDFStore.open closes an open file, do it before taking the lock
+        if self.is_open:
+            self.close()
+        self._flock = self.lock_class(
+                "%s.lock" % self._path, shared=(mode == 'r'),
+                max_interval=probe_interval)
+        self._flock.acquire()
+        try:
+            super(SafeHDFStore, self).open(mode=mode, **kwargs)
+        except BaseException:
+            self._release()
+            raise
 
     def close(self):
         logger.debug('Close SafeHDFStore')
         super(SafeHDFStore, self).close()
-        os.close(self._flock)
-        os.remove(self._lock)
+        self._release()
+
+    def _release(self):
+        flock, self._flock = getattr(self, '_flock', None), None
+        if flock is not None:
+            flock.release()
+
+
+class HDFSession(object):
+    '''
+    Shares one SafeHDFStore between many short uses. The store is opened
+    on first use and closed (releasing the lock) at most `window` seconds
+    later, so other processes get their turn. `on_release(session)` is
+    called right before closing, e.g. to write collected data in one go;
+    it runs on the timer thread and should use session.open() rather than
+    the store property, which would schedule another release.
+    Use it as context manager (with session as store: ...) or through the
+    store property while holding session.lock.
+
+    Open sessions are released at exit.
+
+    Other keyword arguments are passed on to SafeHDFStore.
+    '''
+
+    def __init__(self, path, window=1., on_release=None, **kwargs):
+        self.path = path
+        self.window = window
+        self.on_release = on_release
+        self.lock = threading.RLock()
+        self._kwargs = kwargs
+        self._store = None
+        self._timer = None
+        _sessions.add(self)
+
+    @property
+    def is_open(self):
+        return self._store is not None
+
+    @property
+    def store(self):
+        with self.lock:
+            self.schedule()
+            return self.open()
+
+    def open(self):
+        '''
+        Returns the store, opening it if necessary, without scheduling the
+        release.
+        '''
+        with self.lock:
+            if self._store is None:
+                self._store = SafeHDFStore(self.path, **self._kwargs)
+            return self._store
+
+    def schedule(self):
+        '''
+        Make sure release is called within `window` seconds.
+        '''
+        with self.lock:
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.release)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def release(self):
+        with self.lock:
+            try:
+                if self.on_release is not None:
+                    self.on_release(self)
+            finally:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if self._store is not None:
+                    self._store.close()
+                    self._store = None
+
+    close = release
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            return self.store
+        except BaseException:
+            self.lock.release()
+            raise
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+
+# weak, so the registry doesn't keep sessions alive
+_sessions = weakref.WeakSet()
+
+
+@atexit.register
+def _release_sessions():
+    for session in list(_sessions):
+        session.release()
@@ -0,0 +1,120 @@
+import gc
+import os
+import shutil
+import socket
+import tempfile
+import time
+import threading
+import weakref
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from dalek.wrapper.hdfstore import (
+        SafeHDFStore, HDFSession, FileLock, ExclusiveFileLock, fcntl)
+
+
+@pytest.fixture
+def path():
+    directory = tempfile.mkdtemp()
+    yield os.path.join(directory, 'test.h5')
+    shutil.rmtree(directory)
+
+
+def test_safe_hdfstore(path):
+    with SafeHDFStore(path) as store:
+        store['a'] = pd.Series(np.arange(3))
+        assert os.path.exists(path + '.lock')
+    readers = [SafeHDFStore(path, mode='r') for _ in range(2)]
+    assert all(np.all(r['a'] == np.arange(3)) for r in readers)
+    for r in readers:
+        r.close()
+
+
+@pytest.mark.skipif(fcntl is None, reason='fcntl not available')
+def test_file_lock(path):
+    lock = FileLock(path)
+    lock.acquire()
+    other = FileLock(path, shared=True)
+    waiting = threading.Thread(target=other.acquire)
+    waiting.start()
+    waiting.join(0.1)
+    assert waiting.is_alive()
+    lock.release()
+    waiting.join()
+    assert other.locked
+    # readers share the lock
+    reader = FileLock(path, shared=True)
+    reader.acquire()
+    reader.release()
+    other.release()
+
+
+def test_exclusive_file_lock_stale(path):
+    with open(path, 'w') as f:
+        # pid of a process which is gone
+        f.write('{}:{}'.format(socket.gethostname(), 2 ** 22 + 1))
+    lock = ExclusiveFileLock(path)
+    lock.acquire()
+    assert lock.locked
+    lock.release()
+    assert not os.path.exists(path)
+
+
+def test_hdf_session(path):
+    released = []
+    session = HDFSession(
+            path, window=0.05, on_release=lambda s: released.append(s))
+    with session as store:
+        store['a'] = pd.Series(np.arange(3))
+    with session as other:
+        # still the same store
+        assert other is store
+        assert np.all(other['a'] == np.arange(3))
+    time.sleep(0.2)
+    assert not session.is_open
+    assert released == [session]
+    with SafeHDFStore(path, mode='r') as store:
+        assert np.all(store['a'] == np.arange(3))
+
+
+def test_hdf_session_release(path):
+    def write(session):
+        session.open()['b'] = pd.Series(np.arange(2))
+
+    session = HDFSession(path, window=0.05, on_release=write)
+    session.schedule()
+    time.sleep(0.2)
+    # writing during the release doesn't schedule another one
+    assert session._timer is None
+    assert not session.is_open
+    with SafeHDFStore(path, mode='r') as store:
+        assert np.all(store['b'] == np.arange(2))
+
+    # the exit handler doesn't keep sessions alive
+    ref = weakref.ref(session)
+    del session
+    gc.collect()
+    assert ref() is None
+
+
+def test_exclusive_file_lock_race(path):
+    class Racing(ExclusiveFileLock):
+        # another waiter replaces the stale lock right after it was read
+        def _dead_owner(self):
+            owner = super(Racing, self)._dead_owner()
+            if owner is not None and not os.path.exists(self.path + '.guard'):
+                os.remove(self.path)
+                other.acquire()
+            return owner
+
+    with open(path, 'w') as f:
+        f.write('{}:{}'.format(socket.gethostname(), 2 ** 22 + 1))
+    other = ExclusiveFileLock(path)
+    Racing(path)._remove_stale()
+    # the new lock of the other waiter is kept
+    assert os.path.exists(path)
+    assert other.locked
+    assert not os.path.exists(path + '.guard')
+    other.release()